@@ -0,0 +1,236 @@
+## Server-side micro-batching for the prediction API. Concurrent requests are collected
+# into a single batch, run through the model in one forward pass and the results are
+# handed back to each waiting request.
+
+## Imports
+import asyncio
+import collections
+import time
+
+import numpy as np
+
+from concurrency import QueueFullError
+
+
+## Classes
+
+class BatchingQueue:
+    """
+    Collect images from concurrent requests into batches for the model.
+
+    A batch is run when it reaches max_batch_size images or when its first image has
+    waited for max_latency_ms, whichever comes first. The forward passes run in the
+    given executor, at most max_concurrent_batches at a time.
+    """
+
+    def __init__(self, predict_fn, executor=None, max_batch_size=8,
+                 max_latency_ms=5.0, max_concurrent_batches=1, max_queue_size=0,
+                 history_size=1000):
+        """
+        :param predict_fn: Function that takes a batch of images (numpy array) and
+            returns a list with one result per image
+        :param executor: Executor for running predict_fn. None uses the default
+            executor of the event loop.
+        :param max_batch_size: Largest number of images in one forward pass
+        :param max_latency_ms: Longest time the first image of a batch waits for more
+            images (milliseconds)
+        :param max_concurrent_batches: Number of forward passes allowed to run at once
+        :param max_queue_size: Number of images allowed to wait in the queue. Further
+            images are rejected with QueueFullError. 0 means no limit.
+        :param history_size: Number of recent wait times kept for the metrics
+        """
+        self.predict_fn = predict_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.max_concurrent_batches = max_concurrent_batches
+        self.max_queue_size = max_queue_size
+
+        # The queue and the worker are created in start(), since they need a running
+        # event loop
+        self._queue = None
+        self._worker = None
+        self._batch_slots = None
+        self._batch_tasks = set()
+        self._stopped = False
+
+        # Metrics: number of batches per batch size, recent wait times in seconds,
+        # number of rejected images
+        self.batch_size_counts = collections.Counter()
+        self.wait_times = collections.deque(maxlen=history_size)
+        self.rejected = 0
+
+    def start(self):
+        """
+        Start the background task that runs the batches. Call from a running event loop.
+        """
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._batch_slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop the background task. Batches already running are finished, images still
+        in the queue are not processed: their requests fail with QueueFullError.
+        """
+        self._stopped = True
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+
+        # Let the running forward passes finish and answer their requests
+        if self._batch_tasks:
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+
+        # Fail the waiting requests instead of leaving them hanging
+        queued = []
+        while not self._queue.empty():
+            queued.append(self._queue.get_nowait())
+        self._fail_stopped(queued)
+
+    async def submit(self, img_array):
+        """
+        Queue an image for prediction and wait for its result.
+
+        :param img_array: Numpy array with one preprocessed image, batch dimension first
+        :return: Result returned by predict_fn for the image
+        """
+        if self._stopped:
+            raise QueueFullError("Batching queue stopped")
+
+        future = asyncio.get_running_loop().create_future()
+
+        # Apply backpressure: reject instead of queueing without limit
+        try:
+            self._queue.put_nowait((img_array, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFullError("Batching queue is full")
+
+        return await future
+
+    def metrics(self):
+        """
+        Report queue depth, batch size histogram and wait times for tuning the batch
+        size and latency window.
+
+        :return: Dictionary with the metrics
+        """
+        # Wait times in milliseconds
+        wait_times = np.array(self.wait_times) * 1000
+
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "batches_running": len(self._batch_tasks),
+            "batches": sum(self.batch_size_counts.values()),
+            "rejected": self.rejected,
+            "batch_size_histogram": {str(size): count for size, count
+                                     in sorted(self.batch_size_counts.items())},
+            "wait_time_ms": {
+                "mean": float(wait_times.mean()) if wait_times.size else 0.0,
+                "p50": float(np.percentile(wait_times, 50)) if wait_times.size else 0.0,
+                "p99": float(np.percentile(wait_times, 99)) if wait_times.size else 0.0,
+                "max": float(wait_times.max()) if wait_times.size else 0.0,
+            },
+        }
+
+    async def _collect_batch(self):
+        """
+        Wait for the first image, then collect more until the batch is full or the
+        latency window of the first image closes.
+
+        :return: List of (image, future, enqueue time) tuples
+        """
+        loop = asyncio.get_running_loop()
+
+        # Block until there is something to do
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_latency
+
+        try:
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                # Window closed: only take images that are already waiting
+                if timeout <= 0:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                        continue
+                    except asyncio.QueueEmpty:
+                        break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Stopped while collecting: the images are out of the queue already
+            self._fail_stopped(batch)
+            raise
+
+        return batch
+
+    async def _process_batch(self, batch):
+        """
+        Run one forward pass for the batch in the executor and fan the results out to
+        the requests.
+
+        :param batch: List of (image, future, enqueue time) tuples
+        """
+        # Record metrics
+        start = time.perf_counter()
+        self.wait_times.extend(start - enqueued for _, _, enqueued in batch)
+        self.batch_size_counts[len(batch)] += 1
+
+        # Join the images along the batch dimension
+        img_batch = np.concatenate([img_array for img_array, _, _ in batch])
+
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.predict_fn, img_batch)
+        except Exception as e:
+            # Fail every request of the batch, not just the first one
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # The future is already done, if the client disconnected while waiting
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _run(self):
+        """
+        Collect and process batches until the task is cancelled.
+        """
+        while True:
+            # Wait for a free forward pass slot before collecting the next batch. While
+            # all slots are busy, images pile up in the queue and the batches grow.
+            await self._batch_slots.acquire()
+            batch = await self._collect_batch()
+
+            task = asyncio.create_task(self._process_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._finish_batch)
+
+    @staticmethod
+    def _fail_stopped(batch):
+        """
+        Fail the requests of images that will not be processed, because the queue was
+        stopped.
+
+        :param batch: List of (image, future, enqueue time) tuples
+        """
+        for _, future, _ in batch:
+            if not future.done():
+                future.set_exception(QueueFullError("Batching queue stopped"))
+
+    def _finish_batch(self, task):
+        """
+        Free the forward pass slot of a finished batch.
+
+        :param task: Finished batch task
+        """
+        self._batch_tasks.discard(task)
+        self._batch_slots.release()
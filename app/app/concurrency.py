@@ -0,0 +1,86 @@
+## Bounded thread pools for running blocking work (image decoding, inference) off the
+# asyncio event loop. When a pool is full, new work is rejected instead of queued
+# without limit, so the API can answer with 503 and the worker stays responsive.
+
+## Imports
+import asyncio
+import concurrent.futures
+import functools
+
+
+## Exceptions
+
+class QueueFullError(Exception):
+    """
+    Raised when work is submitted to a queue that is already full.
+    """
+
+
+## Classes
+
+class BoundedExecutor:
+    """
+    Thread pool with a limit on the number of pending (running + queued) tasks.
+    """
+
+    def __init__(self, max_workers, max_queue_size, thread_name_prefix=""):
+        """
+        :param max_workers: Number of worker threads
+        :param max_queue_size: Number of tasks allowed to wait for a free worker
+        :param thread_name_prefix: Prefix for the worker thread names
+        """
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.max_workers = max_workers
+        self.max_pending = max_workers + max_queue_size
+
+        # Metrics. Only touched from the event loop thread, so no lock is needed.
+        self.pending = 0
+        self.rejected = 0
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run a blocking function in the thread pool and wait for its result.
+
+        :param fn: Function to run
+        :param args: Positional arguments for fn
+        :param kwargs: Keyword arguments for fn
+        :return: Return value of fn
+        """
+        # Apply backpressure: reject instead of queueing without limit
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise QueueFullError("Executor queue is full")
+
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(functools.partial(fn, *args, **kwargs))
+
+        # Counted until the thread is done, not until the caller stops waiting: a
+        # cancelled request leaves its task running in the pool
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._task_done))
+
+        return await asyncio.wrap_future(future)
+
+    def _task_done(self):
+        """
+        Count a finished task. Runs in the event loop thread.
+        """
+        self.pending -= 1
+
+    def metrics(self):
+        """
+        Report the pool size, pending tasks and rejected tasks.
+
+        :return: Dictionary with the metrics
+        """
+        return {"workers": self.max_workers,
+                "pending": self.pending,
+                "rejected": self.rejected}
+
+    def shutdown(self):
+        """
+        Shut the thread pool down, wait for running tasks to finish.
+        """
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,412 @@
+## Shared inference process. One process holds the model and its TensorFlow thread
+# pools, and every HTTP worker sends its batches to it over a local socket, instead of
+# each worker loading its own copy. Images are passed through shared memory: a worker
+# writes its batch into a shared memory block and only sends the batch size over the
+# socket, the results (top k scores and indices) are small and sent back directly.
+#
+# Started (and restarted if it exits) before the HTTP workers by prestart.sh when
+# INFERENCE_MODE=shared, or by hand: python inference_server.py
+
+## Imports
+import hashlib
+import multiprocessing.connection
+import os
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import settings
+from model_funcs import configure_threads, load_serving_function, \
+    model_needs_tensorflow, warmup_serving_function
+
+
+## Exceptions
+
+class InferenceServerUnavailableError(ConnectionError):
+    """
+    Raised when the shared inference process cannot be reached.
+    """
+
+
+## Functions
+
+def make_private_directory(path_dir):
+    """
+    Create the directory of the socket, accessible to the current user only. Refuses
+    a directory that belongs to another user, e.g. one created in /tmp by someone else.
+
+    :param path_dir: Path to the directory
+    :raises PermissionError: If the directory belongs to another user
+    """
+    os.makedirs(path_dir, mode=0o700, exist_ok=True)
+    if os.stat(path_dir).st_uid != os.getuid():
+        raise PermissionError(f"{path_dir} belongs to another user.")
+    os.chmod(path_dir, 0o700)
+
+
+def model_identity(path_model):
+    """
+    Identify the model file by the size and modification time of its files, so the
+    workers notice when the inference process was restarted with a different model.
+
+    :param path_model: Path to a .keras file, a SavedModel directory or a .tflite file
+    :return: Hex digest
+    """
+    if os.path.isdir(path_model):
+        paths = sorted(os.path.join(root, filename)
+                       for root, _, filenames in os.walk(path_model)
+                       for filename in filenames)
+    else:
+        paths = [path_model]
+
+    digest = hashlib.blake2b(digest_size=8)
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.relpath(path, path_model)}:{stat.st_size}:"
+                      f"{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+def attach_shared_memory(name):
+    """
+    Attach to a shared memory block created by a client.
+
+    :param name: Name of the block
+    :return: SharedMemory instance
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    # The client owns the block: stop the resource tracker from unlinking it when this
+    # process exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def predict_shared_batch(serving_function, shm, batch_size, image_size):
+    """
+    Run the serving function on a batch in shared memory.
+
+    :param serving_function: Function from model_funcs.load_serving_function()
+    :param shm: Shared memory block with the batch
+    :param batch_size: Number of images in the block
+    :param image_size: Model input size (height, width)
+    :return: Dictionary with the top k "scores" and "indices" as numpy arrays
+    """
+    # A view, no copy. Dropped on return, so the block can be closed later.
+    images = np.ndarray((batch_size,) + tuple(image_size) + (3,), dtype=np.float32,
+                        buffer=shm.buf)
+    prediction = serving_function(images)
+
+    return {"scores": np.asarray(prediction["scores"]),
+            "indices": np.asarray(prediction["indices"])}
+
+
+def handle_client(connection, serving_function, slots, image_size, model_id):
+    """
+    Serve the requests of one client (one inference thread of an HTTP worker) until it
+    disconnects. Requests are ("attach", shared memory name), ("predict", batch size)
+    and ("ping", None), replies are ("ok", result) or ("error", message). Attach and
+    ping answer with the model identity.
+
+    :param connection: Connection to the client
+    :param serving_function: Function from model_funcs.load_serving_function()
+    :param slots: Semaphore that limits the forward passes running at the same time
+    :param image_size: Model input size (height, width)
+    :param model_id: Identity of the loaded model, see model_identity()
+    """
+    shm = None
+    try:
+        while True:
+            try:
+                request, argument = connection.recv()
+            except EOFError:
+                break
+
+            try:
+                if request == "attach":
+                    shm = attach_shared_memory(argument)
+                    connection.send(("ok", model_id))
+                elif request == "ping":
+                    connection.send(("ok", model_id))
+                else:
+                    with slots:
+                        result = predict_shared_batch(serving_function, shm, argument,
+                                                      image_size)
+                    connection.send(("ok", result))
+            except Exception as e:
+                connection.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        connection.close()
+        if shm is not None:
+            shm.close()
+
+
+def serve(address, authkey, path_model, image_size=(224, 224), top_k=3):
+    """
+    Load the model once and serve clients until the process is stopped. Every client
+    connection is served in its own thread, the forward passes are limited to
+    settings.INFERENCE_WORKERS at a time.
+
+    :param address: Path of the Unix socket. Its directory is made private to the
+        current user.
+    :param authkey: Shared secret of the server and the clients (bytes)
+    :param path_model: Path to a .keras file, a SavedModel directory or a .tflite file
+    :param image_size: Model input size (height, width)
+    :param top_k: Number of results to return
+    """
+    start = time.perf_counter()
+
+    # Before loading, a model replaced during the load gets a new identity next time
+    model_id = model_identity(path_model)
+
+    # Thread pools are set before TensorFlow runs anything
+    if model_needs_tensorflow(path_model):
+        configure_threads(settings.TF_INTRA_OP_THREADS, settings.TF_INTER_OP_THREADS)
+
+    serving_function = load_serving_function(
+        path_model, image_size=image_size, top_k=top_k,
+        num_threads=settings.TF_INTRA_OP_THREADS or None)
+    warmup_serving_function(serving_function, range(1, settings.MAX_BATCH_SIZE + 1),
+                            image_size=image_size)
+
+    slots = threading.Semaphore(settings.INFERENCE_WORKERS)
+
+    # Only the current user may reach the socket, the authkey guards the connections
+    make_private_directory(os.path.dirname(os.path.abspath(address)))
+
+    # Socket left behind by a server that did not shut down cleanly
+    if os.path.exists(address):
+        os.unlink(address)
+
+    with multiprocessing.connection.Listener(address, family="AF_UNIX",
+                                             authkey=authkey) as listener:
+        print(f"Inference server ready on {address}, model {model_id} "
+              f"({time.perf_counter() - start:.1f} s)", flush=True)
+        while True:
+            connection = listener.accept()
+            threading.Thread(target=handle_client, daemon=True,
+                             args=(connection, serving_function, slots,
+                                   image_size, model_id)).start()
+
+
+## Classes
+
+class RemoteServingFunction:
+    """
+    Serving function that runs the batches in the shared inference process. Each
+    calling thread gets its own connection and shared memory block, so the inference
+    threads of a worker do not wait for each other. If the inference process dies (and
+    is restarted by prestart.sh), the threads reconnect on their next batch.
+    """
+
+    def __init__(self, address, authkey, max_batch_size, image_size=(224, 224),
+                 connect_timeout_s=300.0, reconnect_timeout_s=5.0):
+        """
+        :param address: Path of the Unix socket of the server
+        :param authkey: Shared secret of the server and the clients (bytes)
+        :param max_batch_size: Largest batch sent to the server at once
+        :param image_size: Model input size (height, width)
+        :param connect_timeout_s: Seconds to wait for the server to come up at startup
+        :param reconnect_timeout_s: Seconds a batch waits for a lost server to come
+            back
+        """
+        self.address = address
+        self.authkey = authkey
+        self.max_batch_size = max_batch_size
+        self.image_size = tuple(image_size)
+        self.connect_timeout_s = connect_timeout_s
+        self.reconnect_timeout_s = reconnect_timeout_s
+
+        # False after a connection to the server was lost, until it answers again
+        self.connected = False
+
+        # Identity of the model in the server, see model_identity(). Changes when the
+        # server was restarted with a different model.
+        self.model_id = None
+
+        self._local = threading.local()
+        # Every (connection, shared memory) pair, for closing them
+        self._clients = []
+        self._lock = threading.Lock()
+
+    def _open_connection(self, timeout_s):
+        """
+        Open a connection to the server, waiting until the server is up.
+
+        :param timeout_s: Seconds to wait for the server
+        :return: Connection
+        :raises InferenceServerUnavailableError: If the server does not come up in time
+        """
+        deadline = time.monotonic() + timeout_s
+        while True:
+            try:
+                return multiprocessing.connection.Client(
+                    self.address, family="AF_UNIX", authkey=self.authkey)
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                if time.monotonic() > deadline:
+                    self.connected = False
+                    raise InferenceServerUnavailableError(
+                        f"Inference server not reachable on {self.address}") from e
+                time.sleep(0.5)
+
+    def connect(self, timeout_s=None):
+        """
+        Connect the calling thread to the server, waiting until the server is up.
+
+        :param timeout_s: Seconds to wait for the server. None uses connect_timeout_s,
+            the server may still be loading the model.
+        :return: Tuple (connection, shared memory block) of the calling thread
+        """
+        if hasattr(self._local, "client"):
+            return self._local.client
+
+        connection = self._open_connection(
+            self.connect_timeout_s if timeout_s is None else timeout_s)
+
+        # One block holds the largest batch
+        shm = shared_memory.SharedMemory(
+            create=True,
+            size=self.max_batch_size * int(np.prod(self.image_size)) * 3 * 4)
+        try:
+            connection.send(("attach", shm.name))
+            self.model_id = self._check_reply(connection.recv())
+        except BaseException:
+            self._close_client(connection, shm)
+            raise
+
+        self._local.client = (connection, shm)
+        with self._lock:
+            self._clients.append(self._local.client)
+        self.connected = True
+
+        return self._local.client
+
+    def _disconnect(self):
+        """
+        Drop the connection and the shared memory block of the calling thread after
+        the server was lost.
+        """
+        client = getattr(self._local, "client", None)
+        if client is None:
+            return
+        del self._local.client
+
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+        self.connected = False
+        self._close_client(*client)
+
+    def _predict(self, images):
+        """
+        Predict a batch over the connection of the calling thread.
+
+        :param images: Float32 image batch
+        :return: Dictionary with the top k "scores" and "indices"
+        """
+        connection, shm = self.connect(timeout_s=self.reconnect_timeout_s)
+
+        # Batches larger than the block are sent in parts
+        results = []
+        for j in range(0, len(images), self.max_batch_size):
+            part = images[j:j + self.max_batch_size]
+            np.ndarray(part.shape, dtype=np.float32, buffer=shm.buf)[:] = part
+            connection.send(("predict", len(part)))
+            results.append(self._check_reply(connection.recv()))
+
+        return {key: np.concatenate([result[key] for result in results])
+                for key in ("scores", "indices")}
+
+    def __call__(self, images):
+        """
+        Predict a batch in the inference process. A lost connection is opened again
+        once, e.g. after the inference process was restarted.
+
+        :param images: Float32 image batch
+        :return: Dictionary with the top k "scores" and "indices"
+        :raises InferenceServerUnavailableError: If the server cannot be reached
+        """
+        images = np.asarray(images, dtype=np.float32)
+
+        try:
+            return self._predict(images)
+        except InferenceServerUnavailableError:
+            raise
+        except (EOFError, OSError):
+            self._disconnect()
+
+        try:
+            return self._predict(images)
+        except InferenceServerUnavailableError:
+            raise
+        except (EOFError, OSError) as e:
+            self._disconnect()
+            raise InferenceServerUnavailableError(
+                f"Lost the connection to the inference server: {e!r}") from e
+
+    def ping(self, timeout_s=1.0):
+        """
+        Check that the server answers, on a connection of its own. Updates connected
+        and model_id.
+
+        :param timeout_s: Seconds to wait for the answer
+        :return: True if the server answered
+        """
+        try:
+            with multiprocessing.connection.Client(
+                    self.address, family="AF_UNIX", authkey=self.authkey) as connection:
+                connection.send(("ping", None))
+                self.connected = False
+                if connection.poll(timeout_s):
+                    status, model_id = connection.recv()
+                    if status == "ok":
+                        self.model_id = model_id
+                        self.connected = True
+        except (EOFError, OSError):
+            self.connected = False
+
+        return self.connected
+
+    @staticmethod
+    def _check_reply(reply):
+        """
+        Unpack a reply of the server.
+
+        :param reply: Tuple ("ok", result) or ("error", message)
+        :return: Result
+        :raises RuntimeError: If the server reported an error
+        """
+        status, payload = reply
+        if status != "ok":
+            raise RuntimeError(f"Inference server error: {payload}")
+        return payload
+
+    @staticmethod
+    def _close_client(connection, shm):
+        """
+        Close a connection and free its shared memory block.
+
+        :param connection: Connection to the server
+        :param shm: Shared memory block of the connection
+        """
+        connection.close()
+        shm.close()
+        shm.unlink()
+
+    def close(self):
+        """
+        Close the connections and free the shared memory blocks.
+        """
+        with self._lock:
+            for connection, shm in self._clients:
+                self._close_client(connection, shm)
+            self._clients = []
+        self.connected = False
+
+
+## Run the inference server
+if __name__ == "__main__":
+    serve(settings.INFERENCE_SERVER_ADDRESS,
+          settings.INFERENCE_SERVER_AUTHKEY.encode(),
+          settings.MODEL_PATH, image_size=(224, 224), top_k=settings.TOP_K)
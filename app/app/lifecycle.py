@@ -0,0 +1,145 @@
+## Startup lifecycle of the model: import, load and warmup run in a background thread
+# after the worker has started, so the worker answers liveness checks right away and
+# reports ready once the model has served its first (dummy) batches. The time spent
+# in each phase is recorded for the metrics.
+
+## Imports
+import importlib
+import threading
+import time
+
+from model_funcs import configure_threads, load_serving_function, \
+    model_needs_tensorflow, warmup_serving_function
+
+
+## Classes
+
+class ModelState:
+    """
+    Holds the serving function and the startup status: "starting", "importing",
+    "loading", "warming_up", "ready" or "failed".
+    """
+
+    def __init__(self, path_model, image_size=(224, 224), top_k=3,
+                 warmup_batch_sizes=(1,), intra_op_threads=0, inter_op_threads=0,
+                 load_fn=None):
+        """
+        :param path_model: Path to a .keras file, a SavedModel directory or a .tflite
+            file, see model_funcs.load_serving_function()
+        :param image_size: Model input size (height, width)
+        :param top_k: Number of results to return
+        :param warmup_batch_sizes: Batch sizes run through the model before it is
+            reported ready. Empty skips the warmup.
+        :param intra_op_threads: TensorFlow threads inside one operation (0: default),
+            see model_funcs.configure_threads()
+        :param inter_op_threads: TensorFlow operations run in parallel (0: default)
+        :param load_fn: Function that returns the serving function, e.g. a client of
+            the shared inference process. None loads the model from path_model.
+        """
+        self.path_model = path_model
+        self.image_size = image_size
+        self.top_k = top_k
+        self.warmup_batch_sizes = tuple(warmup_batch_sizes)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.load_fn = load_fn
+
+        self.serving_function = None
+        self.status = "starting"
+        self.error = None
+
+        # Seconds spent in each startup phase
+        self.timings = {}
+        self._ready = threading.Event()
+
+    @property
+    def ready(self):
+        """
+        True once the model is loaded and warmed up.
+        """
+        return self._ready.is_set()
+
+    def load(self):
+        """
+        Import TensorFlow (if needed), load the model and warm it up. Blocks, run it in
+        a background thread.
+        """
+        try:
+            # Import separately, so its time is not mixed up with loading the model
+            needs_tensorflow = (self.load_fn is None
+                                and model_needs_tensorflow(self.path_model))
+            if needs_tensorflow:
+                self.status = "importing"
+                start = time.perf_counter()
+                importlib.import_module("tensorflow")
+                # Thread pools are set before TensorFlow runs anything
+                configure_threads(self.intra_op_threads, self.inter_op_threads)
+                self.timings["import_s"] = time.perf_counter() - start
+
+            self.status = "loading"
+            start = time.perf_counter()
+            if self.load_fn is not None:
+                serving_function = self.load_fn()
+            else:
+                serving_function = load_serving_function(
+                    self.path_model, image_size=self.image_size, top_k=self.top_k,
+                    num_threads=self.intra_op_threads or None)
+            self.timings["load_s"] = time.perf_counter() - start
+
+            # The first call traces the graph and allocates the buffers
+            self.status = "warming_up"
+            if self.warmup_batch_sizes:
+                start = time.perf_counter()
+                warmup_serving_function(serving_function, self.warmup_batch_sizes[:1],
+                                        image_size=self.image_size)
+                self.timings["first_inference_s"] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                warmup_serving_function(serving_function, self.warmup_batch_sizes[1:],
+                                        image_size=self.image_size)
+                self.timings["warmup_s"] = time.perf_counter() - start
+
+            self.serving_function = serving_function
+            self.status = "ready"
+            self._ready.set()
+
+        except Exception as e:
+            self.status = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+            raise
+
+    def start(self):
+        """
+        Start loading the model in a background thread.
+
+        :return: The thread
+        """
+        thread = threading.Thread(target=self.load, name="model-loader", daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        """
+        Release the serving function, e.g. the connections to the inference process.
+        """
+        if hasattr(self.serving_function, "close"):
+            self.serving_function.close()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the model is ready.
+
+        :param timeout: Seconds to wait. None waits forever.
+        :return: True if the model is ready
+        """
+        return self._ready.wait(timeout)
+
+    def metrics(self):
+        """
+        Report the startup status and the time spent in each phase.
+
+        :return: Dictionary with the metrics
+        """
+        return {"status": self.status,
+                "error": self.error,
+                "timings_s": dict(self.timings)}
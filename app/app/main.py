@@ -2,27 +2,137 @@
 # Docker container.
 
 ## Imports
+import asyncio
+import concurrent.futures
+import json
 import pathlib
+from typing import List
 
-import tensorflow as tf
 import uvicorn
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import UnidentifiedImageError
 
-from prediction_funcs import load_classes, read_image, create_prediction
+import settings
+from batching import BatchingQueue
+from concurrency import BoundedExecutor, QueueFullError
+from inference_server import InferenceServerUnavailableError, RemoteServingFunction
+from lifecycle import ModelState
+from prediction_funcs import load_classes, read_image, create_batch_prediction, \
+    is_archive, read_archive_images, TooManyImagesError
+from result_cache import ResultCache, hash_image_bytes, perceptual_hash
+from uploads import BodySizeLimitMiddleware, UploadRejectedError, UploadValidator
 
 ## Define paths
-path_model = pathlib.Path("../model/mushi_identifier_v1.keras")
+path_model = pathlib.Path(settings.MODEL_PATH)
 path_classes = pathlib.Path("../model/classes_mushi_identifier_v1.csv")
 
-## Import model and mushroom classes
-model = tf.keras.models.load_model(path_model)
+## Import mushroom classes and prepare the model
+# The serving function is traced once with a fixed input signature and returns the top
+# k confidences and class indices. It is loaded at startup (in the background by
+# default) and warmed up with every batch size the batching queue can produce.
 classes = load_classes(path_classes)
 
+if settings.INFERENCE_MODE == "shared":
+    # The inference process loads and warms up the model, the workers only connect
+    remote_serving_function = RemoteServingFunction(
+        settings.INFERENCE_SERVER_ADDRESS, settings.INFERENCE_SERVER_AUTHKEY.encode(),
+        max_batch_size=settings.MAX_BATCH_SIZE, image_size=(224, 224))
+
+    def connect_inference_server():
+        """
+        Wait for the inference process to come up.
+
+        :return: Serving function that runs in the inference process
+        """
+        remote_serving_function.connect()
+        return remote_serving_function
+
+    model_state = ModelState(
+        path_model, image_size=(224, 224), top_k=settings.TOP_K,
+        warmup_batch_sizes=(1,) if settings.WARMUP else (),
+        load_fn=connect_inference_server)
+else:
+    model_state = ModelState(
+        path_model, image_size=(224, 224), top_k=settings.TOP_K,
+        warmup_batch_sizes=(range(1, settings.MAX_BATCH_SIZE + 1) if settings.WARMUP
+                            else ()),
+        intra_op_threads=settings.TF_INTRA_OP_THREADS,
+        inter_op_threads=settings.TF_INTER_OP_THREADS)
+
+if not settings.LOAD_MODEL_IN_BACKGROUND:
+    model_state.load()
+
+
+def predict_batch(img_batch):
+    """
+    Predict a batch with the loaded serving function. Runs in the inference threads.
+
+    :param img_batch: Numpy array with resized and preprocessed images, batch first
+    :return: List with a dictionary of top k class names and confidences per image
+    """
+    return create_batch_prediction(model_state.serving_function, img_batch, classes)
+
+
+## Create thread pools and batching queue
+# Decoding and inference block, so they run in thread pools to keep the event loop free
+decode_executor = BoundedExecutor(settings.DECODE_WORKERS, settings.MAX_QUEUE_SIZE,
+                                  thread_name_prefix="decode")
+inference_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.INFERENCE_WORKERS, thread_name_prefix="inference")
+
+# Concurrent requests are run through the model together in a single forward pass
+batching_queue = BatchingQueue(
+    predict_batch,
+    executor=inference_executor,
+    max_batch_size=settings.MAX_BATCH_SIZE,
+    max_latency_ms=settings.MAX_BATCH_LATENCY_MS,
+    max_concurrent_batches=settings.INFERENCE_WORKERS,
+    max_queue_size=settings.MAX_QUEUE_SIZE
+)
+
+## Create result cache
+# Repeated uploads of the same photo are answered without decoding or inference
+result_cache = ResultCache(max_entries=settings.RESULT_CACHE_SIZE,
+                           max_bytes=int(settings.RESULT_CACHE_MAX_MB * 1024 * 1024),
+                           ttl_s=settings.RESULT_CACHE_TTL_S)
+
+## Create upload limits
+# Megabytes to bytes
+MB = 1024 * 1024
+
+upload_validator = UploadValidator(
+    max_upload_bytes=int(settings.MAX_UPLOAD_MB * MB),
+    max_pixels=int(settings.MAX_IMAGE_MEGAPIXELS * 1e6))
+
 ## Create API
 
 # Initialize the API by creating a FastAPI instance
 app = FastAPI()
 
+# Cut off request bodies beyond the limits before they are buffered. The multipart
+# framing adds a little on top of the file.
+app.add_middleware(BodySizeLimitMiddleware,
+                   limits={"/predict": int(settings.MAX_UPLOAD_MB * MB) + 64 * 1024,
+                           "/predict/batch": int(settings.MAX_BATCH_UPLOAD_MB * MB)},
+                   validator=upload_validator)
+
+
+# Start and stop the batching queue together with the API
+@app.on_event("startup")
+async def start_batching_queue():
+    batching_queue.start()
+    if settings.LOAD_MODEL_IN_BACKGROUND:
+        model_state.start()
+
+
+@app.on_event("shutdown")
+async def stop_batching_queue():
+    await batching_queue.stop()
+    decode_executor.shutdown()
+    inference_executor.shutdown()
+    model_state.close()
+
 
 # Create a simple index
 @app.get("/")
@@ -30,26 +140,221 @@ async def index():
     return {"message": "This is the mushroom classification API!"}
 
 
+# Liveness: the worker is up and the event loop responds. A worker whose model failed
+# to load never becomes ready, so it reports 503 to be restarted.
+@app.get("/health/live")
+async def liveness():
+    if model_state.status == "failed":
+        return JSONResponse(status_code=503, content=model_state.metrics())
+    return {"status": "alive"}
+
+
+# Readiness: the model is loaded and warmed up, route traffic here. In shared mode the
+# inference process must also answer, it may have died (and be restarting) since.
+@app.get("/health/ready")
+async def readiness():
+    if not model_state.ready:
+        return JSONResponse(status_code=503, content=model_state.metrics())
+    if settings.INFERENCE_MODE == "shared":
+        connected = await asyncio.get_running_loop().run_in_executor(
+            None, remote_serving_function.ping)
+        if not connected:
+            return JSONResponse(status_code=503,
+                                content={**model_state.metrics(),
+                                         "inference_server": "disconnected"})
+    return model_state.metrics()
+
+
+def current_model_id():
+    """
+    Identity of the model that answers the predictions. Fixed in local mode, the model
+    is only loaded at startup. In shared mode, as last reported by the inference
+    process.
+
+    :return: Model identity
+    """
+    if settings.INFERENCE_MODE == "shared":
+        return remote_serving_function.model_id
+    return str(path_model)
+
+
+def check_model_ready():
+    """
+    Answer with 503 while the model is still loading.
+
+    :raises HTTPException: If the model is not ready
+    """
+    if not model_state.ready:
+        raise HTTPException(503, detail=f"Model not ready ({model_state.status}). "
+                                        f"Please try again later.",
+                            headers={"Retry-After": "5"})
+
+
+# Report batching metrics for tuning throughput against latency
+@app.get("/metrics")
+async def metrics():
+    return {"batching": batching_queue.metrics(),
+            "decode": decode_executor.metrics(),
+            "result_cache": result_cache.metrics(),
+            "uploads": upload_validator.metrics(),
+            "startup": model_state.metrics()}
+
+
+async def predict_image_bytes(img_bytes):
+    """
+    Predict the class of one image: look the result up in the cache, otherwise decode
+    the image and run it through the batching queue.
+
+    :param img_bytes: Image as byte data
+    :return: Dictionary with top k predictions
+    :raises UploadRejectedError: If the image has an unsupported format, too many
+        pixels or cannot be decoded
+    :raises QueueFullError: If the decode pool or the batching queue is full
+    """
+    # Check the real format and the pixel dimensions from the header
+    upload_validator.check_image(img_bytes)
+
+    # Results of another model are stale, e.g. after the inference process was
+    # restarted with a new MODEL_PATH
+    model_id = current_model_id()
+    result_cache.set_model(model_id)
+
+    # Same bytes as an earlier upload
+    cache_keys = [hash_image_bytes(img_bytes)]
+    predictions_top_k = result_cache.get(cache_keys[0])
+    if predictions_top_k is not None:
+        return predictions_top_k
+
+    # Read the image to numpy array. Target size matches model input size.
+    try:
+        img_array = await decode_executor.run(read_image, img_bytes,
+                                              target_size=(224, 224),
+                                              resize_backend=settings.RESIZE_BACKEND,
+                                              draft=settings.JPEG_DRAFT)
+    except (UnidentifiedImageError, OSError, ValueError) as e:
+        # Valid header, but the pixel data is broken, e.g. a truncated file
+        upload_validator.reject(400, f"Could not read image: {type(e).__name__}.",
+                                "decode_failed")
+
+    # Same picture as an earlier upload, e.g. re-encoded
+    if settings.PERCEPTUAL_CACHE:
+        cache_keys.append(perceptual_hash(img_array))
+        predictions_top_k = result_cache.get(cache_keys[1])
+        if predictions_top_k is not None:
+            result_cache.put(cache_keys[:1], predictions_top_k)
+            return predictions_top_k
+
+    # Create a dictionary with top k predictions. The image is batched together with
+    # other concurrent images.
+    predictions_top_k = await batching_queue.submit(img_array)
+
+    # Not cached if the model changed while the image was predicted
+    if current_model_id() == model_id:
+        result_cache.put(cache_keys, predictions_top_k)
+
+    return predictions_top_k
+
+
 # Predict class of user-submitted image
 @app.post("/predict")
 async def predict_image_class(img_file: UploadFile = File(...)):
-    # Support jpeg and png images
-    if img_file.content_type not in ["image/jpeg", "image/png"]:
-        raise HTTPException(400,
-                            detail="Invalid image type. Please submit a .jpeg or .png image.")
+    check_model_ready()
 
-    # Read image to bytes
-    img_bytes = await img_file.read()
+    try:
+        # Read image to bytes, in chunks up to the size limit. The format is checked
+        # from the magic bytes (jpeg and png are supported), not the declared type.
+        img_bytes = await upload_validator.read(img_file)
 
-    # Read the image to numpy array. Target size matches model input size.
-    img_array = read_image(img_bytes, target_size=(224, 224))
+        predictions_top_k = await predict_image_bytes(img_bytes)
+
+    except UploadRejectedError as e:
+        raise HTTPException(e.status_code, detail=e.detail)
+
+    # Too much work queued already: ask the client to come back later
+    except QueueFullError:
+        raise HTTPException(503, detail="Server is busy. Please try again later.",
+                            headers={"Retry-After": "1"})
 
-    # Create a dictionary with top k predictions
-    predictions_top_k = create_prediction(model, img_array, classes, top_k=3)
+    # The shared inference process is down or restarting
+    except InferenceServerUnavailableError:
+        raise HTTPException(503, detail="Model not available. Please try again later.",
+                            headers={"Retry-After": "5"})
 
     return predictions_top_k
 
 
+# Predict classes of several images in one request. Accepts images and zip/tar
+# archives of images, streams one JSON line per image as soon as it is predicted.
+@app.post("/predict/batch")
+async def predict_image_classes(img_files: List[UploadFile] = File(...)):
+    check_model_ready()
+
+    images = []
+    for img_file in img_files:
+        archive = is_archive(img_file.filename, img_file.content_type)
+
+        # Archives may be as large as the whole request, images as one upload
+        try:
+            upload_bytes = await upload_validator.read(
+                img_file,
+                int(settings.MAX_BATCH_UPLOAD_MB * MB) if archive else None)
+        except UploadRejectedError as e:
+            raise HTTPException(e.status_code, detail=e.detail)
+
+        if archive:
+            try:
+                images += await decode_executor.run(
+                    read_archive_images, upload_bytes,
+                    settings.MAX_IMAGES_PER_REQUEST - len(images),
+                    upload_validator.max_upload_bytes)
+            except TooManyImagesError as e:
+                raise HTTPException(413, detail=str(e))
+            except ValueError as e:
+                raise HTTPException(400, detail=str(e))
+            except QueueFullError:
+                raise HTTPException(503, detail="Server is busy. Please try again "
+                                                "later.", headers={"Retry-After": "1"})
+        else:
+            # The format is checked per image when it is predicted
+            images.append((img_file.filename, upload_bytes))
+
+        # Protect memory: limit the images per request
+        if len(images) > settings.MAX_IMAGES_PER_REQUEST:
+            raise HTTPException(413, detail=f"Too many images, at most "
+                                            f"{settings.MAX_IMAGES_PER_REQUEST} are "
+                                            f"accepted.")
+
+    async def predict_one(index, filename, img_bytes):
+        try:
+            predictions_top_k = await predict_image_bytes(img_bytes)
+            return {"index": index, "filename": filename,
+                    "predictions": predictions_top_k}
+        except UploadRejectedError as e:
+            return {"index": index, "filename": filename, "error": e.detail}
+        except QueueFullError:
+            return {"index": index, "filename": filename,
+                    "error": "Server is busy. Please try again later."}
+        except InferenceServerUnavailableError:
+            return {"index": index, "filename": filename,
+                    "error": "Model not available. Please try again later."}
+
+    async def stream_results():
+        # All images are decoded in parallel and batched together in the batching
+        # queue. The tasks are created when the response starts streaming, so nothing
+        # runs for clients that disconnect before.
+        tasks = [asyncio.create_task(predict_one(index, filename, img_bytes))
+                 for index, (filename, img_bytes) in enumerate(images)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task) + "\n"
+        finally:
+            # Client disconnected: do not predict the remaining images
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
 # Run API on (Docker) port 8000, when called with "python main.py"
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,162 @@
+## Functions for loading the model and building the compiled serving function used in
+# main.py
+#
+# TensorFlow is imported inside the functions that need it. A TensorFlow Lite model
+# runs on the much lighter tflite-runtime package if it is installed, so the API can
+# start without importing TensorFlow at all.
+
+## Imports
+import pathlib
+import threading
+
+import numpy as np
+
+
+## Functions
+
+def model_needs_tensorflow(path_model):
+    """
+    Check if loading a model imports TensorFlow.
+
+    :param path_model: Path to a .keras file, a SavedModel directory or a .tflite file
+    :return: False for TensorFlow Lite models with tflite-runtime installed
+    """
+    if pathlib.Path(path_model).suffix != ".tflite":
+        return True
+
+    try:
+        import tflite_runtime.interpreter  # noqa: F401
+        return False
+    except ImportError:
+        return True
+
+
+def configure_threads(intra_op_threads=0, inter_op_threads=0):
+    """
+    Set the TensorFlow thread pool sizes. Must be called before TensorFlow runs its
+    first operation. 0 keeps the TensorFlow default (one thread per core).
+
+    :param intra_op_threads: Threads used inside one operation, e.g. a convolution
+    :param inter_op_threads: Operations run in parallel
+    """
+    import tensorflow as tf
+
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def build_serving_function(model, image_size=(224, 224), top_k=3, include_logits=False):
+    """
+    Trace the model into a compiled function with a fixed input signature. Calling it
+    skips the data adapter and predict loop that model.predict() builds on every call.
+    Softmax and top k are fused into the traced graph, so no post-processing over all
+    classes is left to Python. Also used for exporting models (src/model/export_funcs.py
+    and quantize_funcs.py), so exported and served models compute the same outputs.
+
+    :param model: Mushi-identifier model that outputs logits
+    :param image_size: Model input size (height, width)
+    :param top_k: Number of results to return, ranked by highest confidence score
+    :param include_logits: Also return the raw "logits" for all classes, e.g. for
+        evaluating an exported model
+    :return: tf.function that maps a float32 image batch to a dictionary with the top k
+        "scores" (softmax confidences) and "indices" (class indices)
+    """
+    import tensorflow as tf
+
+    # Batch dimension is left open, so a single trace serves every batch size
+    input_spec = tf.TensorSpec(shape=(None,) + tuple(image_size) + (3,),
+                               dtype=tf.float32, name="images")
+
+    # Cannot return more results than there are classes
+    top_k = min(top_k, model.output_shape[-1])
+
+    @tf.function(input_signature=[input_spec])
+    def serving_function(images):
+        logits = model(images, training=False)
+        # top_k is a partial sort: its cost stays flat as the number of classes grows
+        scores, indices = tf.math.top_k(tf.nn.softmax(logits), k=top_k)
+        if include_logits:
+            return {"scores": scores, "indices": indices, "logits": logits}
+        return {"scores": scores, "indices": indices}
+
+    return serving_function
+
+
+def load_serving_function(path_model, image_size=(224, 224), top_k=3, num_threads=None):
+    """
+    Load the serving function from a Keras model file, from a SavedModel exported with
+    src/model/export_serving_model.py or from a TensorFlow Lite model exported with
+    src/model/make_quantized_models.py.
+
+    :param path_model: Path to a .keras file, a SavedModel directory or a .tflite file
+    :param image_size: Model input size (height, width). Only used for Keras models.
+    :param top_k: Number of results to return. Only used for Keras models, exported
+        models have top k fixed at export.
+    :param num_threads: Threads of the TensorFlow Lite interpreter. None keeps the
+        default. TensorFlow models use configure_threads() instead.
+    :return: Function that maps a float32 image batch to a dictionary with the top k
+        "scores" and "indices"
+    """
+    path_model = pathlib.Path(path_model)
+
+    # Quantized TensorFlow Lite model
+    if path_model.suffix == ".tflite":
+        return load_tflite_serving_function(path_model, num_threads=num_threads)
+
+    import tensorflow as tf
+
+    # Exported SavedModel: the serving signature already contains softmax and top k.
+    # Loads faster than a Keras model, which is deserialised layer by layer and traced.
+    if path_model.is_dir():
+        signature = tf.saved_model.load(str(path_model)).signatures["serving_default"]
+        return lambda images: signature(images=tf.convert_to_tensor(images))
+
+    # Keras model: trace the serving function here
+    model = tf.keras.models.load_model(path_model)
+    return build_serving_function(model, image_size=image_size, top_k=top_k)
+
+
+def load_tflite_serving_function(path_tflite, num_threads=None):
+    """
+    Load a TensorFlow Lite model as a serving function. Uses tflite-runtime if it is
+    installed, TensorFlow otherwise.
+
+    :param path_tflite: Path to a .tflite file with "scores" and "indices" outputs
+    :param num_threads: Threads of the interpreter. None keeps the default.
+    :return: Function that maps a float32 image batch to a dictionary with the top k
+        "scores" and "indices"
+    """
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+
+    interpreter = Interpreter(model_path=str(path_tflite), num_threads=num_threads)
+    runner = interpreter.get_signature_runner()
+
+    # The interpreter is not thread-safe, but several inference threads may share it
+    lock = threading.Lock()
+
+    def serving_function(images):
+        with lock:
+            outputs = runner(images=np.asarray(images, dtype=np.float32))
+        return {"scores": outputs["scores"], "indices": outputs["indices"]}
+
+    return serving_function
+
+
+def warmup_serving_function(serving_function, batch_sizes, image_size=(224, 224)):
+    """
+    Run dummy batches through the serving function, so the tracing and the first-call
+    allocations happen at startup instead of during the first requests.
+
+    :param serving_function: Function from load_serving_function()
+    :param batch_sizes: Batch sizes to warm up
+    :param image_size: Model input size (height, width)
+    """
+    for batch_size in batch_sizes:
+        serving_function(np.zeros((batch_size,) + tuple(image_size) + (3,),
+                                  dtype=np.float32))
@@ -1,12 +1,30 @@
 ## Functions for creating the prediction in main.py
 
 ## Imports
-
 import io
+import pathlib
+import tarfile
+import zipfile
 
 import numpy as np
-import tensorflow as tf
-from PIL import Image
+
+from preprocessing import preprocess_image
+
+# Uploads read as archives of images in the batch endpoint
+ARCHIVE_CONTENT_TYPES = ("application/zip", "application/x-zip-compressed",
+                         "application/x-tar", "application/gzip",
+                         "application/x-gzip")
+
+# Image file types read from archives
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+## Exceptions
+
+class TooManyImagesError(ValueError):
+    """
+    Raised when an archive has more images than a request accepts.
+    """
 
 
 ## Functions
@@ -29,57 +47,128 @@ def load_classes(path_classes):
     return classes
 
 
-def read_image(img_bytes, target_size=(224, 224)):
+def is_archive(filename, content_type):
     """
-    Read an image from bytedata and prepare it for the model.
+    Check if an upload is a zip or tar archive of images.
+
+    :param filename: Filename of the upload
+    :param content_type: Content type declared by the client
+    :return: True for zip and (compressed) tar archives
+    """
+    suffixes = "".join(pathlib.Path(filename or "").suffixes).lower()
+    return (content_type in ARCHIVE_CONTENT_TYPES
+            or suffixes.endswith((".zip", ".tar", ".tar.gz", ".tgz")))
+
+
+def read_archive_images(archive_bytes, max_images, max_image_bytes=None):
+    """
+    Read the images from a zip or tar archive. Directories and files that are not
+    images (by extension) are skipped. Sizes are checked from the archive index
+    before a member is decompressed.
+
+    :param archive_bytes: Archive as byte data
+    :param max_images: Largest number of images accepted
+    :param max_image_bytes: Largest accepted (uncompressed) image size. None accepts
+        any size.
+    :return: List of (filename, image bytes) tuples
+    :raises TooManyImagesError: If the archive has more than max_images images
+    :raises ValueError: If the archive is invalid or an image is too large
+    """
+    def is_image(name):
+        return pathlib.Path(name).suffix.lower() in IMAGE_EXTENSIONS
+
+    def check_count(n_images):
+        if n_images > max_images:
+            raise TooManyImagesError(f"Too many images, at most {max_images} are "
+                                     f"accepted.")
+
+    def check_size(name, size):
+        if max_image_bytes is not None and size > max_image_bytes:
+            raise ValueError(f"Image too large: {name}")
+
+    images = []
+    if zipfile.is_zipfile(io.BytesIO(archive_bytes)):
+        with zipfile.ZipFile(io.BytesIO(archive_bytes)) as archive:
+            members = [info for info in archive.infolist()
+                       if not info.is_dir() and is_image(info.filename)]
+            # Check the count before anything is decompressed
+            check_count(len(members))
+            for info in members:
+                check_size(info.filename, info.file_size)
+                images.append((info.filename, archive.read(info)))
+        return images
+
+    try:
+        with tarfile.open(fileobj=io.BytesIO(archive_bytes), mode="r:*") as archive:
+            for member in archive:
+                if member.isfile() and is_image(member.name):
+                    check_count(len(images) + 1)
+                    check_size(member.name, member.size)
+                    images.append((member.name, archive.extractfile(member).read()))
+    except tarfile.TarError as e:
+        raise ValueError(f"Invalid archive: {e}")
+
+    return images
+
+
+def read_image(img_bytes, target_size=(224, 224), resize_backend="pil", draft=True):
+    """
+    Read an image from bytedata and prepare it for the model. Uses the same
+    preprocessing as training.
 
     :param img_bytes: Image as byte data
     :param target_size: Target size for resizing image. Must match model input size.
+    :param resize_backend: Name of the resize backend in preprocessing.RESIZE_BACKENDS
+    :param draft: Let the JPEG decoder downscale the image while decoding
     :return: Numpy array with resized and preprocessed image
     """
 
-    # Open the image
-    img = Image.open(io.BytesIO(img_bytes))
-    # Convert to rgb
-    img = img.convert("RGB")
-    # Resize to match model input size
-    img = img.resize(target_size, Image.NEAREST)
-
-    # Preprocess image (other preprocessing steps are as a layer in the network)
-    # To numpy array
-    img_array = tf.keras.preprocessing.image.img_to_array(img)
+    # Decode and resize (other preprocessing steps are as a layer in the network)
+    img_array = preprocess_image(img_bytes, image_size=target_size,
+                                 resize_backend=resize_backend, draft=draft)
     # Add the "batch" dimension required by the model
-    img_array = tf.expand_dims(img_array, 0)
+    img_array = np.expand_dims(img_array, 0)
 
     return img_array
 
 
-def create_prediction(model, img_array, classes, top_k=3):
+def create_prediction(serving_function, img_array, classes):
     """
     Predict image class with model, return predictions with highest confidence.
 
-    :param model: Mushi-identifier model
+    :param serving_function: Serving function that returns the top k "scores" and
+        "indices" of the mushi-identifier model
     :param img_array: Numpy array with resized and preprocessed image
     :param classes: Mushroom classes
-    :param top_k: Number of results to return, ranked by highest confidence score
     :return: Dictionary with class names corresponding to highest confidence scores
     """
-    # Make prediction
-    prediction = model.predict(img_array)
-    # Apply softmax to turn raw prediction values into confidence scores
-    prediction_softmax = tf.nn.softmax(prediction)
+    return create_batch_prediction(serving_function, img_array, classes)[0]
 
-    # Create ordered prediction indices and confidences. Use tolist(), because
-    # FastAPI does not support numpy floats.
-    pred_indices = np.flip(np.argsort(prediction_softmax).flatten()).tolist()
-    pred_confidences = prediction_softmax.numpy().flatten().tolist()
 
-    # Save top k results to lists
-    # TODO: Round confidence scores, if they are only displayed
-    pred_classes_top_k = [classes[ix] for ix in pred_indices][:top_k]
-    pred_confidences_top_k = [pred_confidences[ix] for ix in pred_indices][:top_k]
+def create_batch_prediction(serving_function, img_batch, classes):
+    """
+    Predict classes for a batch of images in a single forward pass, return the
+    predictions with highest confidence for each image.
 
-    # Create dictionary: map class names to confidence scores
-    predictions_top_k = dict(zip(pred_classes_top_k, pred_confidences_top_k))
+    :param serving_function: Serving function that returns the top k "scores" and
+        "indices" of the mushi-identifier model
+    :param img_batch: Numpy array with resized and preprocessed images, batch first
+    :param classes: Mushroom classes
+    :return: List with a dictionary of top k class names and confidences per image
+    """
+    # Make prediction. Softmax and top k are part of the serving function, so the
+    # results are already ordered by confidence.
+    prediction = serving_function(img_batch)
+
+    # Use tolist(), because FastAPI does not support numpy floats
+    # TODO: Round confidence scores, if they are only displayed
+    pred_confidences = np.asarray(prediction["scores"]).tolist()
+    pred_indices = np.asarray(prediction["indices"]).tolist()
+
+    # Create a dictionary per image: map class names to confidence scores
+    predictions_top_k = [
+        {classes[ix]: confidence for ix, confidence in zip(indices, confidences)}
+        for indices, confidences in zip(pred_indices, pred_confidences)
+    ]
 
     return predictions_top_k
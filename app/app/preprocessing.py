@@ -0,0 +1,163 @@
+## Image preprocessing shared by training (src/model/data_funcs.py), batch prediction
+# (src/model/make_predictions.py) and the API (prediction_funcs.py). Every path turns
+# image bytes into model input with the same functions, so the model sees identical
+# tensors in training and serving.
+#
+# Only depends on numpy and Pillow, so the API container can import it without
+# TensorFlow.
+
+## Imports
+import concurrent.futures
+import io
+
+import numpy as np
+from PIL import Image
+
+## Constants
+
+# Model input size (height, width)
+IMAGE_SIZE = (224, 224)
+
+# Resampling filter for resizing. Bilinear is also the default of tf.image.resize, which
+# training used before this module existed, but the results are not identical: Pillow
+# antialiases when downscaling and draft mode decodes JPEGs at a reduced scale. See
+# src/model/check_preprocessing_parity.py for the difference.
+RESAMPLE = Image.BILINEAR
+
+
+## Functions
+
+def resize_pil(img, image_size, resample=RESAMPLE):
+    """
+    Resize an image with Pillow. Installing Pillow-SIMD in place of Pillow makes this
+    backend use SIMD instructions without any code changes.
+
+    :param img: RGB image as PIL Image
+    :param image_size: Target size (height, width)
+    :param resample: PIL resampling filter
+    :return: Numpy array (float32) with the resized image
+    """
+    # PIL takes the size as (width, height)
+    img = img.resize((image_size[1], image_size[0]), resample)
+
+    return np.asarray(img, dtype=np.float32)
+
+
+def resize_opencv(img, image_size, resample=RESAMPLE):
+    """
+    Resize an image with OpenCV, which uses SIMD instructions for resizing. OpenCV is
+    an optional dependency (opencv-python-headless). Its results differ slightly from
+    Pillow, so train and serve with the same backend.
+
+    :param img: RGB image as PIL Image
+    :param image_size: Target size (height, width)
+    :param resample: PIL resampling filter, mapped to the matching OpenCV interpolation
+    :return: Numpy array (float32) with the resized image
+    """
+    import cv2
+
+    # Match the PIL resampling filters
+    interpolation = {Image.NEAREST: cv2.INTER_NEAREST,
+                     Image.BILINEAR: cv2.INTER_LINEAR,
+                     Image.BICUBIC: cv2.INTER_CUBIC}[resample]
+
+    # OpenCV takes the size as (width, height)
+    img_array = cv2.resize(np.asarray(img), (image_size[1], image_size[0]),
+                           interpolation=interpolation)
+
+    return img_array.astype(np.float32)
+
+
+# Resize backends selectable by name
+RESIZE_BACKENDS = {"pil": resize_pil, "opencv": resize_opencv}
+
+
+def get_resize_backend(resize_backend):
+    """
+    Look up a resize backend by name.
+
+    :param resize_backend: Name of the resize backend in RESIZE_BACKENDS
+    :return: Resize function
+    :raises ValueError: If there is no backend with the name
+    """
+    try:
+        return RESIZE_BACKENDS[resize_backend]
+    except KeyError:
+        raise ValueError(f"Unknown resize backend {resize_backend!r}, use one of: "
+                         f"{', '.join(RESIZE_BACKENDS)}.") from None
+
+
+def preprocess_image(img_bytes, image_size=IMAGE_SIZE, resize_backend="pil",
+                     draft=True):
+    """
+    Decode an image from byte data and resize it to the model input size. Other
+    preprocessing steps are a layer in the network.
+
+    :param img_bytes: Image as byte data
+    :param image_size: Target size (height, width). Must match model input size.
+    :param resize_backend: Name of the resize backend in RESIZE_BACKENDS
+    :param draft: Let the JPEG decoder downscale the image while decoding
+    :return: Numpy array (float32) with shape image_size + (3,)
+    """
+    # Open the image. This only reads the header, pixels are decoded on convert().
+    img = Image.open(io.BytesIO(img_bytes))
+
+    # Decode JPEGs directly at 1/2, 1/4 or 1/8 scale (in the DCT domain), as long as
+    # the result stays at least as big as the target size. Most of the pixels of
+    # large photos are never decoded. Has no effect on other formats.
+    if draft:
+        img.draft("RGB", (image_size[1], image_size[0]))
+
+    # Convert to rgb
+    img = img.convert("RGB")
+
+    # Resize to match model input size
+    return get_resize_backend(resize_backend)(img, image_size)
+
+
+def preprocess_image_file(path_image, image_size=IMAGE_SIZE, resize_backend="pil",
+                          draft=True):
+    """
+    Read an image file and preprocess it with preprocess_image().
+
+    :param path_image: Path to the image file
+    :param image_size: Target size (height, width). Must match model input size.
+    :param resize_backend: Name of the resize backend in RESIZE_BACKENDS
+    :param draft: Let the JPEG decoder downscale the image while decoding
+    :return: Numpy array (float32) with shape image_size + (3,)
+    """
+    with open(path_image, "rb") as f:
+        img_bytes = f.read()
+
+    return preprocess_image(img_bytes, image_size=image_size,
+                            resize_backend=resize_backend, draft=draft)
+
+
+def preprocess_images(images_bytes, image_size=IMAGE_SIZE, resize_backend="pil",
+                      draft=True, executor=None):
+    """
+    Preprocess a batch of images into one preallocated array. The images are decoded
+    and resized in parallel threads (Pillow and OpenCV release the GIL).
+
+    :param images_bytes: List of images as byte data
+    :param image_size: Target size (height, width). Must match model input size.
+    :param resize_backend: Name of the resize backend in RESIZE_BACKENDS
+    :param draft: Let the JPEG decoder downscale the images while decoding
+    :param executor: Executor for the threads. None creates a temporary thread pool.
+    :return: Numpy array (float32) with shape (len(images_bytes),) + image_size + (3,)
+    """
+    img_batch = np.empty((len(images_bytes),) + tuple(image_size) + (3,),
+                         dtype=np.float32)
+
+    def preprocess_into_batch(j):
+        img_batch[j] = preprocess_image(images_bytes[j], image_size=image_size,
+                                        resize_backend=resize_backend, draft=draft)
+
+    if executor is None:
+        with concurrent.futures.ThreadPoolExecutor() as temporary_executor:
+            # list() raises the first exception, if any image fails
+            list(temporary_executor.map(preprocess_into_batch, range(len(images_bytes))))
+    else:
+        list(executor.map(preprocess_into_batch, range(len(images_bytes))))
+
+    return img_batch
@@ -0,0 +1,22 @@
+#! /usr/bin/env bash
+
+# Runs before gunicorn starts the HTTP workers (see the tiangolo/uvicorn-gunicorn
+# image, which sources this file). In shared inference mode, start the process that
+# holds the model. The workers wait for it to come up and report ready at
+# /health/ready once connected.
+if [ "$INFERENCE_MODE" = "shared" ]; then
+    # Random shared secret of the inference process and the workers, unless set. This
+    # file is sourced, so the workers inherit the variable.
+    if [ -z "$INFERENCE_SERVER_AUTHKEY" ]; then
+        INFERENCE_SERVER_AUTHKEY="$(python -c \
+            'import secrets; print(secrets.token_hex(32))')"
+        export INFERENCE_SERVER_AUTHKEY
+    fi
+
+    # Restart the inference process if it exits, the workers reconnect to it
+    (cd /app && while true; do
+        python inference_server.py
+        echo "Inference server exited with code $?, restarting in 1 s"
+        sleep 1
+    done > /proc/1/fd/1 2>&1 &)
+fi
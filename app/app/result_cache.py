@@ -0,0 +1,183 @@
+## Cache for prediction results. Clients often submit the same photo again (retries,
+# shared pictures), so results are cached by a hash of the uploaded bytes and,
+# optionally, by a perceptual hash of the decoded image, which also matches re-encoded
+# copies of the same photo. The cache lives in the worker's memory. In shared inference
+# mode the inference process can be restarted with another model while the workers
+# keep running, so the cache is tied to the identity of the model and emptied when it
+# changes, see ResultCache.set_model().
+
+## Imports
+import collections
+import hashlib
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+
+## Functions
+
+def hash_image_bytes(img_bytes):
+    """
+    Hash uploaded image bytes. BLAKE2b is faster than MD5 and SHA-256 on 64-bit CPUs.
+
+    :param img_bytes: Image as byte data
+    :return: Cache key ("bytes", hex digest)
+    """
+    return "bytes", hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+
+
+def perceptual_hash(img_array):
+    """
+    Difference hash (dHash) of a decoded image: the signs of the horizontal gradients
+    of a 9x8 grayscale thumbnail. Survives re-encoding and small edits, unlike a hash
+    of the bytes.
+
+    :param img_array: Decoded image, shape (height, width, 3) or (1, height, width, 3)
+    :return: Cache key ("perceptual", hex digest)
+    """
+    img_array = np.asarray(img_array).reshape(np.shape(img_array)[-3:])
+    img = Image.fromarray(img_array.astype(np.uint8)).convert("L")
+    pixels = np.asarray(img.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return "perceptual", np.packbits(bits).tobytes().hex()
+
+
+def estimate_size(result):
+    """
+    Rough memory footprint of a cached result (dictionary of class names and scores).
+
+    :param result: Result dictionary
+    :return: Size in bytes
+    """
+    return sys.getsizeof(result) + sum(sys.getsizeof(key) + sys.getsizeof(value)
+                                       for key, value in result.items())
+
+
+## Classes
+
+class ResultCache:
+    """
+    LRU cache with a time to live and a memory bound for prediction results. Keys are
+    (kind, digest) tuples from hash_image_bytes() and perceptual_hash(). Only used
+    from the event loop thread, so no lock is needed.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl_s=3600.0):
+        """
+        :param max_entries: Largest number of cached results
+        :param max_bytes: Largest estimated memory use of the cached results
+        :param ttl_s: Seconds a result stays valid
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+
+        # Key -> (expiry time, size, result), least recently used first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+        # Identity of the model the results are from
+        self.model_id = None
+
+        # Metrics. Counted per lookup, a request can look up two keys.
+        self.hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        Look a result up. Counts a hit or a miss.
+
+        :param key: Cache key from hash_image_bytes() or perceptual_hash()
+        :return: Cached result, or None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expiry, size, result = entry
+        if time.monotonic() > expiry:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        kind, _ = key
+        if kind == "perceptual":
+            self.perceptual_hits += 1
+        return result
+
+    def put(self, keys, result):
+        """
+        Cache a result under one or more keys (e.g. byte hash and perceptual hash).
+        Evicts the least recently used results beyond the bounds.
+
+        :param keys: Cache keys
+        :param result: Result dictionary
+        """
+        if self.max_entries <= 0:
+            return
+
+        size = estimate_size(result)
+        expiry = time.monotonic() + self.ttl_s
+        for key in keys:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expiry, size, result)
+            self._bytes += size
+
+        while self._entries and (len(self._entries) > self.max_entries
+                                 or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        """
+        Remove an entry and update the memory estimate.
+
+        :param key: Cache key
+        """
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def set_model(self, model_id):
+        """
+        Set the identity of the model the results come from. Removes the cached
+        results if the model changed.
+
+        :param model_id: Model identity, e.g. from inference_server.model_identity()
+        """
+        if model_id != self.model_id:
+            self.clear()
+            self.model_id = model_id
+
+    def clear(self):
+        """
+        Remove all cached results.
+        """
+        self._entries.clear()
+        self._bytes = 0
+
+    def metrics(self):
+        """
+        Report the cache size and hit/miss counts.
+
+        :return: Dictionary with the metrics
+        """
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "perceptual_hits": self.perceptual_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations}
@@ -0,0 +1,160 @@
+## Settings for the mushroom classification API. Every setting can be overridden with
+# an environment variable of the same name, e.g. in "docker run -e MAX_BATCH_SIZE=16".
+
+## Imports
+import os
+
+
+## Functions
+
+def env_int(name, default):
+    """
+    Read an integer setting from the environment.
+
+    :param name: Name of the environment variable
+    :param default: Value used if the variable is not set
+    :return: Integer value of the setting
+    """
+    return int(os.environ.get(name, default))
+
+
+def env_bool(name, default):
+    """
+    Read a boolean setting from the environment. "1", "true" and "yes" count as true.
+
+    :param name: Name of the environment variable
+    :param default: Value used if the variable is not set
+    :return: Boolean value of the setting
+    """
+    return os.environ.get(name, str(default)).lower() in ("1", "true", "yes")
+
+
+def env_float(name, default):
+    """
+    Read a float setting from the environment.
+
+    :param name: Name of the environment variable
+    :param default: Value used if the variable is not set
+    :return: Float value of the setting
+    """
+    return float(os.environ.get(name, default))
+
+
+## Model
+
+# Keras model file, SavedModel directory exported with src/model/export_serving_model.py
+# or quantized .tflite file exported with src/model/make_quantized_models.py
+MODEL_PATH = os.environ.get("MODEL_PATH", "../model/mushi_identifier_v1.keras")
+
+# Number of predictions returned per image. Fixed at export for exported models.
+TOP_K = env_int("TOP_K", 3)
+
+# Load the model in a background thread after the worker has started. The worker
+# answers /health/live at once and /health/ready once the model is warmed up. False
+# loads the model while main.py is imported.
+LOAD_MODEL_IN_BACKGROUND = env_bool("LOAD_MODEL_IN_BACKGROUND", True)
+
+# Run dummy batches of every batch size before the model is reported ready, so the
+# first requests do not pay for tracing
+WARMUP = env_bool("WARMUP", True)
+
+## Image decoding
+
+# Resize backend: "pil" (Pillow, or Pillow-SIMD if installed in its place) or "opencv"
+# (requires opencv-python-headless). Should match the backend used in training.
+RESIZE_BACKEND = os.environ.get("RESIZE_BACKEND", "pil")
+
+# Let the JPEG decoder downscale large photos while decoding
+JPEG_DRAFT = env_bool("JPEG_DRAFT", True)
+
+## Micro-batching
+
+# Largest number of images run through the model in one forward pass
+MAX_BATCH_SIZE = env_int("MAX_BATCH_SIZE", 8)
+
+# Longest time (in milliseconds) the first image of a batch waits for more images
+# before the batch is run. Trades single-request latency for throughput.
+MAX_BATCH_LATENCY_MS = env_float("MAX_BATCH_LATENCY_MS", 5.0)
+
+## Concurrency
+
+# "local": every worker loads its own copy of the model. "shared": one inference
+# process (started by prestart.sh) holds the model, the workers send it their batches
+# through shared memory. Saves memory and keeps the TensorFlow threads from
+# oversubscribing the cores when gunicorn runs several workers.
+INFERENCE_MODE = os.environ.get("INFERENCE_MODE", "local")
+
+# Unix socket of the shared inference process. Its directory is made private to the
+# user that runs the server.
+INFERENCE_SERVER_ADDRESS = os.environ.get("INFERENCE_SERVER_ADDRESS",
+                                          "/tmp/mushi-inference/inference.sock")
+
+# Shared secret of the inference process and the workers. Required in shared mode,
+# prestart.sh generates a random one if it is not set.
+INFERENCE_SERVER_AUTHKEY = os.environ.get("INFERENCE_SERVER_AUTHKEY", "")
+
+# TensorFlow threads inside one operation and operations run in parallel, per process
+# that holds a model. 0 keeps the TensorFlow default (one thread per core).
+TF_INTRA_OP_THREADS = env_int("TF_INTRA_OP_THREADS", 0)
+TF_INTER_OP_THREADS = env_int("TF_INTER_OP_THREADS", 0)
+
+# Threads per worker for decoding uploaded images
+DECODE_WORKERS = env_int("DECODE_WORKERS", os.cpu_count() or 1)
+
+# Forward passes run at the same time per worker. TensorFlow already uses several
+# threads inside one forward pass, so a small number is usually enough.
+INFERENCE_WORKERS = env_int("INFERENCE_WORKERS", 1)
+
+# Requests allowed to wait for a free decode thread, and images allowed to wait for a
+# forward pass. Beyond these the API answers with 503.
+MAX_QUEUE_SIZE = env_int("MAX_QUEUE_SIZE", 64)
+
+## Upload limits
+
+# Largest accepted image file in megabytes. Larger uploads are cut off while they
+# stream in.
+MAX_UPLOAD_MB = env_float("MAX_UPLOAD_MB", 10.0)
+
+# Largest accepted /predict/batch request body in megabytes
+MAX_BATCH_UPLOAD_MB = env_float("MAX_BATCH_UPLOAD_MB", 100.0)
+
+# Largest accepted image in megapixels, checked from the image header before decoding
+# (protects against decompression bombs)
+MAX_IMAGE_MEGAPIXELS = env_float("MAX_IMAGE_MEGAPIXELS", 64.0)
+
+## Batch endpoint
+
+# Largest number of images accepted in one /predict/batch request, including images in
+# archives
+MAX_IMAGES_PER_REQUEST = env_int("MAX_IMAGES_PER_REQUEST", 32)
+
+## Result cache
+
+# Largest number of cached prediction results per worker. 0 disables the cache.
+RESULT_CACHE_SIZE = env_int("RESULT_CACHE_SIZE", 10000)
+
+# Largest memory use of the cached results per worker, in megabytes
+RESULT_CACHE_MAX_MB = env_float("RESULT_CACHE_MAX_MB", 64.0)
+
+# Seconds a cached result stays valid
+RESULT_CACHE_TTL_S = env_float("RESULT_CACHE_TTL_S", 3600.0)
+
+# Also cache by a perceptual hash of the decoded image, so re-encoded copies of a
+# photo hit the cache. Near-identical photos then share a result.
+PERCEPTUAL_CACHE = env_bool("PERCEPTUAL_CACHE", False)
+
+
+## Checks
+
+# Fail at startup instead of on the first request
+if RESIZE_BACKEND not in ("pil", "opencv"):
+    raise ValueError(f"Unknown RESIZE_BACKEND {RESIZE_BACKEND!r}, use \"pil\" or "
+                     f"\"opencv\".")
+
+if INFERENCE_MODE not in ("local", "shared"):
+    raise ValueError(f"Unknown INFERENCE_MODE {INFERENCE_MODE!r}, use \"local\" or "
+                     f"\"shared\".")
+
+# Without a secret any local process could connect and run batches
+if INFERENCE_MODE == "shared" and not INFERENCE_SERVER_AUTHKEY:
+    raise ValueError("INFERENCE_MODE=shared requires INFERENCE_SERVER_AUTHKEY.")
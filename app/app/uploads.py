@@ -0,0 +1,224 @@
+## Validation of uploaded images before they are decoded. Request bodies are counted
+# while they stream in and cut off at a byte limit, the image format is sniffed from
+# the magic bytes instead of trusting the declared content type, and the pixel
+# dimensions are read from the image header to reject decompression bombs before any
+# pixels are decoded.
+
+## Imports
+import collections
+import io
+import json
+
+from PIL import Image
+
+# Magic bytes of the supported image formats
+MAGIC_BYTES = {
+    "jpeg": b"\xff\xd8\xff",
+    "png": b"\x89PNG\r\n\x1a\n",
+}
+
+# Chunk size for reading uploads
+CHUNK_SIZE = 64 * 1024
+
+
+## Exceptions
+
+class UploadRejectedError(Exception):
+    """
+    Raised when an upload fails validation.
+    """
+
+    def __init__(self, status_code, detail, reason):
+        """
+        :param status_code: HTTP status code for the response
+        :param detail: Message for the client
+        :param reason: Short reason used as the metrics key
+        """
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.reason = reason
+
+
+## Functions
+
+def sniff_image_format(img_bytes):
+    """
+    Detect the image format from the magic bytes at the start of the file.
+
+    :param img_bytes: Image as byte data (at least the first 8 bytes)
+    :return: "jpeg", "png" or None
+    """
+    for image_format, magic in MAGIC_BYTES.items():
+        if img_bytes.startswith(magic):
+            return image_format
+
+    return None
+
+
+## Classes
+
+class UploadValidator:
+    """
+    Upload limits and counters for rejected uploads. Only used from the event loop
+    thread, so no lock is needed.
+    """
+
+    def __init__(self, max_upload_bytes, max_pixels):
+        """
+        :param max_upload_bytes: Largest accepted image file, in bytes
+        :param max_pixels: Largest accepted image, in pixels (width * height)
+        """
+        self.max_upload_bytes = max_upload_bytes
+        self.max_pixels = max_pixels
+
+        # Metrics: rejected uploads per reason
+        self.rejected = collections.Counter()
+
+    def reject(self, status_code, detail, reason):
+        """
+        Count a rejected upload and raise the error.
+
+        :param status_code: HTTP status code for the response
+        :param detail: Message for the client
+        :param reason: Short reason used as the metrics key
+        :raises UploadRejectedError: Always
+        """
+        self.rejected[reason] += 1
+        raise UploadRejectedError(status_code, detail, reason)
+
+    async def read(self, upload_file, max_bytes=None):
+        """
+        Read an uploaded file in chunks and stop as soon as it exceeds the limit, so an
+        oversized file is never held in memory as a whole.
+
+        :param upload_file: FastAPI UploadFile
+        :param max_bytes: Byte limit. None uses max_upload_bytes.
+        :return: File contents as bytes
+        :raises UploadRejectedError: If the file is too large
+        """
+        max_bytes = max_bytes or self.max_upload_bytes
+
+        buffer = bytearray()
+        while True:
+            chunk = await upload_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            buffer += chunk
+            if len(buffer) > max_bytes:
+                self.reject(413, f"File too large, at most {max_bytes // 1024 ** 2} MB "
+                                 f"are accepted.", "too_large")
+
+        return bytes(buffer)
+
+    def check_image(self, img_bytes):
+        """
+        Check the real format and the pixel dimensions of an image. Only the header is
+        parsed, no pixels are decoded.
+
+        :param img_bytes: Image as byte data
+        :return: Image format, "jpeg" or "png"
+        :raises UploadRejectedError: If the format is not supported or the image has
+            too many pixels
+        """
+        image_format = sniff_image_format(img_bytes)
+        if image_format is None:
+            self.reject(415, "Invalid image type. Please submit a .jpeg or .png "
+                             "image.", "invalid_format")
+
+        try:
+            # Opening an image reads its header only
+            with Image.open(io.BytesIO(img_bytes)) as img:
+                width, height = img.size
+        except Exception:
+            self.reject(400, "Could not read the image header.", "invalid_header")
+
+        if width * height > self.max_pixels:
+            self.reject(413, f"Image too large: {width}x{height} pixels, at most "
+                             f"{self.max_pixels} pixels are accepted.",
+                        "too_many_pixels")
+
+        return image_format
+
+    def metrics(self):
+        """
+        Report the limits and the rejected uploads per reason.
+
+        :return: Dictionary with the metrics
+        """
+        return {"max_upload_bytes": self.max_upload_bytes,
+                "max_pixels": self.max_pixels,
+                "rejected": dict(self.rejected)}
+
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware that limits the request body size per path. Requests with a larger
+    Content-Length are rejected before the body is read, streamed bodies are cut off
+    as soon as they exceed the limit. Either way the client gets a 413.
+    """
+
+    def __init__(self, app, limits, validator=None):
+        """
+        :param app: ASGI application
+        :param limits: Dictionary that maps a request path to its body limit in bytes
+        :param validator: UploadValidator that counts the rejected requests
+        """
+        self.app = app
+        self.limits = limits
+        self.validator = validator
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.limits:
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.limits[scope["path"]]
+
+        # Declared size: reject without reading the body
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and int(content_length) > limit:
+            await self.send_too_large(send, limit)
+            return
+
+        state = {"received": 0, "exceeded": False, "sent": False}
+
+        async def limited_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > limit:
+                    state["exceeded"] = True
+                    # Stop reading, the app sees an empty, finished body
+                    return {"type": "http.request", "body": b"", "more_body": False}
+            return message
+
+        async def limited_send(message):
+            # Replace whatever the app answers to a cut-off body with a 413
+            if state["exceeded"]:
+                if not state["sent"]:
+                    state["sent"] = True
+                    await self.send_too_large(send, limit)
+                return
+            await send(message)
+
+        await self.app(scope, limited_receive, limited_send)
+
+    async def send_too_large(self, send, limit):
+        """
+        Send a 413 response and count the rejection.
+
+        :param send: ASGI send callable
+        :param limit: Body limit in bytes
+        """
+        if self.validator is not None:
+            self.validator.rejected["body_too_large"] += 1
+
+        body = json.dumps({"detail": f"Request too large, at most "
+                                     f"{limit // 1024 ** 2} MB are accepted."}).encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,70 @@
+# Benchmark the per-image decode time of the image decoding options (JPEG draft mode,
+# resize backends) and the accuracy the model reaches with each of them.
+#
+# Run from the app directory: python benchmarks/benchmark_decode.py
+
+## Imports
+import importlib.util
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+# The app modules are imported the same way main.py imports them
+sys.path.append(str(pathlib.Path(__file__).parents[1] / "app"))
+from model_funcs import load_serving_function  # noqa: E402
+from prediction_funcs import load_classes, read_image  # noqa: E402
+
+## Paths
+path_model = pathlib.Path(__file__).parents[1] / "model" / "mushi_identifier_v1.keras"
+path_classes = (pathlib.Path(__file__).parents[1] / "model"
+                / "classes_mushi_identifier_v1.csv")
+
+# Test images, one folder per class
+path_test_dir = pathlib.Path(__file__).parents[2] / "data" / "02_processed" / "test"
+
+## Settings
+
+# Number of test images per class used for the benchmark
+n_images_per_class = 20
+
+image_size = (224, 224)
+
+# Decode options to compare: (resize backend, JPEG draft mode)
+decode_options = [("pil", False), ("pil", True)]
+# OpenCV is an optional dependency
+if importlib.util.find_spec("cv2"):
+    decode_options += [("opencv", False), ("opencv", True)]
+
+## Load model, classes and test images
+
+serving_function = load_serving_function(path_model, image_size=image_size, top_k=3)
+classes = load_classes(path_classes)
+
+# Read the image bytes once, so disk reads are not part of the timing
+images = []
+for path_class_dir in sorted(path_test_dir.iterdir()):
+    for path_image in sorted(path_class_dir.iterdir())[:n_images_per_class]:
+        images.append((path_image.read_bytes(), classes.index(path_class_dir.name)))
+
+## Run benchmark
+
+print(f"{'backend':<10}{'draft':>6}{'ms/image':>10}{'top-1':>8}{'top-3':>8}")
+for resize_backend, draft in decode_options:
+    decode_times = np.empty(len(images))
+    n_top1 = 0
+    n_top3 = 0
+
+    for j, (img_bytes, label) in enumerate(images):
+        start = time.perf_counter()
+        img_array = read_image(img_bytes, target_size=image_size,
+                               resize_backend=resize_backend, draft=draft)
+        decode_times[j] = (time.perf_counter() - start) * 1000
+
+        indices = np.asarray(serving_function(img_array)["indices"])[0]
+        n_top1 += int(indices[0] == label)
+        n_top3 += int(label in indices[:3])
+
+    print(f"{resize_backend:<10}{str(draft):>6}{np.median(decode_times):>10.2f}"
+          f"{n_top1 / len(images):>8.3f}{n_top3 / len(images):>8.3f}")
@@ -0,0 +1,78 @@
+# Benchmark the per-request inference latency of model.predict() against the compiled
+# serving function used by the API.
+#
+# Run from the app directory: python benchmarks/benchmark_serving.py
+
+## Imports
+import pathlib
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# The app modules are imported the same way main.py imports them
+sys.path.append(str(pathlib.Path(__file__).parents[1] / "app"))
+from model_funcs import build_serving_function, warmup_serving_function  # noqa: E402
+
+## Paths
+path_model = pathlib.Path(__file__).parents[1] / "model" / "mushi_identifier_v1.keras"
+
+## Settings
+
+# Batch sizes to benchmark
+batch_sizes = [1, 8]
+
+# Timed calls per batch size, after a few untimed warmup calls
+n_calls = 200
+n_warmup_calls = 10
+
+image_size = (224, 224)
+
+
+## Functions
+
+def time_calls(fn, img_batch, n_calls, n_warmup_calls):
+    """
+    Time repeated calls of a prediction function.
+
+    :param fn: Function that takes an image batch
+    :param img_batch: Image batch passed to fn
+    :param n_calls: Number of timed calls
+    :param n_warmup_calls: Number of untimed calls before timing
+    :return: Numpy array with the duration of each call in milliseconds
+    """
+    for _ in range(n_warmup_calls):
+        fn(img_batch)
+
+    durations = np.empty(n_calls)
+    for j in range(n_calls):
+        start = time.perf_counter()
+        # Converting to numpy makes sure the result has been computed, like in the API
+        np.asarray(fn(img_batch))
+        durations[j] = (time.perf_counter() - start) * 1000
+
+    return durations
+
+
+## Run benchmark
+model = tf.keras.models.load_model(path_model)
+
+serving_function = build_serving_function(model, image_size=image_size)
+warmup_serving_function(serving_function, batch_sizes, image_size=image_size)
+
+candidates = {
+    "model.predict": lambda img_batch: model.predict(img_batch, verbose=0),
+    # Softmax and top k are part of the serving function
+    "serving_function": lambda img_batch: serving_function(img_batch)["scores"],
+}
+
+print(f"{'path':<18}{'batch':>6}{'p50 ms':>10}{'p99 ms':>10}{'ms/image':>10}")
+for batch_size in batch_sizes:
+    img_batch = np.random.uniform(0, 255, (batch_size,) + image_size + (3,)).astype(
+        "float32")
+    for name, fn in candidates.items():
+        durations = time_calls(fn, img_batch, n_calls, n_warmup_calls)
+        print(f"{name:<18}{batch_size:>6}{np.percentile(durations, 50):>10.2f}"
+              f"{np.percentile(durations, 99):>10.2f}"
+              f"{np.median(durations) / batch_size:>10.2f}")
@@ -0,0 +1,188 @@
+# Functions for a content-addressed image store. Every image is stored once, under
+# the hash of its contents. The interim and processed directories are trees of links
+# into the store instead of full copies of the dataset, and identical images are
+# detected for free. Used in s01_make_interim.py.
+
+
+## Import libraries
+import concurrent.futures
+import os
+
+import pandas as pd
+
+# For terminal from project root
+from s01_make_interim_funcs import transfer_file
+
+# For pycharm
+# from src.data.s01_make_interim_funcs import transfer_file
+
+# Number of files handed to the thread pool at a time
+TRANSFER_CHUNK_SIZE = 10000
+
+# Blob suffix by the magic bytes at the start of the file
+IMAGE_SIGNATURES = {b"\xff\xd8\xff": ".jpg", b"\x89PNG\r\n\x1a\n": ".png"}
+
+
+##
+def path_blob(path_store, img_hash, suffix):
+    """
+    Path of an image in the store. Blobs are spread over subdirectories by the first two
+    characters of the hash, so no directory gets too many entries.
+
+    :param path_store: Path to blob store directory
+    :param img_hash: Hash of the image contents (see hash_funcs.py)
+    :param suffix: File extension of the blob, see image_suffix()
+    :return: Path to blob
+    """
+    return path_store / img_hash[:2] / (img_hash + suffix)
+
+
+##
+def image_suffix(path_image):
+    """
+    File extension of an image by its format, read from the magic bytes. The raw
+    filename may not tell, e.g. a PNG saved as .jpg.
+
+    :param path_image: Path to image
+    :return: ".jpg" or ".png", the lowercase suffix of the filename for other formats
+    """
+    with open(path_image, "rb") as f:
+        header = f.read(8)
+
+    for signature, suffix in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return suffix
+
+    return path_image.suffix.lower()
+
+
+##
+def add_blob_suffixes(df_meta, path_raw_image_dir, max_workers=16):
+    """
+    Add the blob suffix of each image, see image_suffix(). Images with the same hash
+    get the suffix of the first of them, so they share one blob.
+
+    :param df_meta: Dataframe with image_filename and hash of each image
+    :param path_raw_image_dir: Path to raw image directory
+    :param max_workers: Number of threads reading the file headers
+    :return: Copy of df_meta with a suffix column
+    """
+    df_unique = df_meta.drop_duplicates(subset="hash")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        suffixes = list(executor.map(
+            image_suffix, [path_raw_image_dir / image_filename
+                           for image_filename in df_unique["image_filename"]]))
+
+    return df_meta.assign(suffix=df_meta["hash"].map(dict(zip(df_unique["hash"],
+                                                              suffixes))))
+
+
+##
+def add_images_to_store(df_meta, path_raw_image_dir, path_store, mode="hardlink",
+                        max_workers=16):
+    """
+    Add raw images to the store. Images already in the store (same hash) are skipped,
+    so duplicates are stored once and reruns only add new images.
+
+    :param df_meta: Dataframe with image_filename, hash and suffix of each image, see
+        add_blob_suffixes()
+    :param path_raw_image_dir: Path to raw image directory
+    :param path_store: Path to blob store directory
+    :param mode: How images get into the store: "copy", "hardlink" or "reflink", see
+        s01_make_interim_funcs.transfer_file(). "hardlink" stores no extra bytes if
+        the store is on the same filesystem as raw.
+    :param max_workers: Number of transfer threads
+    """
+    # One blob per unique hash
+    df_unique = df_meta.drop_duplicates(subset="hash")
+    transfers = []
+    for image_filename, img_hash, suffix in zip(
+            df_unique["image_filename"], df_unique["hash"], df_unique["suffix"]):
+        path_dst = path_blob(path_store, img_hash, suffix)
+        if not path_dst.exists():
+            transfers.append((path_raw_image_dir / image_filename, path_dst))
+
+    print(f"Adding {len(transfers)} images to the blob store "
+          f"({len(df_unique) - len(transfers)} already stored, "
+          f"{len(df_meta) - len(df_unique)} duplicates).")
+
+    # Create the hash prefix directories up front
+    for prefix in {path_dst.parent for _, path_dst in transfers}:
+        os.makedirs(prefix, exist_ok=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Hand the files over in chunks to keep the number of pending futures bounded
+        for j in range(0, len(transfers), TRANSFER_CHUNK_SIZE):
+            chunk = transfers[j:j + TRANSFER_CHUNK_SIZE]
+            list(executor.map(lambda transfer: transfer_file(*transfer, mode), chunk))
+            print(f"Added {j + len(chunk)} / {len(transfers)} images to the blob store")
+
+
+##
+def link_images_to_store(df_meta, path_store, path_image_dir, mode="symlink"):
+    """
+    Build a tree of links with one subdirectory per class, pointing into the store.
+    Links that already point to the right blob are left alone, links of images that
+    are no longer in df_meta are removed.
+
+    :param df_meta: Dataframe with image_filename, species, hash and suffix of each
+        image, see add_blob_suffixes()
+    :param path_store: Path to blob store directory
+    :param path_image_dir: Path to the root of the link tree, e.g. interim image
+        directory
+    :param mode: "symlink" or "hardlink"
+    """
+    n_linked = 0
+    expected = set()
+    for image_filename, image_class, img_hash, suffix in zip(
+            df_meta["image_filename"], df_meta["species"], df_meta["hash"],
+            df_meta["suffix"]):
+        path_src = path_blob(path_store, img_hash, suffix)
+        path_dst = path_image_dir / image_class / image_filename
+        expected.add(path_dst)
+
+        # Skip links that are already up to date
+        if mode == "symlink" and path_dst.is_symlink():
+            if os.path.realpath(path_dst) == os.path.realpath(path_src):
+                continue
+        elif mode == "hardlink" and path_dst.exists():
+            if os.path.samefile(path_dst, path_src):
+                continue
+
+        os.makedirs(path_dst.parent, exist_ok=True)
+        transfer_file(path_src, path_dst, mode)
+        n_linked += 1
+
+    # Prune stale links, e.g. of images that were quarantined or left the metadata.
+    # The tree only holds links into the store, so removing them loses no data.
+    n_removed = 0
+    for path_class_dir in path_image_dir.iterdir():
+        if not path_class_dir.is_dir():
+            continue
+        for path_link in path_class_dir.iterdir():
+            if path_link not in expected and (path_link.is_symlink()
+                                              or path_link.is_file()):
+                path_link.unlink()
+                n_removed += 1
+
+    print(f"Linked {n_linked} images into {path_image_dir} "
+          f"({len(df_meta) - n_linked} up to date, {n_removed} stale links removed).")
+
+
+##
+def find_duplicates(dfs_meta):
+    """
+    Find images with identical contents, e.g. the same photo in train and test.
+
+    :param dfs_meta: Dictionary that maps a subset name to a dataframe with
+        image_filename, species and hash of each image
+    :return: Dataframe with one row per duplicated image, sorted by hash
+    """
+    df_all = pd.concat([df_meta.assign(subset=subset)
+                        for subset, df_meta in dfs_meta.items()])
+
+    # Keep every row whose hash occurs more than once
+    df_duplicates = df_all[df_all.duplicated(subset="hash", keep=False)]
+
+    return df_duplicates.sort_values("hash")[["hash", "subset", "species",
+                                              "image_filename"]]
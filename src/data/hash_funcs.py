@@ -0,0 +1,34 @@
+# Functions for hashing files. Used for caching per-file results in the data pipeline.
+
+## Import libraries
+import hashlib
+
+# Read files in chunks of this many bytes
+CHUNK_SIZE = 1024 * 1024
+
+
+##
+def hash_bytes(data):
+    """
+    Hash byte data. BLAKE2b is faster than MD5 and SHA-256 on 64-bit CPUs.
+
+    :param data: Byte data
+    :return: Hex digest (32 characters)
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+##
+def hash_file(path_file):
+    """
+    Hash a file without reading it into memory at once.
+
+    :param path_file: Path to file
+    :return: Hex digest (32 characters), same as hash_bytes() of the file contents
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path_file, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
@@ -1,7 +1,10 @@
 # This script transfers the images from raw and external to interim creating a
 # subdirectory for each class. The images are mixed so they can later be easily split
 # into train/test/validate sets. The images are checked for corruption before the
-# transfer.
+# transfer, corrupted images are quarantined.
+#
+# By default the images are stored once in a content-addressed blob store, and the
+# interim class directories are trees of symlinks into the store.
 
 
 ## Import libraries
@@ -10,10 +13,14 @@ import pathlib
 import pandas as pd
 
 # For terminal from project root
+import blob_store_funcs as blob_funcs
 import s01_make_interim_funcs as funcs
+import s01_verify_images_funcs as verify_funcs
 
 # For pycharm
+# import src.data.blob_store_funcs as blob_funcs
 # import src.data.s01_make_interim_funcs as funcs
+# import src.data.s01_verify_images_funcs as verify_funcs
 
 # TODO: Find a common approach for funcs imports without tweaking PATH
 
@@ -38,6 +45,12 @@ path_raw_image_dir = path_raw_dir / "DF20"
 # Interim image directory
 path_interim_image_dir = path_interim_dir / "images_per_class"
 
+# Interim test image directory
+path_interim_test_image_dir = path_interim_dir / "test"
+
+# Content-addressed blob store for the images
+path_blob_store = path_interim_dir / "blobs"
+
 # Training and validation image metadata
 path_meta_train_val = path_raw_dir / "DF20-train_metadata_PROD.csv"
 
@@ -47,38 +60,122 @@ path_meta_test = path_raw_dir / "DF20-public_test_metadata_PROD.csv"
 # Mushroom classes for the image recognition task
 path_mushroom_classes = path_external_dir / "mushroom_classes.csv"
 
-## Load metadata and classes
-
-# Load training and validation image metadata
-df_meta_train_val_raw = pd.read_csv(path_meta_train_val)
-
-# Load test image metadata
-df_meta_test_raw = pd.read_csv(path_meta_test)
-
-# Load mushroom classes
-df_mushroom_classes = pd.read_csv(path_mushroom_classes)
-
-## Find filenames for the classes of interest
-
-df_meta_train_val = funcs.filter_path_class_metadata(df_meta_train_val_raw,
-                                                     df_mushroom_classes)
-df_meta_test = funcs.filter_path_class_metadata(df_meta_test_raw, df_mushroom_classes)
-
-## Create interim folder structure
-funcs.create_interim_folders(df_mushroom_classes, path_interim_image_dir)
-
-## Transfer raw data to interim
-
-# Train and validation data
-funcs.transfer_raw_to_interim(df_meta_train_val, path_raw_image_dir,
-                              path_interim_image_dir)
-
-# TODO: Mix test data in interim with the train/validation set. For now test is
-#  kept separate so we can compare test set performance to the DF2020 article.
-# Test data
-path_interim_test_image_dir = path_interim_dir / "test"
-funcs.create_interim_folders(df_mushroom_classes, path_interim_test_image_dir)
-funcs.transfer_raw_to_interim(df_meta_test, path_raw_image_dir,
-                              path_interim_test_image_dir)
-
-## TODO: Transfer external data to interim
+# Cache for the filtered metadata
+path_meta_cache_dir = path_interim_dir / "metadata_cache"
+
+## Run
+
+# The verification uses a process pool, which imports this script again in the
+# workers on platforms that spawn processes (macOS, Windows)
+if __name__ == "__main__":
+    ## Load classes
+    df_mushroom_classes = pd.read_csv(path_mushroom_classes)
+
+    ## Find filenames for the classes of interest
+
+    # The raw metadata is streamed in chunks and only the needed columns are parsed.
+    # The filtered result is cached as Parquet, so reruns skip the csv parsing.
+    df_meta_train_val = funcs.load_filtered_metadata(path_meta_train_val,
+                                                     df_mushroom_classes,
+                                                     path_meta_cache_dir)
+    df_meta_test = funcs.load_filtered_metadata(path_meta_test, df_mushroom_classes,
+                                                path_meta_cache_dir)
+
+    ## Verify raw images
+
+    # How to check the images: "decode" decodes every image, "verify" only checks the
+    # file structure and "markers" only the JPEG start/end markers (fastest, misses
+    # corrupted scan data). Results are cached per file, so unchanged files are not
+    # verified again on a rerun.
+    verify_check = "decode"
+
+    df_verified = verify_funcs.verify_images(
+        list(df_meta_train_val["image_filename"])
+        + list(df_meta_test["image_filename"]),
+        path_raw_image_dir, path_cache=path_interim_dir / "verification_cache.csv",
+        check=verify_check)
+
+    # Corrupted images are listed in the quarantine list and not transferred
+    quarantine = verify_funcs.write_quarantine_list(
+        df_verified, path_interim_dir / "quarantine.txt")
+
+    ## Create interim folder structure
+    funcs.create_interim_folders(df_mushroom_classes, path_interim_image_dir)
+
+    # TODO: Mix test data in interim with the train/validation set. For now test is
+    #  kept separate so we can compare test set performance to the DF2020 article.
+    funcs.create_interim_folders(df_mushroom_classes, path_interim_test_image_dir)
+
+    ## Transfer raw data to interim
+
+    # Store each image once under its hash and link the interim directories into the
+    # store. Set to False to transfer full files into the interim directories instead.
+    use_blob_store = True
+
+    # How images get into the store (or interim): "copy" works everywhere. If raw and
+    # interim are on the same filesystem, "hardlink" (or "reflink" on copy-on-write
+    # filesystems) avoids copying the bytes.
+    transfer_mode = "copy"
+
+    # Number of parallel transfer threads
+    transfer_workers = 16
+
+    if use_blob_store:
+        # The verification stage already hashed every image
+        for df_meta in (df_meta_train_val, df_meta_test):
+            df_meta["hash"] = df_verified.loc[df_meta["image_filename"],
+                                              "hash"].to_numpy()
+
+        # Leave out corrupted images
+        df_meta_train_val = df_meta_train_val[
+            ~df_meta_train_val["image_filename"].isin(quarantine)]
+        df_meta_test = df_meta_test[~df_meta_test["image_filename"].isin(quarantine)]
+
+        # Blobs are named by hash and by the image format from the magic bytes
+        df_meta_train_val = blob_funcs.add_blob_suffixes(
+            df_meta_train_val, path_raw_image_dir, max_workers=transfer_workers)
+        df_meta_test = blob_funcs.add_blob_suffixes(
+            df_meta_test, path_raw_image_dir, max_workers=transfer_workers)
+
+        # Store the images, duplicates are stored once
+        blob_funcs.add_images_to_store(pd.concat([df_meta_train_val, df_meta_test]),
+                                       path_raw_image_dir, path_blob_store,
+                                       mode=transfer_mode, max_workers=transfer_workers)
+
+        # Build the interim directories as symlink trees into the store
+        blob_funcs.link_images_to_store(df_meta_train_val, path_blob_store,
+                                        path_interim_image_dir)
+        blob_funcs.link_images_to_store(df_meta_test, path_blob_store,
+                                        path_interim_test_image_dir)
+
+        # Keep the interim manifests (filename, class, hash) for the later stages
+        df_meta_train_val.to_csv(path_interim_dir / "manifest_train_val.csv",
+                                 index=False)
+        df_meta_test.to_csv(path_interim_dir / "manifest_test.csv", index=False)
+
+        # Report images with identical contents, e.g. the same photo in train and test
+        df_duplicates = blob_funcs.find_duplicates({"train_val": df_meta_train_val,
+                                                    "test": df_meta_test})
+        df_duplicates.to_csv(path_interim_dir / "duplicates.csv", index=False)
+        print(f"Found {df_duplicates['hash'].nunique()} duplicated images, "
+              f"see {path_interim_dir / 'duplicates.csv'}")
+
+    else:
+        # Train and validation data. Rerunning skips files already listed in the
+        # manifest.
+        funcs.transfer_raw_to_interim(df_meta_train_val, path_raw_image_dir,
+                                      path_interim_image_dir, mode=transfer_mode,
+                                      max_workers=transfer_workers,
+                                      path_manifest=(path_interim_dir
+                                                     / "transfers_train_val.txt"),
+                                      quarantine=quarantine)
+
+        # Test data
+        funcs.transfer_raw_to_interim(df_meta_test, path_raw_image_dir,
+                                      path_interim_test_image_dir, mode=transfer_mode,
+                                      max_workers=transfer_workers,
+                                      path_manifest=(path_interim_dir
+                                                     / "transfers_test.txt"),
+                                      quarantine=quarantine)
+
+    ## TODO: Transfer external data to interim
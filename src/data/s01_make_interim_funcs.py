@@ -3,8 +3,31 @@
 
 
 ## Import libraries
+import concurrent.futures
+import json
 import os
 import shutil
+import time
+
+import pandas as pd
+
+# For terminal from project root
+from hash_funcs import hash_bytes, hash_file
+
+# For pycharm
+# from src.data.hash_funcs import hash_bytes, hash_file
+
+# ioctl request code for cloning a file on copy-on-write filesystems (Linux)
+FICLONE = 0x40049409
+
+# Columns of interest in the raw metadata and their dtypes. There is a lot of
+# metadata, but we are only interested in species and image paths. Genus and epithet
+# repeat a lot, so categoricals keep them small.
+META_COLUMNS = ["genus", "specificEpithet", "image_path"]
+META_DTYPES = {"genus": "category", "specificEpithet": "category", "image_path": str}
+
+# Bump when filter_path_class_metadata() changes, so cached results are rebuilt
+META_FILTER_VERSION = 1
 
 
 ##
@@ -13,21 +36,22 @@ def filter_path_class_metadata(df_meta_raw, df_classes):
     Find image filenames from raw metadata for the classes of interest.
     This is a pre-step for transferring the images to the interim folder.
 
-    :param df_meta_raw: Dataframe with raw metadata
+    :param df_meta_raw: Dataframe with raw metadata (or a chunk of it)
     :param df_classes: Dataframe with mushroom classes
     :return: Dataframe with filename and class of each image
     """
 
-    # Choose columns of interest. There is a lot of metadata, but
-    # we are only interested in species and image paths.
-    df_meta = df_meta_raw.loc[:, ["genus", "specificEpithet", "image_path"]]
+    # Choose columns of interest
+    df_meta = df_meta_raw.loc[:, META_COLUMNS]
 
     # Rename image_path, since it actually contains filenames
     df_meta.rename(columns={"image_path": "image_filename"}, inplace=True)
 
     # Construct the species name (in the raw metadata "scientificName" has additional
-    # characters and "species" has NaNs)
-    df_meta["species"] = df_meta["genus"] + " " + df_meta["specificEpithet"]
+    # characters and "species" has NaNs). Categoricals do not support string
+    # concatenation, so they are joined as strings.
+    df_meta["species"] = (df_meta["genus"].astype(str) + " "
+                          + df_meta["specificEpithet"].astype(str))
 
     # Drop the columns used for constructing the species name
     df_meta = df_meta.drop(columns=["genus", "specificEpithet"])
@@ -45,6 +69,101 @@ def filter_path_class_metadata(df_meta_raw, df_classes):
     return df_meta
 
 
+##
+def read_filtered_metadata(path_meta, df_classes, chunksize=None):
+    """
+    Read raw metadata and filter it for the classes of interest. Only the needed
+    columns are parsed, with compact dtypes. With a chunksize the file is streamed, so
+    only one chunk of the raw metadata is in memory at a time.
+
+    :param path_meta: Path to raw metadata (csv)
+    :param df_classes: Dataframe with mushroom classes
+    :param chunksize: Number of rows per chunk. None reads the file at once.
+    :return: Dataframe with filename and class of each image, see
+        filter_path_class_metadata()
+    """
+    read_kwargs = dict(usecols=META_COLUMNS, dtype=META_DTYPES)
+
+    if chunksize is None:
+        df_meta = filter_path_class_metadata(pd.read_csv(path_meta, **read_kwargs),
+                                             df_classes)
+    else:
+        with pd.read_csv(path_meta, chunksize=chunksize, **read_kwargs) as reader:
+            df_meta = pd.concat([filter_path_class_metadata(df_chunk, df_classes)
+                                 for df_chunk in reader], ignore_index=True)
+
+    # Few classes, many rows
+    df_meta["species"] = df_meta["species"].astype("category")
+
+    return df_meta.reset_index(drop=True)
+
+
+##
+def hash_metadata_file(path_meta, path_stat_cache):
+    """
+    Hash a metadata file. The hash is cached together with the size and modification
+    time of the file, so an unchanged file is not read again.
+
+    :param path_meta: Path to metadata file
+    :param path_stat_cache: Path to hash cache (json)
+    :return: Hex digest of the file contents
+    """
+    stat = os.stat(path_meta)
+    stat_key = [stat.st_size, stat.st_mtime_ns]
+
+    # Fast path: the file was not touched since it was hashed
+    if path_stat_cache.is_file():
+        with open(path_stat_cache, "r") as f:
+            cached = json.load(f)
+        if cached["stat"] == stat_key:
+            return cached["hash"]
+
+    file_hash = hash_file(path_meta)
+    with open(path_stat_cache, "w") as f:
+        json.dump({"stat": stat_key, "hash": file_hash}, f)
+
+    return file_hash
+
+
+##
+def load_filtered_metadata(path_meta, df_classes, path_cache_dir, chunksize=100000):
+    """
+    Load filtered metadata from a Parquet cache, or read and filter the raw metadata
+    and cache the result. The cache is keyed by the hash of the metadata file, the
+    classes and the filter version, so any change to them rebuilds it.
+
+    :param path_meta: Path to raw metadata (csv)
+    :param df_classes: Dataframe with mushroom classes
+    :param path_cache_dir: Directory for the cached results
+    :param chunksize: Number of rows per chunk, see read_filtered_metadata()
+    :return: Dataframe with filename and class of each image
+    """
+    os.makedirs(path_cache_dir, exist_ok=True)
+
+    # Cache key
+    meta_hash = hash_metadata_file(
+        path_meta, path_cache_dir / f"{path_meta.stem}.hash.json")
+    classes_hash = hash_bytes(
+        "\n".join(sorted(df_classes["species"])).encode("utf-8"))
+    path_cache = (path_cache_dir / f"{path_meta.stem}_{meta_hash[:16]}_"
+                                   f"{classes_hash[:8]}_v{META_FILTER_VERSION}.parquet")
+
+    if path_cache.is_file():
+        print(f"Loading cached metadata: {path_cache}")
+        return pd.read_parquet(path_cache)
+
+    print(f"Filtering metadata: {path_meta}")
+    df_meta = read_filtered_metadata(path_meta, df_classes, chunksize=chunksize)
+
+    # Remove results cached for older versions of the file
+    for path_old in path_cache_dir.glob(f"{path_meta.stem}_*.parquet"):
+        os.remove(path_old)
+
+    df_meta.to_parquet(path_cache, index=False)
+
+    return df_meta
+
+
 ##
 def create_interim_folders(df_classes, path_interim_image_dir):
     """
@@ -69,65 +188,136 @@ def create_interim_folders(df_classes, path_interim_image_dir):
 
 
 ##
-def transfer_raw_to_interim(df_meta, path_raw_image_dir, path_interim_image_dir):
+def transfer_file(path_src, path_dst, mode="copy"):
+    """
+    Transfer a single file. The file is written under a temporary name and renamed
+    once complete, so an interrupted transfer never leaves a partial file behind.
+
+    :param path_src: Path to source file
+    :param path_dst: Path to destination file
+    :param mode: "copy" copies the bytes, "hardlink" links the destination to the same
+        inode (same filesystem only), "reflink" makes a copy-on-write clone (same
+        filesystem only, e.g. Btrfs or XFS), "symlink" creates a relative symbolic link
+        to the file that path_src resolves to
+    :return: Size of the file in bytes
     """
-    Transfer images from raw directory into interim. During the transfer, each image
-    is checked for corruption and only non-corrupted images are transferred.
+    path_tmp = path_dst.with_name(path_dst.name + ".part")
+
+    # Replace a stale link from an interrupted run
+    if mode in ("hardlink", "symlink") and os.path.lexists(path_tmp):
+        os.unlink(path_tmp)
+
+    if mode == "copy":
+        shutil.copyfile(src=path_src, dst=path_tmp)
+    elif mode == "hardlink":
+        os.link(path_src, path_tmp)
+    elif mode == "symlink":
+        # Relative, so the data directory can be moved as a whole
+        os.symlink(os.path.relpath(os.path.realpath(path_src), path_dst.parent),
+                   path_tmp)
+    elif mode == "reflink":
+        # Clone the file extents with the FICLONE ioctl (Linux only)
+        import fcntl
+        with open(path_src, "rb") as f_src, open(path_tmp, "wb") as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+    else:
+        raise ValueError(f"Unknown transfer mode: {mode}")
+
+    os.replace(path_tmp, path_dst)
+
+    return os.path.getsize(path_dst)
+
+
+##
+def load_transfer_manifest(path_manifest):
+    """
+    Load the set of files that a previous run already transferred.
+
+    :param path_manifest: Path to manifest file (one interim path per line)
+    :return: Set of transferred interim paths (relative to the interim image directory)
+    """
+    if not path_manifest.is_file():
+        return set()
+
+    with open(path_manifest, "r") as f:
+        return {row.rstrip("\n") for row in f}
+
+
+##
+def transfer_raw_to_interim(df_meta, path_raw_image_dir, path_interim_image_dir,
+                            mode="copy", max_workers=16, path_manifest=None,
+                            quarantine=None):
+    """
+    Transfer images from raw directory into interim with a pool of threads. Transferred
+    files are recorded in a manifest, so a rerun (e.g. after an interruption) skips the
+    files that are already done. Quarantined (corrupted) images are not transferred.
 
     :param df_meta: Dataframe with filename and class of each image
-    :param path_raw_dir: Path to raw directory
+    :param path_raw_image_dir: Path to raw image directory
     :param path_interim_image_dir: Path to interim image directory
+    :param mode: "copy", "hardlink" or "reflink", see transfer_file()
+    :param max_workers: Number of transfer threads. Network and SSD filesystems
+        benefit from more threads than there are cores, a single HDD from fewer.
+    :param path_manifest: Path to manifest file. Defaults to a file in the interim
+        image directory.
+    :param quarantine: Set of image filenames that failed verification and are not
+        transferred, see s01_verify_images_funcs.py
     """
-    # Copy image files to interim directory
-    for j, (image_name, image_class) in enumerate(
-            zip(df_meta["image_filename"], df_meta["species"])):
-        # Create path for the raw image
-        path_raw_image = path_raw_image_dir / image_name
-        # Create path for the interim image
-        path_interim_image = path_interim_image_dir / image_class / image_name
+    if path_manifest is None:
+        path_manifest = path_interim_image_dir / "transfer_manifest.txt"
 
-        # TODO: implement a robust corruption check (even though raw dataset
-        #  is known-good). PIL should be good enough.
-        # Check for corrupted images
-        # if verify_not_corrupted(path_raw_image):
+    # Skip the files that a previous run already transferred, and corrupted files
+    done = load_transfer_manifest(path_manifest)
+    quarantine = quarantine or set()
+    transfers = [(image_name, image_class)
+                 for image_name, image_class
+                 in zip(df_meta["image_filename"], df_meta["species"])
+                 if f"{image_class}/{image_name}" not in done
+                 and image_name not in quarantine]
+    print(f"Transferring {len(transfers)} files raw -> interim "
+          f"({len(df_meta) - len(transfers)} already done or quarantined, "
+          f"mode: {mode}).")
 
-        # Print progress
-        if ((j + 1) % 500 == 0):
-            print(f"Transferring file {j + 1} / {len(df_meta)}")
-        elif (j + 1) == len(df_meta):
-            print("File transfer raw -> interim complete.")
+    start = time.perf_counter()
+    n_files = 0
+    n_bytes = 0
 
-        # Copy files to the interim data directory
-        shutil.copyfile(src=path_raw_image,
-                        dst=path_interim_image)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            open(path_manifest, "a") as f_manifest:
+        # Keep a bounded number of transfers in flight, so hundreds of thousands of
+        # files do not turn into hundreds of thousands of pending futures
+        in_flight = {}
+        transfers_iter = iter(transfers)
 
+        while True:
+            # Top up the in-flight transfers
+            for image_name, image_class in transfers_iter:
+                path_interim_image = path_interim_image_dir / image_class / image_name
+                future = executor.submit(transfer_file, path_raw_image_dir / image_name,
+                                         path_interim_image, mode)
+                in_flight[future] = f"{image_class}/{image_name}"
+                if len(in_flight) >= max_workers * 4:
+                    break
 
-##
-# This function is slow, but the most reliable way to check if images look
-# corrupt to tensorflow
-# TODO: Rethink - currently not used since clunky and unclean.
-
-# import tensorflow as tf
-# from tensorflow.python.framework.errors_impl import InvalidArgumentError
-
-# def verify_not_corrupted(image_path):
-#     """
-#     Check that the input image can be imported by tensorflow.
-#
-#     :param image_path: Path to image to be checked
-#     :return: True if image is ok, False if image is corrupted
-#     """
-#
-#
-#     # Attempt to read the image file to a tensor. This is not the fastest or
-#     # cleanest approach, but in practice I have found it more reliable at
-#     # finding bizarre corruptions than other methods (e.g. PIL, cv2). Note, that
-#     # this does not catch the "Corrupt JPEG data" message, since it is technically
-#     # not an error (see https://github.com/tensorflow/models/issues/2194).
-#     try:
-#         img_tf = tf.io.read_file(str(image_path))
-#         tf.image.decode_jpeg(img_tf, channels=3)
-#         return True
-#     except (ValueError, InvalidArgumentError) as e:
-#         print(f"Bad file: {image_path}, \nError: {e}")
-#         return False
+            if not in_flight:
+                break
+
+            # Record finished transfers in the manifest
+            finished, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                n_bytes += future.result()
+                n_files += 1
+                f_manifest.write(in_flight.pop(future) + "\n")
+
+                # Print progress and throughput
+                if n_files % 500 == 0 or n_files == len(transfers):
+                    elapsed = time.perf_counter() - start
+                    print(f"Transferring file {n_files} / {len(transfers)} "
+                          f"({n_files / elapsed:.0f} files/s, "
+                          f"{n_bytes / elapsed / 1e6:.1f} MB/s)")
+
+            # Make the progress durable for a resumed run
+            f_manifest.flush()
+
+    print("File transfer raw -> interim complete.")
@@ -0,0 +1,252 @@
+# Functions for verifying that images are not corrupted before they are transferred to
+# interim. Used in s01_make_interim.py.
+
+
+## Import libraries
+import concurrent.futures
+import io
+import os
+
+import pandas as pd
+from PIL import Image
+
+# For terminal from project root
+from hash_funcs import hash_bytes
+
+# For pycharm
+# from src.data.hash_funcs import hash_bytes
+
+# JPEG start of image and end of image markers
+JPEG_SOI = b"\xff\xd8\xff"
+JPEG_EOI = b"\xff\xd9"
+
+# Columns of the verification cache
+CACHE_COLUMNS = ["image_filename", "size", "mtime_ns", "hash", "check", "ok",
+                 "reason"]
+
+
+##
+def check_jpeg_markers(img_bytes):
+    """
+    Cheap check for the most common corruption, a truncated JPEG: the file must start
+    with the start of image marker and end with the end of image marker. Corrupted
+    scan data between the markers goes unnoticed.
+
+    :param img_bytes: Image as byte data
+    :return: True if both markers are in place
+    """
+    # Some encoders pad the file after the end of image marker
+    return (img_bytes.startswith(JPEG_SOI)
+            and img_bytes.rstrip(b"\x00").endswith(JPEG_EOI))
+
+
+##
+def check_structure(img_bytes):
+    """
+    Check the file structure with Pillow's verify() without decoding the pixels.
+    Faster than a full decode, but does not catch all corruptions of the scan data.
+
+    :param img_bytes: Image as byte data
+    :return: Tuple (True if the structure is intact, reason for failure)
+    """
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            img.verify()
+        return True, ""
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+
+
+##
+def check_full_decode(img_bytes):
+    """
+    Decode all pixels of the image. Slowest, but catches corruptions that the markers
+    and the structure do not reveal.
+
+    :param img_bytes: Image as byte data
+    :return: Tuple (True if the image decodes, reason for failure)
+    """
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            img.load()
+        return True, ""
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+
+
+##
+def check_image(img_bytes, check="decode"):
+    """
+    Check an image for corruption.
+
+    :param img_bytes: Image as byte data
+    :param check: "decode" decodes all pixels. "verify" only checks the structure, see
+        check_structure(). "markers" is an opt-in fast path for JPEGs: images with
+        both markers pass without decoding, the others are fully decoded.
+    :return: Tuple (True if the image is intact, reason for failure)
+    """
+    if check == "decode":
+        return check_full_decode(img_bytes)
+    elif check == "verify":
+        return check_structure(img_bytes)
+    elif check == "markers":
+        if check_jpeg_markers(img_bytes):
+            return True, ""
+        return check_full_decode(img_bytes)
+    else:
+        raise ValueError(f"Unknown check {check!r}, use one of: decode, verify, "
+                         f"markers.")
+
+
+##
+def verify_image(path_image, cached_hash=None, cached_verdict=None, check="decode"):
+    """
+    Verify an image. If its contents are unchanged since the cached verification (same
+    hash, e.g. the file was only touched), the cached verdict is returned without
+    checking the image again. Runs in a worker process.
+
+    :param path_image: Path to image
+    :param cached_hash: Hash of the image contents in the cache, None if not cached
+    :param cached_verdict: Cached tuple (ok, reason), used if the hash matches
+    :param check: How to check the image, see check_image()
+    :return: Tuple (size, mtime_ns, hash, check, ok, reason)
+    """
+    stat = os.stat(path_image)
+    with open(path_image, "rb") as f:
+        img_bytes = f.read()
+    img_hash = hash_bytes(img_bytes)
+
+    if img_hash == cached_hash:
+        ok, reason = cached_verdict
+    else:
+        ok, reason = check_image(img_bytes, check)
+
+    return stat.st_size, stat.st_mtime_ns, img_hash, check, ok, reason
+
+
+##
+def load_verification_cache(path_cache):
+    """
+    Load the results of previous verification runs.
+
+    :param path_cache: Path to cache file (csv)
+    :return: Dataframe with CACHE_COLUMNS, indexed by image filename
+    """
+    if not path_cache.is_file():
+        return pd.DataFrame(columns=CACHE_COLUMNS).set_index("image_filename")
+
+    # Read "reason" as strings, so empty reasons are not turned into NaN
+    df_cache = pd.read_csv(path_cache, dtype={"hash": str, "reason": str},
+                           keep_default_na=False)
+
+    # Caches written before the check was configurable only checked the markers
+    if "check" not in df_cache.columns:
+        df_cache["check"] = "markers"
+
+    return df_cache[CACHE_COLUMNS].set_index("image_filename")
+
+
+##
+def verify_images(image_filenames, path_image_dir, path_cache, max_workers=None,
+                  check="decode"):
+    """
+    Verify images across all cores with a process pool. Results are cached per file:
+    files whose size and modification time match the cache are not read again, and
+    files whose contents (hash) match the cache are read and hashed, but not checked
+    again.
+
+    :param image_filenames: Image filenames to verify
+    :param path_image_dir: Path to image directory
+    :param path_cache: Path to cache file (csv), updated after the run
+    :param max_workers: Number of processes. None uses all cores.
+    :param check: How to check the images, see check_image()
+    :return: Dataframe with CACHE_COLUMNS for the given images, indexed by filename
+    """
+    df_cache = load_verification_cache(path_cache)
+
+    # Only verdicts of the same check are reused, e.g. a marker check does not count
+    # as a full decode
+    df_same_check = df_cache[df_cache["check"] == check]
+
+    # Plain dictionaries are much faster to look up than dataframe rows
+    cached_stats = dict(zip(df_same_check.index,
+                            zip(df_same_check["size"], df_same_check["mtime_ns"])))
+    cached_hashes = dict(zip(df_same_check.index, df_same_check["hash"]))
+    cached_verdicts = dict(zip(df_same_check.index,
+                               zip(df_same_check["ok"].astype(bool),
+                                   df_same_check["reason"])))
+
+    # Find the files that changed since they were cached
+    to_verify = []
+    for image_filename in image_filenames:
+        if image_filename in cached_stats:
+            stat = os.stat(path_image_dir / image_filename)
+            if cached_stats[image_filename] == (stat.st_size, stat.st_mtime_ns):
+                continue
+        to_verify.append(image_filename)
+
+    print(f"Verifying {len(to_verify)} images "
+          f"({len(image_filenames) - len(to_verify)} cached).")
+
+    # Verify in parallel. The workers get the cached hash and verdict, so files with
+    # unchanged contents are not checked again. Chunks keep the inter-process overhead
+    # low.
+    paths = [path_image_dir / image_filename for image_filename in to_verify]
+    hashes = [cached_hashes.get(image_filename) for image_filename in to_verify]
+    verdicts = [cached_verdicts.get(image_filename) for image_filename in to_verify]
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for j, (image_filename, result) in enumerate(
+                zip(to_verify, executor.map(verify_image, paths, hashes, verdicts,
+                                            [check] * len(paths), chunksize=64))):
+            results[image_filename] = result
+
+            # Print progress
+            if (j + 1) % 5000 == 0:
+                print(f"Verified {j + 1} / {len(to_verify)} images")
+
+    # Update the cache
+    if results:
+        df_new = pd.DataFrame.from_dict(results, orient="index",
+                                        columns=CACHE_COLUMNS[1:])
+        df_cache = pd.concat([df_cache.drop(index=list(results), errors="ignore"),
+                              df_new])
+        df_cache.index.name = "image_filename"
+        df_cache.to_csv(path_cache)
+
+    return df_cache.loc[list(image_filenames)]
+
+
+##
+def write_quarantine_list(df_verified, path_quarantine):
+    """
+    Write the filenames of corrupted images to a quarantine list, one per line.
+
+    :param df_verified: Dataframe returned by verify_images()
+    :param path_quarantine: Path to quarantine list
+    :return: Set of quarantined filenames
+    """
+    quarantine = set(df_verified.index[~df_verified["ok"].astype(bool)])
+
+    with open(path_quarantine, "w") as f:
+        for image_filename in sorted(quarantine):
+            f.write(image_filename + "\n")
+
+    print(f"Quarantined {len(quarantine)} corrupted images, see {path_quarantine}")
+
+    return quarantine
+
+
+##
+def load_quarantine_list(path_quarantine):
+    """
+    Load the filenames of quarantined images.
+
+    :param path_quarantine: Path to quarantine list
+    :return: Set of quarantined filenames (empty if the list does not exist)
+    """
+    if not path_quarantine.is_file():
+        return set()
+
+    with open(path_quarantine, "r") as f:
+        return {row.rstrip("\n") for row in f if row.strip()}
@@ -51,18 +51,46 @@ sr_classes = (df_mushroom_classes["species"]
               .str.lower())
 
 ## Transfer interim data to processed
-# TODO: Make a function for splitting data into subsets according to the distribution
-#  of each class. Use this to create train/validation/test in processed. Check the
-#  permutation idea from manning. But basically shuffle + split + copy
 
-# Train and validation data
-funcs.transfer_interim_to_processed(sr_classes, "train_and_validation",
-                                    path_interim_image_dir,
-                                    path_processed_dir)
+# "symlink" links processed into the blob store that interim points to (see
+# s01_make_interim.py), so no image is copied. Use "copy" for a standalone directory,
+# e.g. for uploading to Colab.
+transfer_mode = "symlink"
 
-# Test data
+# Train and validation are split per class into index files by s02_make_splits.py, so
+# they stay in one directory here.
+
+# Only touch the images that were added, removed or changed since the last run. Images
+# are named after their contents, so their names stay stable. Set to False to rebuild
+# from scratch with the {class}_{j}.jpg names.
+incremental_build = True
+
+# Interim test data
 # TODO: Remove this once test is mixed with the rest of the data in interim and
 #  the split function is implemented.
 path_interim_test_image_dir = path_interim_dir / "test"
-funcs.transfer_interim_to_processed(sr_classes, "test", path_interim_test_image_dir,
-                                    path_processed_dir)
+
+if incremental_build:
+    # Source -> destination manifests with content hashes
+    path_manifest_dir = path_processed_dir / "manifests"
+
+    # Train and validation data
+    funcs.build_processed_incremental(
+        sr_classes, "train_and_validation", path_interim_image_dir, path_processed_dir,
+        path_manifest_dir / "train_and_validation.csv", mode=transfer_mode)
+
+    # Test data
+    funcs.build_processed_incremental(
+        sr_classes, "test", path_interim_test_image_dir, path_processed_dir,
+        path_manifest_dir / "test.csv", mode=transfer_mode)
+
+else:
+    # Train and validation data
+    funcs.transfer_interim_to_processed(sr_classes, "train_and_validation",
+                                        path_interim_image_dir,
+                                        path_processed_dir, mode=transfer_mode)
+
+    # Test data
+    funcs.transfer_interim_to_processed(sr_classes, "test",
+                                        path_interim_test_image_dir,
+                                        path_processed_dir, mode=transfer_mode)
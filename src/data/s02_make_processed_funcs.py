@@ -3,12 +3,27 @@
 
 ## Import libraries
 import os
-import shutil
+
+import pandas as pd
+
+# For terminal from project root
+from hash_funcs import hash_file
+from s01_make_interim_funcs import transfer_file
+
+# For pycharm
+# from src.data.hash_funcs import hash_file
+# from src.data.s01_make_interim_funcs import transfer_file
+
+# Columns of the processed manifest
+MANIFEST_COLUMNS = ["species", "source", "destination", "hash", "size", "mtime_ns"]
+
+# Minimum number of images for a class to be included in processed
+MIN_CLASS_SIZE = 6
 
 
 ##
 def transfer_interim_to_processed(sr_classes, subset, path_interim_image_dir,
-                                  path_processed_dir):
+                                  path_processed_dir, mode="copy"):
     """
     Transfer images from interim directory into processed. During the transfer,
     each image is renamed to the {image_class}_{j}.jpg format.
@@ -17,6 +32,9 @@ def transfer_interim_to_processed(sr_classes, subset, path_interim_image_dir,
     :param subset: Subset to be transferred: "train", "validation" or "test" (not enforced)
     :param path_interim_image_dir: Path to interim image directory
     :param path_processed_dir: Path to processed directory
+    :param mode: "copy", "hardlink" or "symlink", see
+        s01_make_interim_funcs.transfer_file(). Links into the blob store avoid a
+        second copy of the dataset.
     """
     # Loop over classes
     for image_class in sr_classes:
@@ -29,17 +47,16 @@ def transfer_interim_to_processed(sr_classes, subset, path_interim_image_dir,
         # List files in origin class directory
         orig_fnames = os.listdir(orig_folder)
         # If the class has a reasonable number of files
-        if len(orig_fnames) > 5:
+        if len(orig_fnames) >= MIN_CLASS_SIZE:
 
             # Create the destination folder
             os.makedirs(dest_folder, exist_ok=True)
             # Build the destination filename
             dest_fnames = [f"{image_class}_{j}.jpg" for j in range(0, len(orig_fnames))]
 
-            # Copy files from origin to destination, rename
+            # Copy or link files from origin to destination, rename
             for orig_fname, dest_fname in zip(orig_fnames, dest_fnames):
-                shutil.copyfile(src=orig_folder / orig_fname,
-                                dst=dest_folder / dest_fname)
+                transfer_file(orig_folder / orig_fname, dest_folder / dest_fname, mode)
 
             # Report transfer progress
             print(f"Transfer interim -> processed complete "
@@ -49,3 +66,124 @@ def transfer_interim_to_processed(sr_classes, subset, path_interim_image_dir,
         else:
             print(f"Skip transfer for {image_class}, "
                   f"too little data ({len(orig_fnames)} files).")
+
+
+##
+def load_processed_manifest(path_manifest):
+    """
+    Load the manifest of a previous incremental build.
+
+    :param path_manifest: Path to manifest file (csv)
+    :return: Dataframe with MANIFEST_COLUMNS
+    """
+    if not path_manifest.is_file():
+        return pd.DataFrame(columns=MANIFEST_COLUMNS)
+
+    return pd.read_csv(path_manifest, dtype={"hash": str})
+
+
+##
+def scan_class_folder(orig_folder, cached_hashes):
+    """
+    Stat walk over an interim class folder. Files are hashed only if their size or
+    modification time differ from the previous build.
+
+    :param orig_folder: Path to interim class folder
+    :param cached_hashes: Dictionary that maps (source, size, mtime_ns) to the hash
+        computed in the previous build
+    :return: List of (source, hash, size, mtime_ns) tuples
+    """
+    sources = []
+    if not orig_folder.is_dir():
+        return sources
+
+    for entry in os.scandir(orig_folder):
+        # Leftovers of interrupted transfers
+        if entry.name.endswith(".part"):
+            continue
+
+        # Follows symlinks into the blob store
+        stat = entry.stat()
+        key = (entry.name, stat.st_size, stat.st_mtime_ns)
+        img_hash = cached_hashes.get(key)
+        if img_hash is None:
+            img_hash = hash_file(entry.path)
+        sources.append((entry.name, img_hash, stat.st_size, stat.st_mtime_ns))
+
+    return sources
+
+
+##
+def build_processed_incremental(sr_classes, subset, path_interim_image_dir,
+                                path_processed_dir, path_manifest, mode="copy"):
+    """
+    Incrementally build a processed subset from interim. Each image is named
+    {image_class}_{hash}.jpg after its contents, so names are stable across runs and
+    do not depend on the directory listing order. Only images that were added, removed
+    or changed are touched. A run without changes does no I/O beyond a stat walk.
+
+    :param sr_classes: Series with mushroom classes
+    :param subset: Subset to be built, e.g. "train_and_validation" or "test"
+    :param path_interim_image_dir: Path to interim image directory
+    :param path_processed_dir: Path to processed directory
+    :param path_manifest: Path to manifest file (csv) mapping sources to destinations
+    :param mode: "copy", "hardlink" or "symlink", see
+        s01_make_interim_funcs.transfer_file()
+    """
+    df_manifest = load_processed_manifest(path_manifest)
+
+    # Hashes of the previous build, keyed by source filename and stat
+    cached_hashes = {(source, size, mtime_ns): img_hash
+                     for source, size, mtime_ns, img_hash
+                     in zip(df_manifest["source"], df_manifest["size"],
+                            df_manifest["mtime_ns"], df_manifest["hash"])}
+
+    rows = []
+    for image_class in sr_classes:
+        orig_folder = path_interim_image_dir / image_class
+        dest_folder = path_processed_dir / subset / image_class
+
+        sources = scan_class_folder(orig_folder, cached_hashes)
+
+        # Desired destination files. Identical images in a class are kept once.
+        desired = {}
+        if len(sources) >= MIN_CLASS_SIZE:
+            for source, img_hash, size, mtime_ns in sources:
+                desired.setdefault(f"{image_class}_{img_hash[:16]}.jpg",
+                                   (source, img_hash, size, mtime_ns))
+        else:
+            print(f"Skip {image_class}, too little data ({len(sources)} files).")
+
+        # Files currently in processed
+        existing = set(os.listdir(dest_folder)) if dest_folder.is_dir() else set()
+
+        # Remove images that were removed or changed in interim
+        removed = existing - set(desired)
+        for dest_fname in removed:
+            os.unlink(dest_folder / dest_fname)
+
+        # Add new and changed images
+        added = set(desired) - existing
+        if added:
+            os.makedirs(dest_folder, exist_ok=True)
+        for dest_fname in added:
+            source = desired[dest_fname][0]
+            transfer_file(orig_folder / source, dest_folder / dest_fname, mode)
+
+        if added or removed:
+            print(f"Updated {image_class}: {len(added)} added, {len(removed)} removed, "
+                  f"{len(desired) - len(added)} unchanged.")
+
+        rows += [(image_class, source, dest_fname, img_hash, size, mtime_ns)
+                 for dest_fname, (source, img_hash, size, mtime_ns) in desired.items()]
+
+    # Only rewrite the manifest if something changed
+    df_new = (pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+              .sort_values(["species", "destination"], ignore_index=True))
+    df_old = df_manifest.sort_values(["species", "destination"], ignore_index=True)
+    if not df_new.astype(str).equals(df_old.astype(str)):
+        os.makedirs(path_manifest.parent, exist_ok=True)
+        df_new.to_csv(path_manifest, index=False)
+        print(f"Processed {subset} updated ({len(df_new)} images).")
+    else:
+        print(f"Processed {subset} is up to date ({len(df_new)} images).")
@@ -0,0 +1,53 @@
+# Splits the processed train and validation images with a stratified split, so every
+# class has the same validation fraction, and assigns them to stratified folds for
+# k-fold cross-validation. Only index files are written, no images are copied.
+# data_funcs.load_dataset() reads the splits with path_split (and fold).
+#
+# Run as a module from the project root: python -m src.data.s02_make_splits
+
+## Libraries
+import os
+import pathlib
+
+from src.model.data_funcs import list_image_files, stratified_k_fold, \
+    stratified_split, write_split
+
+## Paths
+
+# Processed data directory
+path_processed_dir = pathlib.Path(
+    "data/02_processed/"
+)
+
+# Training and validation data
+path_train_val_dir = path_processed_dir / "train_and_validation"
+
+# Split index files
+path_split_dir = path_processed_dir / "splits"
+
+## Settings
+
+# Matches the train/validation fraction in make_model_v1.py
+validation_fraction = 0.11
+
+# Number of folds for k-fold cross-validation
+n_folds = 5
+
+# A new split only needs a new seed
+seed = 666
+
+## Split data
+
+paths, labels, class_names = list_image_files(path_train_val_dir)
+validation_mask = stratified_split(labels, validation_fraction, seed=seed)
+folds = stratified_k_fold(labels, n_folds=n_folds, seed=seed)
+
+## Write split file
+
+os.makedirs(path_split_dir, exist_ok=True)
+path_split = path_split_dir / f"train_and_validation_seed{seed}.npz"
+write_split(path_split, path_train_val_dir, paths, labels, class_names,
+            validation_mask, folds)
+
+print(f"Wrote {path_split}: {len(paths)} images, {validation_mask.sum()} validation, "
+      f"{n_folds} folds")
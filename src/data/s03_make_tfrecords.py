@@ -0,0 +1,86 @@
+# Writes the processed images into sharded TFRecord files with pre-resized images and
+# integer labels. Training reads the shards with data_funcs.load_tfrecord_dataset(),
+# which is faster than decoding the original JPEGs every epoch and does not need the
+# whole dataset cached in memory.
+#
+# The shared preprocessing lives in the app directory, so run as a module from the
+# project root: python -m src.data.s03_make_tfrecords
+
+## Libraries
+import os
+import pathlib
+
+import numpy as np
+
+import src.data.s03_make_tfrecords_funcs as funcs
+from src.model.data_funcs import list_image_files, load_split, split_indices, \
+    split_train_validation
+
+## Paths
+
+# Processed data directory
+path_processed_dir = pathlib.Path(
+    "data/02_processed/"
+)
+
+# Training and validation data
+path_train_val_dir = path_processed_dir / "train_and_validation"
+
+# Test data
+path_test_dir = path_processed_dir / "test"
+
+# TFRecord directory
+path_tfrecord_dir = path_processed_dir / "tfrecords"
+
+## Settings
+
+# Model input size
+image_size = (224, 224)
+
+# Payload: "raw" keeps the tensors identical to the API, "jpeg" is about 10x smaller
+payload = "raw"
+
+# About 150 MB per shard with raw 224x224 payloads
+images_per_shard = 1000
+
+# Same train/validation split as data_funcs.load_dataset()
+train_val_split = 0.11
+seed = 666
+
+# Stratified split written by src/data/s02_make_splits.py, used if it exists
+path_split = path_processed_dir / "splits" / f"train_and_validation_seed{seed}.npz"
+
+## Split data
+
+if path_split.is_file():
+    split = load_split(path_split, path_image_dir=path_train_val_dir)
+    paths = np.array([str(path_train_val_dir / file) for file in split["files"]])
+    labels = split["labels"]
+    class_names = list(split["class_names"])
+    train_ix, validation_ix = split_indices(split)
+else:
+    paths, labels, class_names = list_image_files(path_train_val_dir)
+    train_ix, validation_ix = split_train_validation(len(paths), train_val_split,
+                                                     seed=seed)
+test_paths, test_labels, _ = list_image_files(path_test_dir)
+
+subsets = {
+    "train": (paths[train_ix], labels[train_ix]),
+    "validation": (paths[validation_ix], labels[validation_ix]),
+    "test": (test_paths, test_labels),
+}
+
+## Write TFRecords
+
+os.makedirs(path_tfrecord_dir, exist_ok=True)
+
+shards = {}
+for subset, (subset_paths, subset_labels) in subsets.items():
+    shards[subset] = funcs.write_tfrecord_subset(
+        subset, subset_paths, subset_labels, path_tfrecord_dir, image_size=image_size,
+        payload=payload, images_per_shard=images_per_shard)
+
+funcs.write_tfrecord_metadata(path_tfrecord_dir, class_names,
+                              {subset: len(subset_paths)
+                               for subset, (subset_paths, _) in subsets.items()},
+                              shards, image_size=image_size, payload=payload)
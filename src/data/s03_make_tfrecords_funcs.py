@@ -0,0 +1,144 @@
+# Functions for writing the processed images into sharded TFRecord files. Used in
+# s03_make_tfrecords.py.
+
+## Import libraries
+import concurrent.futures
+import io
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from app.app.preprocessing import preprocess_image_file
+from src.model.data_funcs import TFRECORD_METADATA_FILENAME
+
+
+##
+def encode_image(img_array, payload="raw"):
+    """
+    Encode a preprocessed image for the TFRecord payload.
+
+    :param img_array: Preprocessed image (float32 with integer pixel values)
+    :param payload: "raw" (uint8 pixels, lossless) or "jpeg" (smaller, lossy)
+    :return: Image as bytes
+    """
+    img_array = img_array.astype(np.uint8)
+
+    # Raw pixels keep the tensors identical to the API preprocessing
+    if payload == "raw":
+        return img_array.tobytes()
+
+    # JPEG shrinks the files about tenfold, but re-encoding changes the pixels slightly
+    buffer = io.BytesIO()
+    Image.fromarray(img_array).save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+##
+def write_shard(path_shard, paths, labels, image_size=(224, 224), payload="raw"):
+    """
+    Preprocess images and write them into one TFRecord shard.
+
+    :param path_shard: Path to the shard file
+    :param paths: Image paths
+    :param labels: Class index of each image
+    :param image_size: Size to resize the images to
+    :param payload: "raw" or "jpeg", see encode_image()
+    :return: Number of images written
+    """
+    with tf.io.TFRecordWriter(str(path_shard)) as writer:
+        for path_image, label in zip(paths, labels):
+            # Same preprocessing as the API
+            img_array = preprocess_image_file(path_image, image_size=image_size)
+
+            example = tf.train.Example(features=tf.train.Features(feature={
+                "image": tf.train.Feature(bytes_list=tf.train.BytesList(
+                    value=[encode_image(img_array, payload)])),
+                "label": tf.train.Feature(int64_list=tf.train.Int64List(
+                    value=[int(label)])),
+            }))
+            writer.write(example.SerializeToString())
+
+    return len(paths)
+
+
+##
+def write_tfrecord_subset(subset, paths, labels, path_tfrecord_dir,
+                          image_size=(224, 224), payload="raw", images_per_shard=1000,
+                          max_workers=None):
+    """
+    Write a subset into sharded TFRecord files. Shards are written in parallel threads
+    (decoding and resizing release the GIL) under temporary names and renamed once all
+    are written. Shards of the subset from earlier runs are deleted, so a different
+    shard count does not leave old images behind.
+
+    :param subset: Subset name used in the shard filenames, e.g. "train"
+    :param paths: Image paths
+    :param labels: Class index of each image
+    :param path_tfrecord_dir: Directory to write the shards to
+    :param image_size: Size to resize the images to
+    :param payload: "raw" or "jpeg", see encode_image()
+    :param images_per_shard: Number of images per shard
+    :param max_workers: Number of threads. None uses the Python default.
+    :return: Shard filenames in order, for write_tfrecord_metadata()
+    """
+    n_shards = max(1, int(np.ceil(len(paths) / images_per_shard)))
+    shard_filenames = [f"{subset}-{shard:05d}-of-{n_shards:05d}.tfrecord"
+                       for shard in range(n_shards)]
+
+    # Leftovers of an interrupted run
+    for path_tmp in path_tfrecord_dir.glob(f"{subset}-*.tfrecord.tmp"):
+        path_tmp.unlink()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for shard, shard_filename in enumerate(shard_filenames):
+            shard_slice = slice(shard * images_per_shard,
+                                (shard + 1) * images_per_shard)
+            path_shard = path_tfrecord_dir / (shard_filename + ".tmp")
+            futures.append(executor.submit(write_shard, path_shard, paths[shard_slice],
+                                           labels[shard_slice], image_size, payload))
+
+        # Report progress as shards finish, raise errors from the threads
+        n_written = 0
+        for future in concurrent.futures.as_completed(futures):
+            n_written += future.result()
+            print(f"Writing {subset} TFRecords: {n_written} / {len(paths)} images")
+
+    # Replace the shards of earlier runs
+    for path_shard in path_tfrecord_dir.glob(f"{subset}-*.tfrecord"):
+        path_shard.unlink()
+    for shard_filename in shard_filenames:
+        os.replace(path_tfrecord_dir / (shard_filename + ".tmp"),
+                   path_tfrecord_dir / shard_filename)
+
+    return shard_filenames
+
+
+##
+def write_tfrecord_metadata(path_tfrecord_dir, class_names, n_images, shards,
+                            image_size=(224, 224), payload="raw"):
+    """
+    Write the metadata that the TFRecord reader in data_funcs needs.
+
+    :param path_tfrecord_dir: TFRecord directory
+    :param class_names: Class names in label order
+    :param n_images: Dictionary with the number of images per subset
+    :param shards: Dictionary with the shard filenames per subset, the reader reads
+        exactly these files
+    :param image_size: Size the images were resized to
+    :param payload: "raw" or "jpeg", see encode_image()
+    """
+    metadata = {"payload": payload,
+                "image_size": list(image_size),
+                "class_names": list(class_names),
+                "n_images": n_images,
+                "shards": shards}
+
+    # Replace the file at once, a reader never sees half of it
+    path_metadata = path_tfrecord_dir / TFRECORD_METADATA_FILENAME
+    with open(path_metadata.with_suffix(".json.tmp"), "w") as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(path_metadata.with_suffix(".json.tmp"), path_metadata)
@@ -0,0 +1,122 @@
+# Benchmark epoch time and peak memory of the directory loader (cached in memory, as in
+# make_model_v1.py) against the TFRecord loader. Each loader runs in its own process,
+# so the peak memory is measured separately.
+#
+# Run as a module from the project root: python -m src.model.benchmark_data_loading
+
+## Imports
+import multiprocessing
+import pathlib
+import queue as queue_module
+import resource
+import time
+
+## Paths (relative to project root)
+
+# Processed data directory
+path_processed_dir = pathlib.Path("data/02_processed/")
+
+# Training and validation data
+path_train_val_dir = path_processed_dir / "train_and_validation"
+
+# Test data
+path_test_dir = path_processed_dir / "test"
+
+# TFRecord directory written by src/data/s03_make_tfrecords.py
+path_tfrecord_dir = path_processed_dir / "tfrecords"
+
+## Settings
+
+batch_size = 32
+
+# The first epoch fills the in-memory cache of the directory loader
+n_epochs = 3
+
+# Seconds a loader may run before it is stopped and reported as failed
+timeout_s = 3600
+
+
+## Functions
+
+def run_loader(loader_name, queue):
+    """
+    Iterate over the training set with a loader and report epoch times and peak memory.
+
+    :param loader_name: "directory" or "tfrecord"
+    :param queue: Queue for returning the results to the parent process
+    """
+    import tensorflow as tf
+
+    from src.model.data_funcs import load_dataset, load_tfrecord_dataset
+
+    if loader_name == "directory":
+        train_ds, _, _ = load_dataset(path_train_val_dir, path_test_dir,
+                                      train_val_split=0.11, batch_size=batch_size)
+        train_ds = train_ds.cache().prefetch(buffer_size=tf.data.AUTOTUNE)
+    else:
+        train_ds = load_tfrecord_dataset(path_tfrecord_dir, "train",
+                                         batch_size=batch_size, shuffle=True)
+        train_ds = train_ds.prefetch(buffer_size=tf.data.AUTOTUNE)
+
+    epoch_times = []
+    for _ in range(n_epochs):
+        start = time.perf_counter()
+        for _ in train_ds:
+            pass
+        epoch_times.append(time.perf_counter() - start)
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((loader_name, epoch_times, peak_memory_mb))
+
+
+def wait_for_result(process, queue, timeout_s):
+    """
+    Wait for the result of a loader process. A process that crashes (e.g. missing
+    TFRecords, out of memory) or runs into the timeout does not block the other
+    loader.
+
+    :param process: Started process.
+    :param queue: Queue the process puts its result into.
+    :param timeout_s: Seconds to wait for the result.
+    :return: Result tuple. The process is joined.
+    :raises RuntimeError: If the process exited without a result or timed out.
+    """
+    deadline = time.monotonic() + timeout_s
+    while True:
+        try:
+            result = queue.get(timeout=5)
+            break
+        except queue_module.Empty:
+            if not process.is_alive():
+                process.join()
+                raise RuntimeError(f"exit code {process.exitcode}")
+            if time.monotonic() > deadline:
+                process.terminate()
+                process.join()
+                raise RuntimeError(f"timed out after {timeout_s} s")
+
+    process.join()
+    return result
+
+
+## Run benchmark
+if __name__ == "__main__":
+    # Spawn fresh processes, so the loaders do not share memory or TensorFlow state
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+
+    print(f"{'loader':<12}{'first epoch s':>15}{'later epochs s':>16}{'peak MB':>10}")
+    for loader_name in ("directory", "tfrecord"):
+        process = context.Process(target=run_loader, args=(loader_name, queue))
+        process.start()
+        try:
+            name, epoch_times, peak_memory_mb = wait_for_result(process, queue,
+                                                                timeout_s)
+        except RuntimeError as e:
+            print(f"{loader_name:<12} failed ({e})")
+            continue
+
+        later_epochs = sum(epoch_times[1:]) / max(1, len(epoch_times) - 1)
+        print(f"{name:<12}{epoch_times[0]:>15.1f}{later_epochs:>16.1f}"
+              f"{peak_memory_mb:>10.0f}")
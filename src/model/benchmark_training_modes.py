@@ -0,0 +1,143 @@
+# Benchmark training of the baseline model with XLA compilation and bfloat16 mixed
+# precision against the float32 baseline. Each mode trains in its own process, since
+# the precision policy is global, and reports steps per second, epoch time and the
+# final validation accuracy.
+#
+# Run as a module from the project root: python -m src.model.benchmark_training_modes
+
+## Imports
+import multiprocessing
+import pathlib
+import queue as queue_module
+import time
+
+## Paths (relative to project root)
+
+# Processed data directory
+path_processed_dir = pathlib.Path("data/02_processed/")
+
+# Training and validation data
+path_train_val_dir = path_processed_dir / "train_and_validation"
+
+# Test data
+path_test_dir = path_processed_dir / "test"
+
+# Split written by src/data/s02_make_splits.py
+path_split = path_processed_dir / "splits" / "train_and_validation_seed666.npz"
+
+## Settings
+
+image_size = (224, 224)
+batch_size = 32
+
+# The first epoch includes tracing and XLA compilation
+n_epochs = 3
+
+# Training modes: (name, jit_compile, mixed_precision)
+modes = [
+    ("baseline", False, False),
+    ("xla", True, False),
+    ("bf16", False, True),
+    ("xla_bf16", True, True),
+]
+
+# Seconds a mode may train before it is stopped and reported as failed
+timeout_s = 4 * 3600
+
+
+## Functions
+
+def run_mode(name, jit_compile, mixed_precision, queue):
+    """
+    Train the model in one mode and report the timings and accuracy.
+
+    :param name: Name of the mode.
+    :param jit_compile: Compile the train step and the augmentation with XLA.
+    :param mixed_precision: Train with mixed_bfloat16.
+    :param queue: Queue for returning the results to the parent process
+    """
+    import tensorflow as tf
+
+    from src.model.data_funcs import augment_dataset, load_dataset
+    from src.model.model_funcs import StepTimer, build_model, compile_model, \
+        set_precision_policy
+
+    # Before building the model, the policy applies to new layers only
+    set_precision_policy(mixed_precision)
+
+    train_ds, validation_ds, _ = load_dataset(
+        path_train_val_dir, path_test_dir, train_val_split=0.11, image_size=image_size,
+        batch_size=batch_size, path_split=path_split if path_split.is_file() else None)
+    train_ds = augment_dataset(train_ds.cache(),
+                               jit_compile=jit_compile).prefetch(tf.data.AUTOTUNE)
+    validation_ds = validation_ds.cache().prefetch(tf.data.AUTOTUNE)
+
+    model = build_model(len(train_ds.class_names), image_size=image_size)
+    compile_model(model, jit_compile=jit_compile)
+
+    timer = StepTimer()
+    history = model.fit(train_ds, epochs=n_epochs, validation_data=validation_ds,
+                        callbacks=[timer], verbose=0)
+
+    queue.put((name, timer.epoch_times, timer.steps_per_second,
+               history.history["val_acc"][-1]))
+
+
+def wait_for_result(process, queue, timeout_s):
+    """
+    Wait for the result of a mode process. A process that crashes (e.g. XLA or bf16
+    not supported, out of memory) or runs into the timeout does not block the other
+    modes.
+
+    :param process: Started process.
+    :param queue: Queue the process puts its result into.
+    :param timeout_s: Seconds to wait for the result.
+    :return: Result tuple. The process is joined.
+    :raises RuntimeError: If the process exited without a result or timed out.
+    """
+    deadline = time.monotonic() + timeout_s
+    while True:
+        try:
+            result = queue.get(timeout=5)
+            break
+        except queue_module.Empty:
+            if not process.is_alive():
+                process.join()
+                raise RuntimeError(f"exit code {process.exitcode}")
+            if time.monotonic() > deadline:
+                process.terminate()
+                process.join()
+                raise RuntimeError(f"timed out after {timeout_s} s")
+
+    process.join()
+    return result
+
+
+## Run benchmark
+if __name__ == "__main__":
+    from src.model.model_funcs import bfloat16_supported
+
+    if not bfloat16_supported():
+        print("No native bfloat16 on this CPU, bf16 modes are emulated (slow)")
+
+    # Spawn fresh processes, so the precision policy and XLA caches are not shared
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+
+    print(f"{'mode':<10}{'first epoch s':>15}{'later epochs s':>16}{'steps/s':>9}"
+          f"{'val acc':>9}")
+    for mode in modes:
+        process = context.Process(target=run_mode, args=mode + (queue,))
+        process.start()
+        try:
+            name, epoch_times, steps_per_second, val_acc = wait_for_result(
+                process, queue, timeout_s)
+        except RuntimeError as e:
+            print(f"{mode[0]:<10} failed ({e})")
+            continue
+
+        # Steady state, without tracing and compilation in the first epoch
+        later_epochs = sum(epoch_times[1:]) / max(1, len(epoch_times) - 1)
+        later_steps = sum(steps_per_second[1:]) / max(1, len(steps_per_second) - 1)
+        print(f"{name:<10}{epoch_times[0]:>15.1f}{later_epochs:>16.1f}"
+              f"{later_steps:>9.1f}{val_acc:>9.3f}")
@@ -0,0 +1,112 @@
+# Check that the model sees identical tensors in training and serving. The training
+# inputs are read the way training reads them (the TFRecord shards written by
+# src/data/s03_make_tfrecords.py, or the directory loader if there are none), the
+# serving inputs are preprocessed with the resize backend and draft mode configured
+# for the API (app/app/settings.py, read from the same environment variables). Run
+# after changing the preprocessing or the API settings, before training or deploying.
+#
+# Also reports how far the tensors are from the TensorFlow resizing that training used
+# before the preprocessing was shared (tf.image.resize, as in
+# image_dataset_from_directory). Models trained back then see slightly different
+# inputs in serving.
+#
+# Run as a module from the project root: python -m src.model.check_preprocessing_parity
+
+## Imports
+import json
+import pathlib
+
+import numpy as np
+import tensorflow as tf
+
+from app.app import settings as api_settings
+from app.app.preprocessing import preprocess_image
+from src.model.data_funcs import TFRECORD_METADATA_FILENAME, list_image_files, \
+    make_image_dataset, parse_tfrecord_example
+
+## Paths (relative to project root)
+
+# Processed data directory
+path_processed_dir = pathlib.Path("data/02_processed/")
+
+# Test data
+path_test_dir = path_processed_dir / "test"
+
+# TFRecord directory written by src/data/s03_make_tfrecords.py
+path_tfrecord_dir = path_processed_dir / "tfrecords"
+
+## Settings
+
+image_size = (224, 224)
+
+# Number of images to compare
+n_images = 100
+
+## Training inputs
+
+paths, labels, _ = list_image_files(path_test_dir)
+
+# Spread the checked images over all classes
+indices = np.linspace(0, len(paths) - 1, num=min(n_images, len(paths)), dtype=int)
+
+if (path_tfrecord_dir / TFRECORD_METADATA_FILENAME).is_file():
+    with open(path_tfrecord_dir / TFRECORD_METADATA_FILENAME, "r") as f:
+        metadata = json.load(f)
+
+    # Read the shards in order: the test shards hold the images in the order of
+    # list_image_files()
+    path_shards = [str(path_tfrecord_dir / filename)
+                   for filename in metadata["shards"]["test"]]
+    test_ds = tf.data.TFRecordDataset(path_shards).map(
+        lambda example: parse_tfrecord_example(example, payload=metadata["payload"],
+                                               image_size=metadata["image_size"]))
+    selected = set(indices)
+    img_train = np.stack([img.numpy() for j, (img, _) in enumerate(test_ds)
+                          if j in selected])
+    source = f"TFRecords ({metadata['payload']} payload)"
+
+    # JPEG payloads are lossy, they cannot match exactly
+    exact = metadata["payload"] == "raw"
+else:
+    test_ds = make_image_dataset(paths[indices], labels[indices],
+                                 image_size=image_size, batch_size=1).unbatch()
+    img_train = np.stack([img.numpy() for img, _ in test_ds])
+    source = "directory loader"
+    exact = True
+
+paths = paths[indices]
+
+## Serving inputs
+
+# As the API decodes the uploaded bytes
+img_serve = np.stack([preprocess_image(pathlib.Path(path_image).read_bytes(),
+                                       image_size=image_size,
+                                       resize_backend=api_settings.RESIZE_BACKEND,
+                                       draft=api_settings.JPEG_DRAFT)
+                      for path_image in paths])
+
+# As training resized the images before the preprocessing was shared
+img_tf = np.stack([tf.image.resize(tf.io.decode_image(tf.io.read_file(path_image),
+                                                      channels=3,
+                                                      expand_animations=False),
+                                   image_size).numpy()
+                   for path_image in paths])
+
+## Compare
+
+print(f"Training inputs: {source}, serving: RESIZE_BACKEND="
+      f"{api_settings.RESIZE_BACKEND}, JPEG_DRAFT={api_settings.JPEG_DRAFT}")
+
+difference = np.abs(img_train - img_serve).reshape(len(paths), -1).max(axis=1)
+for path_image in paths[difference > 0]:
+    print(f"Mismatch for {path_image}")
+print(f"Training vs serving: {np.count_nonzero(difference)} / {len(paths)} images "
+      f"differ, max abs difference {difference.max():.1f}")
+
+difference_tf = np.abs(img_tf - img_serve)
+print(f"tf.image.resize vs serving: mean abs difference {difference_tf.mean():.2f}, "
+      f"max {difference_tf.max():.1f}")
+
+if exact:
+    assert not difference.any(), "Training and serving preprocessing differ"
+    print(f"Training and serving preprocessing are identical for {len(paths)} images.")
@@ -1,6 +1,8 @@
 # Functions for loading and plotting modeling data.
 
 ## Imports
+import json
+import pathlib
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -8,15 +10,304 @@ import pandas as pd
 import tensorflow as tf
 from seaborn import heatmap
 from sklearn.metrics import classification_report
-from tensorflow.keras.preprocessing import image_dataset_from_directory
+
+from app.app.preprocessing import preprocess_image_file
+
+# Image file types read from the processed directories
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Features of the TFRecord files written by src/data/s03_make_tfrecords.py
+TFRECORD_FEATURES = {
+    "image": tf.io.FixedLenFeature([], tf.string),
+    "label": tf.io.FixedLenFeature([], tf.int64),
+}
+
+# Metadata file (payload format, image size, class names) in the TFRecord directory
+TFRECORD_METADATA_FILENAME = "metadata.json"
 
 
 ## Functions
 
+def list_image_files(path_image_dir):
+    """
+    List the image files in a directory with one subdirectory per class. Files are
+    sorted, so the order (and the class indices) are the same on every run.
+
+    :param path_image_dir: Path to image directory.
+    :return: Numpy arrays with image paths and class indices, list of class names.
+    """
+    path_image_dir = pathlib.Path(path_image_dir)
+
+    # Class names are the sorted subdirectory names, like in image_dataset_from_directory
+    class_names = sorted(path.name for path in path_image_dir.iterdir() if path.is_dir())
+
+    paths = []
+    labels = []
+    for label, class_name in enumerate(class_names):
+        for path_image in sorted((path_image_dir / class_name).iterdir()):
+            if path_image.suffix.lower() in IMAGE_EXTENSIONS:
+                paths.append(str(path_image))
+                labels.append(label)
+
+    return np.array(paths), np.array(labels, dtype=np.int32), class_names
+
+
+def split_train_validation(n_images, train_val_split, seed=666):
+    """
+    Split image indices into train and validation with a seeded permutation.
+
+    :param n_images: Number of images.
+    :param train_val_split: Fraction of images to reserve for validation.
+    :param seed: Random seed for the split.
+    :return: Numpy arrays with train and validation indices.
+    """
+    permutation = np.random.RandomState(seed).permutation(n_images)
+    n_validation = int(train_val_split * n_images)
+
+    return permutation[:n_images - n_validation], permutation[n_images - n_validation:]
+
+
+def rank_within_class(labels, seed=666):
+    """
+    Give each image a random rank within its class (0, 1, ... n_class_images - 1).
+    Vectorised: one permutation and one stable sort, no loop over classes.
+
+    :param labels: Class index of each image.
+    :param seed: Random seed for the ranks.
+    :return: Numpy array with the rank of each image.
+    """
+    labels = np.asarray(labels)
+    permutation = np.random.RandomState(seed).permutation(len(labels))
+
+    # A stable sort by label keeps the shuffled order within each class
+    order = permutation[np.argsort(labels[permutation], kind="stable")]
+
+    # Position in the sorted order minus the position where the class starts
+    counts = np.bincount(labels)
+    starts = np.cumsum(counts) - counts
+    ranks = np.empty(len(labels), dtype=np.int64)
+    ranks[order] = np.arange(len(labels)) - np.repeat(starts, counts)
+
+    return ranks
+
+
+def stratified_split(labels, validation_fraction, seed=666):
+    """
+    Split images into train and validation so that each class is split with the same
+    fraction.
+
+    :param labels: Class index of each image.
+    :param validation_fraction: Fraction of each class to reserve for validation.
+    :param seed: Random seed for the split.
+    :return: Boolean numpy array, True for validation images.
+    """
+    labels = np.asarray(labels)
+    ranks = rank_within_class(labels, seed=seed)
+    n_validation = np.floor(validation_fraction * np.bincount(labels)).astype(np.int64)
+
+    return ranks < n_validation[labels]
+
+
+def stratified_k_fold(labels, n_folds=5, seed=666):
+    """
+    Assign images to k folds so that each class is spread evenly over the folds.
+
+    :param labels: Class index of each image.
+    :param n_folds: Number of folds.
+    :param seed: Random seed for the assignment.
+    :return: Numpy array with the fold of each image.
+    """
+    return (rank_within_class(labels, seed=seed) % n_folds).astype(np.int8)
+
+
+def write_split(path_split, path_image_dir, paths, labels, class_names,
+                validation_mask, folds):
+    """
+    Write a split index file (.npz). The file stores the image paths relative to the
+    image directory, labels and the subset of each image, so the loaders need neither
+    to list the directory nor to copy images into subset directories. The number of
+    images per class is stored for checking the split against the directory, see
+    load_split().
+
+    :param path_split: Path to split file.
+    :param path_image_dir: Image directory that the paths are relative to.
+    :param paths: Image paths.
+    :param labels: Class index of each image.
+    :param class_names: Class names in label order.
+    :param validation_mask: Boolean array, True for validation images, see
+        stratified_split().
+    :param folds: Fold of each image, see stratified_k_fold().
+    """
+    path_image_dir = pathlib.Path(path_image_dir)
+    files = np.array([str(pathlib.Path(path).relative_to(path_image_dir))
+                      for path in paths])
+
+    labels = np.asarray(labels, dtype=np.int32)
+    np.savez(path_split, files=files, labels=labels,
+             class_names=np.array(class_names), validation=validation_mask,
+             folds=folds, class_counts=np.bincount(labels, minlength=len(class_names)))
+
+
+def load_split(path_split, path_image_dir=None):
+    """
+    Load a split index file written with write_split(). Given the image directory, the
+    split is checked against it, so a split that is stale after the processed images
+    were rebuilt fails here instead of in the middle of an epoch.
+
+    :param path_split: Path to split file.
+    :param path_image_dir: Image directory that the paths are relative to. None skips
+        the check.
+    :return: Dictionary with files, labels, class_names, validation, folds and
+        class_counts arrays.
+    :raises ValueError: If the split does not match the images in path_image_dir.
+    """
+    with np.load(path_split) as split:
+        split = {key: split[key] for key in split.files}
+
+    if path_image_dir is not None:
+        check_split(split, path_image_dir, path_split)
+
+    return split
+
+
+def check_split(split, path_image_dir, path_split="split"):
+    """
+    Check that a split lists exactly the images in the image directory.
+
+    :param split: Split loaded with load_split().
+    :param path_image_dir: Image directory that the paths are relative to.
+    :param path_split: Name of the split file for the error message.
+    :raises ValueError: If images were added, removed, renamed or moved to another
+        class since the split was written.
+    """
+    path_image_dir = pathlib.Path(path_image_dir)
+    paths, labels, class_names = list_image_files(path_image_dir)
+    files = {str(pathlib.Path(path).relative_to(path_image_dir)) for path in paths}
+    split_files = set(split["files"])
+
+    if files == split_files and class_names == list(split["class_names"]):
+        return
+
+    # Name the classes that changed, split files written before the counts were
+    # stored only report the file differences
+    changed = []
+    if "class_counts" in split:
+        split_counts = dict(zip(split["class_names"], split["class_counts"]))
+        counts = dict(zip(class_names, np.bincount(labels,
+                                                   minlength=len(class_names))))
+        changed = [class_name for class_name in sorted(set(split_counts) | set(counts))
+                   if split_counts.get(class_name) != counts.get(class_name)]
+
+    raise ValueError(f"{path_split} does not match {path_image_dir}: "
+                     f"{len(split_files - files)} images of the split are missing, "
+                     f"{len(files - split_files)} images are not in the split"
+                     + (f", changed classes: {', '.join(changed)}" if changed else "")
+                     + ". Rerun src/data/s02_make_splits.py.")
+
+
+def split_indices(split, fold=None):
+    """
+    Train and validation indices of a split.
+
+    :param split: Split loaded with load_split().
+    :param fold: Fold used for validation in k-fold cross-validation. None uses the
+        train/validation split.
+    :return: Numpy arrays with train and validation indices.
+    """
+    if fold is None:
+        validation_mask = split["validation"]
+    else:
+        validation_mask = split["folds"] == fold
+
+    return np.flatnonzero(~validation_mask), np.flatnonzero(validation_mask)
+
+
+def make_augmentation():
+    """
+    Image augmentation for training.
+
+    :return: Sequential model with the augmentation layers.
+    """
+    return tf.keras.Sequential([
+        # No vertical flip, mushroom pictures are usually not upside down
+        tf.keras.layers.experimental.preprocessing.RandomFlip("horizontal"),
+        tf.keras.layers.experimental.preprocessing.RandomRotation(0.1),
+        tf.keras.layers.experimental.preprocessing.RandomZoom(0.2)
+    ], name="data_augmentation")
+
+
+def augment_dataset(ds, augmentation=None, jit_compile=False):
+    """
+    Augment batches in the input pipeline with parallel calls. Apply after .cache(),
+    so every epoch sees new augmentations, and before .prefetch(), so the augmentation
+    overlaps the train step instead of running inside it.
+
+    :param ds: Dataset of (image batch, label batch).
+    :param augmentation: Augmentation model. None uses make_augmentation().
+    :param jit_compile: Compile the augmentation with XLA, like the train step with
+        model_funcs.compile_model(jit_compile=True).
+    :return: Dataset of (augmented image batch, label batch).
+    """
+    if augmentation is None:
+        augmentation = make_augmentation()
+
+    @tf.function(jit_compile=jit_compile)
+    def augment(images):
+        return augmentation(images, training=True)
+
+    return ds.map(lambda images, labels: (augment(images), labels),
+                  num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def load_image(path_image, image_size=(224, 224)):
+    """
+    Read and preprocess an image inside a tf.data pipeline with the preprocessing shared
+    with the API.
+
+    :param path_image: String tensor with the path to the image.
+    :param image_size: Size to resize the image to.
+    :return: Float32 image tensor.
+    """
+    img = tf.numpy_function(
+        lambda path: preprocess_image_file(path.decode(), image_size=image_size),
+        [path_image], tf.float32)
+    # numpy_function loses the static shape
+    img.set_shape(tuple(image_size) + (3,))
+
+    return img
+
+
+def make_image_dataset(paths, labels, image_size=(224, 224), batch_size=32,
+                       shuffle=False, seed=None):
+    """
+    Build a batched dataset that reads and preprocesses the images in parallel.
+
+    :param paths: Image paths.
+    :param labels: Class index of each image.
+    :param image_size: Size to resize images to after they are read from disk.
+    :param batch_size: Size of the batches of data.
+    :param shuffle: Should the images be shuffled (every epoch).
+    :param seed: Random seed for shuffling.
+    :return: Dataset of (image batch, label batch).
+    """
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+
+    # Shuffle paths before reading, the buffer of paths is cheap to hold in memory
+    if shuffle:
+        ds = ds.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+
+    ds = ds.map(lambda path, label: (load_image(path, image_size), label),
+                num_parallel_calls=tf.data.AUTOTUNE)
+
+    return ds.batch(batch_size)
+
+
 def load_dataset(path_train_val_dir, path_test_dir, train_val_split, seed=666,
-                 image_size=(224, 224), batch_size=32):
+                 image_size=(224, 224), batch_size=32, path_split=None, fold=None):
     """
-    Load train, validation and test datasets from processed directory.
+    Load train, validation and test datasets from processed directory. The images are
+    preprocessed with the same functions as in the API, so training and serving see
+    identical tensors.
 
     :param path_train_val_dir: Path to train/validation directory.
     :param path_test_dir: Path to test directory.
@@ -24,42 +315,122 @@ def load_dataset(path_train_val_dir, path_test_dir, train_val_split, seed=666,
     :param seed: Random seed for train/validation split.
     :param image_size: Size to resize images to after they are read from disk.
     :param batch_size: Size of the batches of data.
-    :return: Train, validation and test datasets.
+    :param path_split: Path to a split file written by src/data/s02_make_splits.py.
+        If given, the images and the split are read from it (train_val_split is
+        ignored). None lists the directory and splits with split_train_validation().
+    :param fold: Validation fold for k-fold cross-validation, requires path_split.
+        None uses the stratified train/validation split of the file.
+    :return: Train, validation and test datasets. Each has the class names in the
+        class_names attribute.
     """
-    # TODO: Currently assumes that train and validation data are in the same directory
-    #  and split with this function. Once they have been pre-split to processed,
-    #  change this functionality to load them from separate directories.
+    if fold is not None and path_split is None:
+        raise ValueError("fold requires path_split, the folds are stored in the split "
+                         "file.")
+
+    # Split train and validation images
+    if path_split is not None:
+        split = load_split(path_split, path_image_dir=path_train_val_dir)
+        paths = np.array([str(pathlib.Path(path_train_val_dir) / file)
+                          for file in split["files"]])
+        labels = split["labels"]
+        class_names = list(split["class_names"])
+        train_ix, validation_ix = split_indices(split, fold=fold)
+    else:
+        paths, labels, class_names = list_image_files(path_train_val_dir)
+        train_ix, validation_ix = split_train_validation(len(paths), train_val_split,
+                                                         seed=seed)
 
     # Load train dataset
-    train_dataset = image_dataset_from_directory(
-        path_train_val_dir,
-        validation_split=train_val_split,
-        subset="training",
-        seed=seed,
-        image_size=image_size,
-        batch_size=batch_size
-    )
+    train_dataset = make_image_dataset(paths[train_ix], labels[train_ix],
+                                       image_size=image_size, batch_size=batch_size,
+                                       shuffle=True, seed=seed)
 
     # Load validation dataset
-    validation_dataset = image_dataset_from_directory(
-        path_train_val_dir,
-        validation_split=train_val_split,
-        subset="validation",
-        seed=seed,
-        image_size=image_size,
-        batch_size=batch_size
-    )
+    validation_dataset = make_image_dataset(paths[validation_ix], labels[validation_ix],
+                                            image_size=image_size,
+                                            batch_size=batch_size)
 
     # Load test dataset
-    test_dataset = image_dataset_from_directory(
-        path_test_dir,
-        image_size=image_size,
-        batch_size=batch_size
-    )
+    test_paths, test_labels, _ = list_image_files(path_test_dir)
+    test_dataset = make_image_dataset(test_paths, test_labels, image_size=image_size,
+                                      batch_size=batch_size)
+
+    for dataset in (train_dataset, validation_dataset, test_dataset):
+        dataset.class_names = class_names
 
     return train_dataset, validation_dataset, test_dataset
 
 
+def parse_tfrecord_example(serialized_example, payload="raw", image_size=(224, 224)):
+    """
+    Parse and decode one image written by src/data/s03_make_tfrecords.py.
+
+    :param serialized_example: Serialized tf.train.Example.
+    :param payload: Image payload format: "raw" (uint8 pixels) or "jpeg".
+    :param image_size: Size the images were resized to before writing.
+    :return: Float32 image tensor and int32 label.
+    """
+    features = tf.io.parse_single_example(serialized_example, TFRECORD_FEATURES)
+
+    if payload == "raw":
+        img = tf.io.decode_raw(features["image"], tf.uint8)
+        img = tf.reshape(img, tuple(image_size) + (3,))
+    else:
+        img = tf.io.decode_jpeg(features["image"], channels=3)
+        img.set_shape(tuple(image_size) + (3,))
+
+    return tf.cast(img, tf.float32), tf.cast(features["label"], tf.int32)
+
+
+def load_tfrecord_dataset(path_tfrecord_dir, subset, batch_size=32, shuffle=False,
+                          shuffle_buffer_size=2048, seed=None):
+    """
+    Build a batched dataset from the TFRecord shards of a subset. Shards are read
+    interleaved and decoded in parallel, so there is no need to .cache() the whole
+    dataset in memory.
+
+    :param path_tfrecord_dir: Directory written by src/data/s03_make_tfrecords.py.
+    :param subset: Subset to load: "train", "validation" or "test".
+    :param batch_size: Size of the batches of data.
+    :param shuffle: Should the shard order and the images be shuffled (every epoch).
+    :param shuffle_buffer_size: Number of images in the shuffle buffer.
+    :param seed: Random seed for shuffling.
+    :return: Dataset of (image batch, label batch) with the class names in the
+        class_names attribute.
+    """
+    path_tfrecord_dir = pathlib.Path(path_tfrecord_dir)
+
+    # Payload format, image size and class names are stored next to the shards
+    with open(path_tfrecord_dir / TFRECORD_METADATA_FILENAME, "r") as f:
+        metadata = json.load(f)
+
+    # Read exactly the shards of the last run, not whatever matches a pattern
+    if "shards" not in metadata:
+        raise ValueError(f"{path_tfrecord_dir} has no shard list, rerun "
+                         f"src/data/s03_make_tfrecords.py.")
+    files = tf.data.Dataset.from_tensor_slices(
+        [str(path_tfrecord_dir / filename) for filename in metadata["shards"][subset]])
+    if shuffle:
+        files = files.shuffle(len(metadata["shards"][subset]), seed=seed,
+                              reshuffle_each_iteration=True)
+    # Read several shards at once. Order does not matter when shuffling.
+    ds = files.interleave(tf.data.TFRecordDataset,
+                          num_parallel_calls=tf.data.AUTOTUNE,
+                          deterministic=not shuffle)
+
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer_size, seed=seed, reshuffle_each_iteration=True)
+
+    ds = ds.map(lambda example: parse_tfrecord_example(
+        example, payload=metadata["payload"], image_size=metadata["image_size"]),
+                num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.batch(batch_size)
+
+    ds.class_names = metadata["class_names"]
+
+    return ds
+
+
 def plot_loss_accuracy(model_history=None, from_logs=False, path_training_logs=None):
     """
     Plot model loss and accuracy metrics from history object or from training logs.
@@ -130,60 +501,131 @@ def plot_loss_accuracy(model_history=None, from_logs=False, path_training_logs=N
     # plt.savefig("loss_accuracy.png")
 
 
-def find_predicted_true(model, ds):
+def evaluate_model(model, ds):
     """
-    Get predicted and true labels by looping over batches of the dataset.
+    Run one inference pass over the dataset and keep the logits, predicted labels and
+    true labels. The outputs are written into preallocated arrays (grown by doubling
+    if the dataset turns out larger), so there is no reallocation per batch. The
+    metrics below are computed from the result without running the model again.
+
+    :param model: Trained model (or any object with a predict() method returning logits)
+    :param ds: Dataset of (image batch, label batch).
+    :return: Dictionary with "logits", "predicted_labels" and "true_labels" arrays.
+    """
+    # Keras models: predict_on_batch skips the per-call setup of predict()
+    predict = getattr(model, "predict_on_batch", model.predict)
+
+    logits = None
+    true_labels = None
+    n_images = 0
+    for data_batch, label_batch in ds:
+        batch_logits = np.asarray(predict(data_batch))
+        batch_size = len(batch_logits)
+
+        # Allocate once the output size is known, sized from the number of batches
+        if logits is None:
+            n_batches = int(ds.cardinality())
+            capacity = batch_size * n_batches if n_batches > 0 else 1024
+            logits = np.empty((capacity, batch_logits.shape[1]), dtype=np.float32)
+            true_labels = np.empty(capacity, dtype=np.int32)
+
+        # Grow geometrically if the capacity was underestimated
+        if n_images + batch_size > len(logits):
+            capacity = max(2 * len(logits), n_images + batch_size)
+            logits = np.resize(logits, (capacity, logits.shape[1]))
+            true_labels = np.resize(true_labels, capacity)
+
+        logits[n_images:n_images + batch_size] = batch_logits
+        true_labels[n_images:n_images + batch_size] = label_batch
+        n_images += batch_size
+
+    if logits is None:
+        raise ValueError("The dataset is empty")
+
+    logits = logits[:n_images]
+    return {"logits": logits,
+            "predicted_labels": np.argmax(logits, axis=1).astype(np.int32),
+            "true_labels": true_labels[:n_images]}
+
+
+def find_predicted_true(model, ds, evaluation=None):
+    """
+    Get predicted and true labels of the dataset.
 
     :param model: Trained model used for predictions
     :param ds: Dataset for which to find predicted labels and true labels.
+    :param evaluation: Result of evaluate_model(). If given, model and ds are not used.
     :return: Predicted and true labels
     """
+    if evaluation is None:
+        evaluation = evaluate_model(model, ds)
 
-    # Initialize predicted and true labels
-    predicted_labels = np.array([])
-    true_labels = np.array([])
+    return evaluation["predicted_labels"], evaluation["true_labels"]
 
-    # Find predicted and true labels by looping over batches of data
-    for data_batch, label_batch in ds:
-        prediction = np.argmax(tf.nn.softmax(model.predict(data_batch)), axis=1)
-        predicted_labels = np.append(predicted_labels, prediction)
-        true_labels = np.append(true_labels, label_batch)
 
-    return predicted_labels, true_labels
+def compute_top_k_accuracy(model, ds, k=3, evaluation=None):
+    """
+    Compute the top-k accuracy of a model on the dataset.
+
+    :param model: Trained model (or any object with a predict() method returning logits)
+    :param ds: Dataset for which to compute the accuracy.
+    :param k: Number of highest-ranked predictions that count as correct.
+    :param evaluation: Result of evaluate_model(). If given, model and ds are not used.
+    :return: Top-k accuracy as a fraction.
+    """
+    if evaluation is None:
+        evaluation = evaluate_model(model, ds)
+
+    logits = evaluation["logits"]
+    k = min(k, logits.shape[1])
 
+    # Partial sort: the k highest logits of each image, in any order
+    top_k = np.argpartition(-logits, k - 1, axis=1)[:, :k]
+    in_top_k = np.any(top_k == evaluation["true_labels"][:, np.newaxis], axis=1)
 
-def create_confusion_matrix(model, ds):
+    return float(np.mean(in_top_k))
+
+
+def create_confusion_matrix(model, ds, evaluation=None):
     """
     Compute a confusion matrix based on a trained model and a dataset object.
 
     :param model: Trained model.
     :param ds: Dataset for which to plot predicted labels and true labels.
+    :param evaluation: Result of evaluate_model(). If given, model and ds are not used.
     :return: Confusion matrix computed for the dataset.
     """
 
+    if evaluation is None:
+        evaluation = evaluate_model(model, ds)
+
     # Find predicted and true labels from the dataset
-    predicted_labels, true_labels = find_predicted_true(model, ds)
+    predicted_labels, true_labels = find_predicted_true(model, ds, evaluation)
 
-    # Compute the confusion matrix
-    confusion_matrix = tf.math.confusion_matrix(true_labels, predicted_labels).numpy()
+    # Compute the confusion matrix. Classes missing from the dataset still get a row.
+    confusion_matrix = tf.math.confusion_matrix(
+        true_labels, predicted_labels,
+        num_classes=evaluation["logits"].shape[1]).numpy()
 
     return confusion_matrix
 
 
-def create_class_report(model, ds, classes):
+def create_class_report(model, ds, classes, evaluation=None):
     """
     Create a classification report based on a trained model and a dataset object.
 
     :param model: Trained model.
     :param ds: Dataset for which to create classification report.
-    :param classes:
-    :return:
+    :param classes: Class names in label order.
+    :param evaluation: Result of evaluate_model(). If given, model and ds are not used.
+    :return: Classification report as a string.
     """
     # Find predicted and true labels from the dataset
-    predicted_labels, true_labels = find_predicted_true(model, ds)
+    predicted_labels, true_labels = find_predicted_true(model, ds, evaluation)
 
-    # Compute the classification report
-    class_report = classification_report(predicted_labels, true_labels,
+    # Compute the classification report (true labels first)
+    class_report = classification_report(true_labels, predicted_labels,
+                                         labels=np.arange(len(classes)),
                                          target_names=classes, zero_division=0)
 
     return class_report
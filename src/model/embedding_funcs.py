@@ -0,0 +1,229 @@
+# Functions for training the classifier head on cached backbone embeddings. The frozen
+# backbone runs once over the dataset (optionally over several augmented views of each
+# image), and the pooled embeddings are stored in a memory-mapped array on disk. The
+# head then trains on the embeddings in minutes instead of running the backbone every
+# epoch.
+
+## Imports
+import hashlib
+import inspect
+import json
+import os
+import pathlib
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+import app.app.preprocessing
+from src.model.data_funcs import make_augmentation, make_image_dataset
+
+# Bump when compute_embeddings() changes, so cached embeddings are rebuilt
+EMBEDDING_VERSION = 1
+
+
+## Functions
+
+def build_backbone(image_size=(224, 224)):
+    """
+    Frozen MobileNetV2 feature extractor with the same input scaling and pooling as the
+    model in make_model_v1.py.
+
+    :param image_size: Model input size (height, width).
+    :return: Model that maps float32 images with pixel values [0, 255] to pooled
+        embeddings.
+    """
+    image_shape = tuple(image_size) + (3,)
+    base_model = keras.applications.MobileNetV2(input_shape=image_shape,
+                                                include_top=False,
+                                                weights="imagenet")
+    base_model.trainable = False
+
+    inputs = keras.Input(shape=image_shape)
+    # Rescale images for MobileNetV2, which expects image scale [-1, 1]
+    x = keras.applications.mobilenet_v2.preprocess_input(inputs)
+    # Set training to False due to the batch normalization layers
+    x = base_model(x, training=False)
+    outputs = keras.layers.GlobalAveragePooling2D()(x)
+
+    return keras.Model(inputs, outputs, name="backbone")
+
+
+def build_head(embedding_dim, num_classes, dropout=0.2):
+    """
+    Classifier head trained on the embeddings: dropout and a dense layer with logits.
+
+    :param embedding_dim: Size of the embeddings.
+    :param num_classes: Number of output classes.
+    :param dropout: Dropout rate.
+    :return: Head model.
+    """
+    return keras.Sequential([
+        keras.Input(shape=(embedding_dim,)),
+        keras.layers.Dropout(dropout),
+        keras.layers.Dense(num_classes)
+    ], name="head")
+
+
+def attach_head(backbone, head, image_size=(224, 224)):
+    """
+    Combine the backbone and a trained head into a model that takes images, e.g. for
+    saving and exporting. The model has no augmentation layers.
+
+    :param backbone: Backbone from build_backbone().
+    :param head: Trained head from build_head().
+    :param image_size: Model input size (height, width).
+    :return: Model that maps images to logits.
+    """
+    inputs = keras.Input(shape=tuple(image_size) + (3,))
+    outputs = head(backbone(inputs, training=False))
+
+    return keras.Model(inputs, outputs)
+
+
+def embedding_cache_key(backbone, paths, image_size, n_views, seed):
+    """
+    Hash everything that determines the embeddings: backbone weights, the shared
+    preprocessing code, the images (path, size and modification time) and the
+    augmentation code and settings. Any change gives a new key, so stale embeddings
+    are never reused, also after the processed images were rebuilt under the same
+    names.
+
+    :param backbone: Backbone from build_backbone().
+    :param paths: Image paths.
+    :param image_size: Model input size (height, width).
+    :param n_views: Number of views per image, see compute_embeddings().
+    :param seed: Random seed for the augmented views.
+    :return: Hex digest.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+
+    for weights in backbone.get_weights():
+        hasher.update(weights.tobytes())
+
+    hasher.update(inspect.getsource(app.app.preprocessing).encode("utf-8"))
+
+    # The augmented views depend on the augmentation layers
+    if n_views > 1:
+        hasher.update(inspect.getsource(make_augmentation).encode("utf-8"))
+
+    for path in paths:
+        stat = os.stat(path)
+        hasher.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    hasher.update(json.dumps([list(image_size), n_views, seed,
+                              EMBEDDING_VERSION]).encode("utf-8"))
+
+    return hasher.hexdigest()
+
+
+def compute_embeddings(backbone, paths, path_cache_dir, image_size=(224, 224),
+                       batch_size=64, n_views=1, seed=666):
+    """
+    Run the backbone over the images and store the embeddings in a memory-mapped .npy
+    file. View 0 is the plain image, views 1, ..., n_views - 1 are augmented with
+    make_augmentation(). Embeddings already cached under the same key are loaded
+    instead.
+
+    :param backbone: Backbone from build_backbone().
+    :param paths: Image paths.
+    :param path_cache_dir: Directory for the embedding files.
+    :param image_size: Model input size (height, width).
+    :param batch_size: Number of images per backbone call.
+    :param n_views: Number of views per image.
+    :param seed: Random seed for the augmented views.
+    :return: Read-only memory-mapped array with shape (n_views, n_images,
+        embedding_dim).
+    """
+    path_cache_dir = pathlib.Path(path_cache_dir)
+    os.makedirs(path_cache_dir, exist_ok=True)
+
+    key = embedding_cache_key(backbone, paths, image_size, n_views, seed)
+    path_embeddings = path_cache_dir / f"embeddings_{key}.npy"
+
+    if path_embeddings.is_file():
+        print(f"Loading cached embeddings: {path_embeddings}")
+        return np.load(path_embeddings, mmap_mode="r")
+
+    # Write under a temporary name, so an interrupted run leaves no valid cache behind
+    path_partial = path_cache_dir / f"embeddings_{key}.part.npy"
+    embedding_dim = backbone.output_shape[-1]
+    embeddings = np.lib.format.open_memmap(
+        path_partial, mode="w+", dtype=np.float32,
+        shape=(n_views, len(paths), embedding_dim))
+
+    ds = make_image_dataset(paths, np.zeros(len(paths), dtype=np.int32),
+                            image_size=image_size, batch_size=batch_size)
+    ds = ds.prefetch(tf.data.AUTOTUNE)
+
+    augmentation = make_augmentation()
+    tf.random.set_seed(seed)
+
+    # Fixed input signature, so the last (smaller) batch does not retrace
+    @tf.function(input_signature=[tf.TensorSpec((None,) + tuple(image_size) + (3,),
+                                                tf.float32)])
+    def embed_augmented(images):
+        return backbone(augmentation(images, training=True), training=False)
+
+    for view in range(n_views):
+        start = 0
+        for images, _ in ds:
+            if view == 0:
+                batch_embeddings = backbone(images, training=False)
+            else:
+                batch_embeddings = embed_augmented(images)
+            # Write the batch straight into the preallocated file
+            embeddings[view, start:start + len(images)] = batch_embeddings.numpy()
+            start += len(images)
+        print(f"Computed embeddings for view {view + 1} / {n_views}")
+
+    embeddings.flush()
+    del embeddings
+    os.replace(path_partial, path_embeddings)
+
+    return np.load(path_embeddings, mmap_mode="r")
+
+
+def make_embedding_dataset(embeddings, labels, batch_size=256, shuffle=False,
+                           seed=None, image_ix=None):
+    """
+    Build a batched dataset of (embedding batch, label batch). Only indices go through
+    tf.data, the embeddings are gathered from the memory-mapped array per batch, so
+    the array is never copied into memory as a whole. Every view of every image is an
+    example.
+
+    :param embeddings: Array with shape (n_views, n_images, embedding_dim).
+    :param labels: Class index of each image.
+    :param batch_size: Size of the batches of data.
+    :param shuffle: Should the examples be shuffled (every epoch).
+    :param seed: Random seed for shuffling.
+    :param image_ix: Indices of the images to use, e.g. the training images of a fold.
+        None uses all images.
+    :return: Dataset of (embedding batch, label batch).
+    """
+    n_views, _, embedding_dim = embeddings.shape
+    labels = np.asarray(labels, dtype=np.int32)
+    if image_ix is None:
+        image_ix = np.arange(embeddings.shape[1])
+    n_images = len(image_ix)
+
+    def gather(ix):
+        # Sorted reads are sequential on disk
+        ix = np.sort(ix)
+        view, image = np.divmod(ix, n_images)
+        image = image_ix[image]
+        return np.asarray(embeddings[view, image], dtype=np.float32), labels[image]
+
+    ds = tf.data.Dataset.range(n_views * n_images)
+    if shuffle:
+        ds = ds.shuffle(n_views * n_images, seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+
+    def gather_batch(ix):
+        batch_embeddings, batch_labels = tf.numpy_function(gather, [ix],
+                                                           [tf.float32, tf.int32])
+        # numpy_function loses the static shape
+        batch_embeddings.set_shape((None, embedding_dim))
+        batch_labels.set_shape((None,))
+        return batch_embeddings, batch_labels
+
+    return ds.map(gather_batch, num_parallel_calls=tf.data.AUTOTUNE)
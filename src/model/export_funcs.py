@@ -0,0 +1,32 @@
+# Functions for exporting trained models for serving. The serving function is the one
+# the API builds (app/app/model_funcs.py), so exported and served models compute the
+# same outputs.
+
+## Imports
+
+import tensorflow as tf
+
+from app.app.model_funcs import build_serving_function
+
+
+## Functions
+
+def export_serving_model(model, path_export, image_size=(224, 224), top_k=3):
+    """
+    Export a model as a SavedModel whose "serving_default" signature returns the top k
+    scores and class indices. The app loads it by pointing MODEL_PATH to path_export.
+
+    :param model: Trained model that outputs logits.
+    :param path_export: Directory to write the SavedModel to.
+    :param image_size: Model input size (height, width).
+    :param top_k: Number of results to return, ranked by highest confidence score.
+    """
+    serving_function = build_serving_function(model, image_size=image_size, top_k=top_k)
+
+    # Attach the function to a module that tracks the model variables
+    module = tf.Module()
+    module.model = model
+    module.serving_function = serving_function
+
+    tf.saved_model.save(module, str(path_export),
+                        signatures={"serving_default": serving_function})
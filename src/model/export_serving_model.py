@@ -0,0 +1,33 @@
+# Export a trained model as a SavedModel for the app. The exported serving signature
+# returns softmax-normalised top k scores and class indices.
+
+## Imports
+import pathlib
+
+import tensorflow as tf
+
+from src.model.export_funcs import export_serving_model
+
+## Paths (relative to project root)
+
+# Model name
+model_name = "mushi_identifier_v1"
+
+# Model directory
+path_model_dir = pathlib.Path("models/")
+
+# Trained model
+path_saved_model = path_model_dir / (model_name + ".keras")
+
+# Exported serving model
+path_serving_model = path_model_dir / (model_name + "_serving")
+
+## Export
+
+model = tf.keras.models.load_model(path_saved_model)
+
+# Number of predictions returned per image, same as the app default
+top_k = 3
+
+export_serving_model(model, path_serving_model, image_size=(224, 224), top_k=top_k)
+print(f"Exported serving model to {path_serving_model}")
@@ -16,8 +16,11 @@ import matplotlib.pyplot as plt
 import tensorflow as tf
 from tensorflow import keras
 
-from src.model.data_funcs import load_dataset, create_confusion_matrix, \
-    plot_confusion_matrix, plot_loss_accuracy
+from src.model.data_funcs import load_dataset, augment_dataset, \
+    compute_top_k_accuracy, create_class_report, create_confusion_matrix, \
+    evaluate_model, load_tfrecord_dataset, make_augmentation, plot_confusion_matrix, \
+    plot_loss_accuracy
+from src.model.model_funcs import set_precision_policy
 
 ## Paths (relative to project root)
 
@@ -42,6 +45,13 @@ path_train_val_dir = path_processed_dir / "train_and_validation"
 # Test data
 path_test_dir = path_processed_dir / "test"
 
+# Stratified train/validation split and k-fold folds, written by
+# src/data/s02_make_splits.py
+path_split = path_processed_dir / "splits" / "train_and_validation_seed666.npz"
+
+# Sharded TFRecords written by src/data/s03_make_tfrecords.py
+path_tfrecord_dir = path_processed_dir / "tfrecords"
+
 # Training logs directory
 path_training_logs = path_model_dir / "training_logs" / (
         model_name + "_training_logs.csv")
@@ -52,8 +62,20 @@ path_model_class_names = path_model_dir / (model_name + "_classes.csv")
 # Saved model
 path_saved_model = path_model_dir / (model_name + ".keras")
 
+## Training mode
+
+# Compile the train step and the augmentation with XLA
+jit_compile = False
+
+# Compute in bfloat16, keep the variables in float32. Only faster on CPUs with native
+# bfloat16 (see model_funcs.bfloat16_supported()). Compare the modes with
+# benchmark_training_modes.py.
+mixed_precision = False
+
+# Must be set before the layers are created
+set_precision_policy(mixed_precision)
+
 ## Import data
-# TODO: Implement k-fold cross validation
 
 # MobileNetV2 max is 224 in Keras Danish Fungi authors used (299, 299) - possible
 # performance hit. Also makes the file size of our processed set feel unnecessarily big.
@@ -65,10 +87,31 @@ batch_size = 32
 
 # This is roughly a 80-10-10 split for the data. The Danish Fungi article used 10 %
 # test data so we are matching validation dataset to that. But this is obviously too
-# little, and we should implement k-fold cross-validation to get reliable validation
-# scores.
-train_ds, validation_ds, test_ds = load_dataset(path_train_val_dir, path_test_dir,
-                                                train_val_split=0.11)
+# little, so for reliable validation scores train once per fold (0, ..., 4) of the
+# split file. None uses its stratified train/validation split, or a random split of
+# the directory if src/data/s02_make_splits.py has not been run.
+fold = None
+
+# Read the pre-resized TFRecord shards instead of decoding the JPEGs. The shards are
+# streamed from disk every epoch, so the dataset is not cached in memory. They hold
+# the stratified split they were written with, so folds need the directory loader.
+use_tfrecords = False
+
+if use_tfrecords:
+    if fold is not None:
+        raise ValueError("The TFRecords hold one train/validation split, set "
+                         "use_tfrecords = False to train on a fold.")
+    train_ds, validation_ds, test_ds = (
+        load_tfrecord_dataset(path_tfrecord_dir, subset, batch_size=batch_size,
+                              shuffle=subset == "train", seed=666)
+        for subset in ("train", "validation", "test"))
+else:
+    if fold is not None and not path_split.is_file():
+        raise FileNotFoundError(f"Training on fold {fold} needs the split file "
+                                f"{path_split}, run src/data/s02_make_splits.py first.")
+    train_ds, validation_ds, test_ds = load_dataset(
+        path_train_val_dir, path_test_dir, train_val_split=0.11, batch_size=batch_size,
+        path_split=path_split if path_split.is_file() else None, fold=fold)
 
 ## Classes
 
@@ -94,33 +137,35 @@ for images, labels in train_ds.take(1):
         plt.title(train_ds.class_names[labels[j]])
         plt.axis("off")
 
+## Augment images
+# TODO: add more augmentation (?)
+
+data_augmentation = make_augmentation()
+
 ## Configure datasets for performance
 
 # .cache() keeps the images in memory after they are loaded off disk during the first epoch.
+# The TFRecords are cheap to read, so they are not cached.
+# Augmentation runs after the cache in parallel map calls, so it is not cached and not
+# part of the model (the saved model needs no augmentation layers for serving).
 # .prefetch() overlaps data preprocessing and model execution while training.
 
 AUTOTUNE = tf.data.AUTOTUNE
-train_ds = train_ds.cache().prefetch(buffer_size=AUTOTUNE)
-validation_ds = validation_ds.cache().prefetch(buffer_size=AUTOTUNE)
-
-## Augment images
-# TODO: add more augmentation (?)
-
-data_augmentation = keras.Sequential([
-    # No vertical flip, mushroom pictures are usually not upside down
-    keras.layers.experimental.preprocessing.RandomFlip("horizontal"),
-    keras.layers.experimental.preprocessing.RandomRotation(0.1),
-    keras.layers.experimental.preprocessing.RandomZoom(0.2)
-])
+if not use_tfrecords:
+    train_ds = train_ds.cache()
+    validation_ds = validation_ds.cache()
+train_ds = augment_dataset(train_ds, data_augmentation,
+                           jit_compile=jit_compile).prefetch(buffer_size=AUTOTUNE)
+validation_ds = validation_ds.prefetch(buffer_size=AUTOTUNE)
 
 ## View some augmented images
 
+# The training images are augmented in the pipeline
 plt.figure(figsize=(10, 10))
-for images, _ in train_ds.take(1):
+for augmented_images, _ in train_ds.take(1):
     for j in range(4):
-        augmented_images = data_augmentation(images)
         ax = plt.subplot(2, 2, j + 1)
-        plt.imshow(augmented_images[0].numpy().astype("uint8"))
+        plt.imshow(augmented_images[j].numpy().astype("uint8"))
         plt.axis("off")
 
 ## Load the base model used for feature extraction
@@ -140,9 +185,8 @@ base_model.trainable = False
 num_classes = len(class_names)
 
 inputs = keras.Input(shape=image_shape)
-x = data_augmentation(inputs)
 # Rescale images for MobileNetV2, which expects image scale [-1, 1]
-x = keras.applications.mobilenet_v2.preprocess_input(x)
+x = keras.applications.mobilenet_v2.preprocess_input(inputs)
 # Set training to False due to the batch normalization layers
 x = base_model(x, training=False)
 # Global pooling is better than flatten for small datasets. See:
@@ -150,7 +194,8 @@ x = base_model(x, training=False)
 x = keras.layers.GlobalAveragePooling2D()(x)
 # TODO: Tune the dropout
 x = keras.layers.Dropout(0.2)(x)
-outputs = keras.layers.Dense(num_classes)(x)
+# Logits in float32 under mixed precision, so the softmax and loss stay stable
+outputs = keras.layers.Dense(num_classes, dtype="float32")(x)
 
 model = keras.Model(inputs, outputs)
 
@@ -198,6 +243,17 @@ callbacks = [
     )
 ]
 
+## Profile input pipeline
+
+# Profile batches 10-20 of the first epoch for TensorBoard. In the trace viewer, the
+# train step should not wait for input (see the input pipeline analysis).
+profile = False
+
+if profile:
+    callbacks += [keras.callbacks.TensorBoard(
+        log_dir=path_model_dir / "logs" / (model_name + "_profile"),
+        profile_batch=(10, 20))]
+
 ## Compile model
 
 # TODO: Tune learning rate
@@ -205,7 +261,8 @@ learning_rate = 0.001
 
 model.compile(loss=keras.losses.SparseCategoricalCrossentropy(from_logits=True),
               optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
-              metrics=metrics)
+              metrics=metrics,
+              jit_compile=jit_compile)
 
 ## Colab tensorboard
 
@@ -242,5 +299,12 @@ plot_loss_accuracy(model_history)
 
 ## Plot confusion matrix
 
-cm = create_confusion_matrix(model, validation_ds)
+# One inference pass, the metrics below reuse its logits
+evaluation = evaluate_model(model, validation_ds)
+
+cm = create_confusion_matrix(model, validation_ds, evaluation=evaluation)
 plot_confusion_matrix(cm, class_names, normalize=False)
+
+print(create_class_report(model, validation_ds, class_names, evaluation=evaluation))
+print(f"Top-3 accuracy: "
+      f"{compute_top_k_accuracy(model, validation_ds, k=3, evaluation=evaluation):.3f}")
@@ -1,64 +1,55 @@
-# Create predictions with the trained model
-
-import pathlib
+# Predict the classes of many images with the trained model. Accepts a directory, a
+# glob pattern or a CSV manifest and writes the top k predictions per image to a CSV
+# file or a Parquet directory. Rerunning with the same output resumes where the
+# previous run stopped.
+#
+# Run as a module from the project root, e.g.:
+# python -m src.model.make_predictions "data/field_photos" predictions.csv
+# python -m src.model.make_predictions "photos/**/*.jpg" predictions.parquet
+# python -m src.model.make_predictions manifest.csv predictions.csv --column path
 
 ## Imports
-import numpy as np
-import tensorflow as tf
-
-## Paths
-# Model directory
-path_model_dir = pathlib.Path(
-    "/home/jpe/Documents/python_projects/mushi-identifier/models/"
-)
-
-## Load model
-model = tf.keras.models.load_model(path_model_dir / "mushi_identifier_v1.keras")
-
-## Load classes
-
-# Could easily do this with pandas, but don't need to import anything this way
-path_classes = path_model_dir / "classes_mushi_identifier_v1.csv"
-with open(path_classes, "r") as f:
-    classes = [row.rstrip("\n") for row in f]
-
-# Drop header
-classes = classes[1:]
-
-## Load image
-# TODO: make this cleaner, now just for testing and show
-
-# Path to image
-img_path = "/home/jpe/Documents/python_projects/mushi-identifier/data/00_external/2018_FGVCx_Fungi/interim_done/cantharellus_cibarius/APE2017-9196936_BkzOiYFVZ.JPG"
-
-# Load, resize image
-img = tf.keras.preprocessing.image.load_img(
-    img_path, target_size=(224, 224, 3)
-)
-
-## Preprocess image (mobilenet preprocessing attached to model though,
-# so just PIL -> array -> batches here)
-img_array = tf.keras.preprocessing.image.img_to_array(img)
-img_array = tf.expand_dims(img_array, 0)
-
-## Create prediction
-prediction = model.predict(img_array)
-
-## Apply softmax to calculate confidences, since not done in model output layer
-prediction_softmax = tf.nn.softmax(prediction)
+import argparse
+import pathlib
 
-# Create ordered prediction indices and confidences
-pred_indices = np.flip(np.argsort(prediction_softmax).flatten()).tolist()
-pred_confidences = prediction_softmax.numpy().flatten().tolist()
+import pandas as pd
 
-## Save top 3 results to dictionary
-pred_classes_top3 = [classes[ix] for ix in pred_indices][:3]
-pred_confidences_top3 = [pred_confidences[ix] for ix in pred_indices][:3]
+from app.app.model_funcs import load_serving_function
+from src.model.predict_funcs import list_input_images, predict_images
 
-predictions_top3 = dict(zip(pred_classes_top3, pred_confidences_top3))
+## Paths (relative to project root)
 
-## Print top 3 results
-print("-Top 3 predictions-", end="\n\n")
-# Dictionaries are ordered in python 3.7+, so this is safe
-for cls, conf in predictions_top3.items():
-    print(f"Prediction: {cls} \nConfidence: {conf:.3f}", end="\n\n")
+# Model directory
+path_model_dir = pathlib.Path("models/")
+
+## Arguments
+parser = argparse.ArgumentParser(description="Predict mushroom classes of images.")
+parser.add_argument("source",
+                    help="Image directory, glob pattern or CSV manifest")
+parser.add_argument("output",
+                    help="Output .csv file or Parquet directory (e.g. out.parquet)")
+parser.add_argument("--column", default="image_path",
+                    help="Column with the image paths in a CSV manifest")
+parser.add_argument("--model",
+                    default=str(path_model_dir / "mushi_identifier_v1.keras"),
+                    help="Keras model, SavedModel directory or .tflite file")
+parser.add_argument("--classes",
+                    default=str(path_model_dir / "classes_mushi_identifier_v1.csv"),
+                    help="CSV file with the class names (species column)")
+parser.add_argument("--top-k", type=int, default=3,
+                    help="Number of predictions per image")
+parser.add_argument("--batch-size", type=int, default=64,
+                    help="Number of images per inference call")
+parser.add_argument("--decode-workers", type=int, default=None,
+                    help="Number of decode threads (default: number of cores)")
+args = parser.parse_args()
+
+## Load model and classes
+serving_function = load_serving_function(args.model, image_size=(224, 224),
+                                         top_k=args.top_k)
+classes = pd.read_csv(args.classes)["species"].tolist()
+
+## Predict
+paths = list_input_images(args.source, column=args.column)
+predict_images(serving_function, paths, classes, args.output,
+               batch_size=args.batch_size, decode_workers=args.decode_workers)
@@ -0,0 +1,75 @@
+# Convert the trained model to quantized TensorFlow Lite models (dynamic range,
+# float16 and int8) and compare their accuracy to the original model. The app can
+# serve any of the variants by pointing MODEL_PATH to the .tflite file.
+
+## Imports
+import pathlib
+
+import tensorflow as tf
+
+from src.model.data_funcs import load_dataset
+from src.model.quantize_funcs import QUANTIZATION_MODES, TFLiteModel, \
+    convert_to_tflite, evaluate_models, make_representative_dataset
+
+## Paths (relative to project root)
+
+# Model name
+model_name = "mushi_identifier_v1"
+
+# Processed data directory
+path_processed_dir = pathlib.Path("data/02_processed/")
+
+# Model directory
+path_model_dir = pathlib.Path("models/")
+
+# Training and validation data
+path_train_val_dir = path_processed_dir / "train_and_validation"
+
+# Test data
+path_test_dir = path_processed_dir / "test"
+
+# Trained model
+path_saved_model = path_model_dir / (model_name + ".keras")
+
+## Settings
+
+image_size = (224, 224)
+
+# Number of predictions returned per image, same as the app default
+top_k = 3
+
+# Number of training images used to calibrate the int8 quantization
+n_calibration_samples = 200
+
+## Load model and data
+
+model = tf.keras.models.load_model(path_saved_model)
+
+# Evaluate on the test set, calibrate on training images
+_, _, test_ds = load_dataset(path_train_val_dir, path_test_dir, train_val_split=0.11,
+                             image_size=image_size)
+representative_dataset = make_representative_dataset(
+    path_train_val_dir, n_samples=n_calibration_samples, image_size=image_size)
+
+## Convert
+
+models = {"keras_float32": model}
+for mode in QUANTIZATION_MODES:
+    path_tflite = path_model_dir / f"{model_name}_{mode}.tflite"
+
+    tflite_model = convert_to_tflite(model, mode,
+                                     representative_dataset=representative_dataset,
+                                     image_size=image_size, top_k=top_k)
+    path_tflite.write_bytes(tflite_model)
+    print(f"Saved {path_tflite} ({len(tflite_model) / 1e6:.1f} MB)")
+
+    models[mode] = TFLiteModel(path_tflite)
+
+## Evaluate accuracy parity
+
+results = evaluate_models(models, test_ds)
+
+print(f"{'model':<16}{'top-1':>8}{'delta':>8}{'top-3':>8}{'delta':>8}")
+for result in results:
+    print(f"{result['model']:<16}{result['top1_acc']:>8.3f}{result['top1_delta']:>+8.3f}"
+          f"{result['top3_acc']:>8.3f}{result['top3_delta']:>+8.3f}")
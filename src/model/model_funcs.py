@@ -0,0 +1,109 @@
+# Functions for building and compiling the baseline model with optional XLA
+# compilation and bfloat16 mixed precision.
+
+## Imports
+import time
+
+from tensorflow import keras
+
+from src.model.data_funcs import make_augmentation
+from src.model.embedding_funcs import build_backbone
+
+
+## Functions
+
+def bfloat16_supported():
+    """
+    Check if the CPU computes bfloat16 natively (AVX512_BF16 or AMX). Without it,
+    mixed_bfloat16 is emulated and slower than float32.
+
+    :return: True if the CPU flags list bfloat16 support (Linux only).
+    """
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = f.read()
+    except OSError:
+        return False
+
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def set_precision_policy(mixed_precision=False):
+    """
+    Set the global Keras dtype policy. Must be called before the model is built.
+
+    :param mixed_precision: Compute in bfloat16 and keep the variables in float32.
+    """
+    if mixed_precision and not bfloat16_supported():
+        print("No native bfloat16 on this CPU, mixed precision is emulated and slower "
+              "than float32")
+
+    policy = "mixed_bfloat16" if mixed_precision else "float32"
+    keras.mixed_precision.set_global_policy(policy)
+
+
+def build_model(num_classes, image_size=(224, 224), dropout=0.2, augmentation=False):
+    """
+    Build the baseline model of make_model_v1.py: frozen MobileNetV2, dropout and a
+    dense layer with logits.
+
+    :param num_classes: Number of output classes.
+    :param image_size: Model input size (height, width).
+    :param dropout: Dropout rate.
+    :param augmentation: Include the augmentation layers in the model. By default the
+        augmentation runs in the input pipeline (data_funcs.augment_dataset()), so the
+        saved model has no augmentation layers.
+    :return: Model that maps images to logits.
+    """
+    inputs = keras.Input(shape=tuple(image_size) + (3,))
+    x = make_augmentation()(inputs) if augmentation else inputs
+    x = build_backbone(image_size)(x, training=False)
+    x = keras.layers.Dropout(dropout)(x)
+    # Logits in float32 under mixed precision, so the softmax and loss stay stable
+    outputs = keras.layers.Dense(num_classes, dtype="float32")(x)
+
+    return keras.Model(inputs, outputs)
+
+
+def compile_model(model, learning_rate=0.001, jit_compile=False):
+    """
+    Compile the model with the loss and metrics of make_model_v1.py.
+
+    :param model: Model from build_model().
+    :param learning_rate: Learning rate of the Adam optimizer.
+    :param jit_compile: Compile the train step (and augmentation layers in the model,
+        if any) with XLA. Augmentation in the input pipeline is compiled separately,
+        see data_funcs.augment_dataset().
+    """
+    model.compile(loss=keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                  optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
+                  metrics=[keras.metrics.SparseCategoricalAccuracy(name="acc"),
+                           keras.metrics.SparseTopKCategoricalAccuracy(
+                               k=3, name="top_3_acc")],
+                  jit_compile=jit_compile)
+
+
+class StepTimer(keras.callbacks.Callback):
+    """
+    Record the duration of every epoch (including validation) and the training steps
+    per second.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.epoch_times = []
+        self.steps_per_second = []
+        self._start = None
+        self._steps = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = time.perf_counter()
+        self._steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._steps += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_time = time.perf_counter() - self._start
+        self.epoch_times.append(epoch_time)
+        self.steps_per_second.append(self._steps / epoch_time)
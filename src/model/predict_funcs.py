@@ -0,0 +1,188 @@
+# Functions for predicting the classes of many images offline. Images are decoded in
+# parallel threads, predicted in batches with the serving function of the app and the
+# top k results are written to a CSV or Parquet file batch by batch. Used in
+# make_predictions.py.
+
+## Imports
+import concurrent.futures
+import glob
+import os
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.app.preprocessing import preprocess_image_file
+
+# Image file types picked up from directories
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+## Functions
+
+def list_input_images(source, column="image_path"):
+    """
+    List the images to predict from a directory (searched recursively), a glob
+    pattern or a CSV manifest.
+
+    :param source: Directory, glob pattern (e.g. "photos/**/*.jpg") or CSV file.
+    :param column: Column with the image paths in a CSV manifest.
+    :return: List of image paths (sorted, except for manifests).
+    """
+    path_source = pathlib.Path(source)
+
+    if path_source.is_dir():
+        return sorted(str(path) for path in path_source.rglob("*")
+                      if path.suffix.lower() in IMAGE_EXTENSIONS)
+
+    if path_source.suffix.lower() == ".csv":
+        return pd.read_csv(path_source, usecols=[column])[column].astype(str).tolist()
+
+    return sorted(glob.glob(source, recursive=True))
+
+
+def load_completed_images(path_output):
+    """
+    Find the images already predicted in an earlier run.
+
+    :param path_output: CSV file or Parquet directory written by predict_images().
+    :return: Set of image paths.
+    """
+    if path_output.is_dir():
+        parts = sorted(path_output.glob("part-*.parquet"))
+        if not parts:
+            return set()
+        return set(pd.concat([pd.read_parquet(part, columns=["image_path"])
+                              for part in parts])["image_path"])
+
+    if path_output.is_file():
+        return set(pd.read_csv(path_output, usecols=["image_path"])["image_path"])
+
+    return set()
+
+
+def decode_batch(paths, executor, image_size=(224, 224)):
+    """
+    Decode and resize a batch of image files in parallel into a preallocated array.
+    Images that fail to decode are left as zeros and reported.
+
+    :param paths: Image paths.
+    :param executor: Thread pool for decoding.
+    :param image_size: Model input size (height, width).
+    :return: Float32 batch array and a list with an error message (or "") per image.
+    """
+    img_batch = np.zeros((len(paths),) + tuple(image_size) + (3,), dtype=np.float32)
+    errors = [""] * len(paths)
+
+    def decode_into_batch(j):
+        try:
+            img_batch[j] = preprocess_image_file(paths[j], image_size=image_size)
+        except Exception as e:
+            errors[j] = f"{type(e).__name__}: {e}"
+
+    list(executor.map(decode_into_batch, range(len(paths))))
+
+    return img_batch, errors
+
+
+def format_predictions(paths, prediction, errors, classes):
+    """
+    Turn serving function outputs into a results table.
+
+    :param paths: Image paths.
+    :param prediction: Dictionary with the top k "scores" and "indices".
+    :param errors: Error message (or "") per image, see decode_batch().
+    :param classes: Class names in label order.
+    :return: Dataframe with image_path, class_1, score_1, ..., class_k, score_k, error.
+    """
+    scores = np.asarray(prediction["scores"])
+    indices = np.asarray(prediction["indices"])
+    classes = np.asarray(classes)
+
+    df = pd.DataFrame({"image_path": paths})
+    for k in range(scores.shape[1]):
+        df[f"class_{k + 1}"] = classes[indices[:, k]]
+        df[f"score_{k + 1}"] = scores[:, k]
+    df["error"] = errors
+
+    # No predictions for images that could not be read
+    failed = df["error"] != ""
+    df.loc[failed, df.columns[1:-1]] = None
+
+    return df
+
+
+def write_results(df, path_output, part):
+    """
+    Append a batch of results to the output. CSV files are appended in place, Parquet
+    results are written as numbered part files into a directory.
+
+    :param df: Results from format_predictions().
+    :param path_output: Path to a .csv file or a Parquet directory.
+    :param part: Running number of the batch, used for Parquet part filenames.
+    """
+    if path_output.suffix.lower() == ".csv":
+        df.to_csv(path_output, mode="a", index=False, header=not path_output.is_file())
+    else:
+        os.makedirs(path_output, exist_ok=True)
+        # Write under a temporary name, so a crash never leaves a partial part behind
+        path_part = path_output / f"part-{part:06d}.parquet"
+        path_tmp = path_part.with_suffix(".tmp")
+        df.to_parquet(path_tmp, index=False)
+        os.replace(path_tmp, path_part)
+
+
+def predict_images(serving_function, paths, classes, path_output, batch_size=64,
+                   decode_workers=None, image_size=(224, 224)):
+    """
+    Predict the top k classes of many images and write the results incrementally.
+    While a batch is in inference the next batch is being decoded, and at most these
+    two batches are in memory. Images already in the output are skipped, so a run
+    resumes where an earlier one stopped.
+
+    :param serving_function: Serving function that returns the top k "scores" and
+        "indices", see app/app/model_funcs.py
+    :param paths: Image paths.
+    :param classes: Class names in label order.
+    :param path_output: Path to a .csv file or a Parquet directory (e.g.
+        predictions.parquet).
+    :param batch_size: Number of images per inference call.
+    :param decode_workers: Number of decode threads. None uses the number of cores.
+    :param image_size: Model input size (height, width).
+    """
+    path_output = pathlib.Path(path_output)
+
+    completed = load_completed_images(path_output)
+    pending = [path for path in paths if path not in completed]
+    print(f"Predicting {len(pending)} images ({len(paths) - len(pending)} done)")
+
+    # Continue the numbering of Parquet parts written in earlier runs
+    part = len(list(path_output.glob("part-*.parquet"))) if path_output.is_dir() else 0
+
+    batches = [pending[j:j + batch_size] for j in range(0, len(pending), batch_size)]
+    decode_workers = decode_workers or os.cpu_count()
+
+    start = time.perf_counter()
+    n_done = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=decode_workers) as executor:
+        # A separate thread decodes the next batch while the current one is predicted
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+            future = (prefetcher.submit(decode_batch, batches[0], executor, image_size)
+                      if batches else None)
+
+            for j, batch_paths in enumerate(batches):
+                img_batch, errors = future.result()
+                if j + 1 < len(batches):
+                    future = prefetcher.submit(decode_batch, batches[j + 1], executor,
+                                               image_size)
+
+                prediction = serving_function(img_batch)
+                write_results(format_predictions(batch_paths, prediction, errors,
+                                                 classes), path_output, part)
+                part += 1
+
+                n_done += len(batch_paths)
+                elapsed = time.perf_counter() - start
+                print(f"Predicted {n_done} / {len(pending)} images "
+                      f"({n_done / elapsed:.1f} images/s)")
@@ -0,0 +1,131 @@
+# Functions for converting trained models to quantized TensorFlow Lite models and
+# evaluating them against the original model.
+
+## Imports
+
+import numpy as np
+import tensorflow as tf
+
+from app.app.model_funcs import build_serving_function
+from src.model.data_funcs import find_predicted_true, compute_top_k_accuracy, \
+    evaluate_model, list_image_files, make_image_dataset
+
+# Supported quantization modes
+QUANTIZATION_MODES = ("dynamic_range", "float16", "int8")
+
+
+## Classes
+
+class TFLiteModel:
+    """
+    Run a TensorFlow Lite model exported with convert_to_tflite() through the same
+    predict() interface as a Keras model, so it can be evaluated with data_funcs.
+    """
+
+    def __init__(self, path_tflite):
+        """
+        :param path_tflite: Path to the .tflite file.
+        """
+        self.interpreter = tf.lite.Interpreter(model_path=str(path_tflite))
+        self.runner = self.interpreter.get_signature_runner()
+
+    def predict(self, data_batch):
+        """
+        Compute logits for a batch of images.
+
+        :param data_batch: Batch of images.
+        :return: Numpy array with the logits.
+        """
+        return self.runner(images=np.asarray(data_batch, dtype=np.float32))["logits"]
+
+
+## Functions
+
+def make_representative_dataset(path_image_dir, n_samples=200, image_size=(224, 224),
+                                seed=666):
+    """
+    Create a representative dataset for calibrating the int8 quantization ranges.
+
+    :param path_image_dir: Path to a processed image directory (one folder per class).
+    :param n_samples: Number of images used for calibration.
+    :param image_size: Model input size (height, width).
+    :param seed: Random seed for picking the images.
+    :return: Generator function that yields single-image batches.
+    """
+    # Shuffled, so the calibration images cover all classes
+    paths, labels, _ = list_image_files(path_image_dir)
+    ds = make_image_dataset(paths, labels, image_size=image_size, batch_size=1,
+                            shuffle=True, seed=seed)
+
+    def representative_dataset():
+        for data_batch, _ in ds.take(n_samples):
+            yield [tf.cast(data_batch, tf.float32)]
+
+    return representative_dataset
+
+
+def convert_to_tflite(model, mode, representative_dataset=None, image_size=(224, 224),
+                      top_k=3):
+    """
+    Convert a model to a quantized TensorFlow Lite model. The model signature returns
+    the top k "scores" and "indices" like the exported serving model, and "logits" for
+    evaluation. Inputs and outputs stay float32, so the app can run every variant the
+    same way.
+
+    :param model: Trained model that outputs logits.
+    :param mode: "dynamic_range" (int8 weights), "float16" (float16 weights) or "int8"
+        (int8 weights and activations).
+    :param representative_dataset: Generator function from
+        make_representative_dataset(). Required, if mode = "int8".
+    :param image_size: Model input size (height, width).
+    :param top_k: Number of results to return, ranked by highest confidence score.
+    :return: The converted model as bytes.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode: {mode}")
+    if mode == "int8" and representative_dataset is None:
+        raise ValueError("Define the representative dataset for int8 quantization")
+
+    serving_function = build_serving_function(model, image_size=image_size, top_k=top_k,
+                                              include_logits=True)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [serving_function.get_concrete_function()], model)
+
+    # Every mode quantizes the weights
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if mode == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == "int8":
+        # Calibrate activation ranges, fail if an op cannot run in int8
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    return converter.convert()
+
+
+def evaluate_models(models, ds):
+    """
+    Compute the top-1 and top-3 accuracy of several models on the same dataset.
+
+    :param models: Dictionary that maps a model name to a model. The first model is
+        the reference for the accuracy deltas.
+    :param ds: Dataset to evaluate the models on.
+    :return: List with a dictionary of accuracies and deltas per model.
+    """
+    results = []
+    for name, model in models.items():
+        # One inference pass per model, both accuracies come from its logits
+        evaluation = evaluate_model(model, ds)
+        predicted_labels, true_labels = find_predicted_true(model, ds, evaluation)
+        top1_acc = float(np.mean(predicted_labels == true_labels))
+        top3_acc = compute_top_k_accuracy(model, ds, k=3, evaluation=evaluation)
+
+        results.append({"model": name, "top1_acc": top1_acc, "top3_acc": top3_acc})
+
+    # Deltas against the reference model
+    for result in results:
+        result["top1_delta"] = result["top1_acc"] - results[0]["top1_acc"]
+        result["top3_delta"] = result["top3_acc"] - results[0]["top3_acc"]
+
+    return results
@@ -0,0 +1,78 @@
+# Run a k-fold cross-validation sweep over the head hyperparameters of the baseline
+# model (dropout, learning rate, batch size). The backbone embeddings of all train and
+# validation images are computed once and shared read-only by the trials, which run
+# in parallel processes. Rerunning the script resumes an interrupted sweep.
+#
+# Run as a module from the project root: python -m src.model.run_sweep
+
+## Imports
+import os
+import pathlib
+
+import numpy as np
+
+from src.model.sweep_funcs import make_trials, run_sweep, summarize_sweep
+
+## Paths (relative to project root)
+
+# Processed data directory
+path_processed_dir = pathlib.Path("data/02_processed/")
+
+# Model directory
+path_model_dir = pathlib.Path("models/")
+
+# Training and validation data
+path_train_val_dir = path_processed_dir / "train_and_validation"
+
+# Split written by src/data/s02_make_splits.py
+path_split = path_processed_dir / "splits" / "train_and_validation_seed666.npz"
+
+# Embedding cache
+path_embedding_dir = path_processed_dir / "embeddings"
+
+# Sweep results, one row per trial (also the checkpoint for resuming)
+path_results = path_model_dir / "sweeps" / "head_sweep_results.csv"
+
+# Results aggregated over the folds
+path_summary = path_model_dir / "sweeps" / "head_sweep_summary.csv"
+
+## Settings
+
+image_size = (224, 224)
+
+# Must match the folds in the split file
+n_folds = 5
+
+param_grid = {
+    "dropout": [0.2, 0.4],
+    "learning_rate": [0.001, 0.0003],
+    "batch_size": [32, 64],
+}
+
+# Threads per trial. The number of parallel trials follows from the core count.
+threads_per_trial = 2
+
+## Run sweep
+if __name__ == "__main__":
+    # Imported here, so the spawned worker processes do not load the backbone
+    from src.model.data_funcs import load_split
+    from src.model.embedding_funcs import build_backbone, compute_embeddings
+
+    split = load_split(path_split, path_image_dir=path_train_val_dir)
+    paths = np.array([str(path_train_val_dir / file) for file in split["files"]])
+
+    # Shared embeddings. One view per image: the folds take their train and
+    # validation images from it.
+    embeddings = compute_embeddings(build_backbone(image_size), paths,
+                                    path_embedding_dir, image_size=image_size)
+    path_embeddings = embeddings.filename
+    del embeddings
+
+    os.makedirs(path_results.parent, exist_ok=True)
+    trials = make_trials(param_grid, n_folds)
+    df_results = run_sweep(trials, path_embeddings, path_split, path_results,
+                           threads_per_trial=threads_per_trial)
+
+    df_summary = summarize_sweep(df_results, param_grid)
+    df_summary.to_csv(path_summary, index=False)
+    print(df_summary.to_string())
@@ -0,0 +1,239 @@
+# Functions for running k-fold / hyperparameter sweeps of the classifier head in
+# parallel processes. Every trial (fold x config) trains on the same read-only
+# embedding file from embedding_funcs.py, which the processes memory-map, so the
+# dataset is in the page cache once no matter how many trials run.
+
+## Imports
+import concurrent.futures
+import hashlib
+import itertools
+import multiprocessing
+import os
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+
+
+## Functions
+
+def make_trials(param_grid, n_folds):
+    """
+    Expand a parameter grid into trials, one per fold and parameter combination.
+
+    :param param_grid: Dictionary that maps a parameter name to a list of values.
+    :param n_folds: Number of folds.
+    :return: List of trial dictionaries with "trial_id", "fold" and the parameters.
+    """
+    names = sorted(param_grid)
+    trials = []
+    for values in itertools.product(*(param_grid[name] for name in names)):
+        config = dict(zip(names, values))
+        config_id = "_".join(f"{name}={value}" for name, value in config.items())
+        for fold in range(n_folds):
+            trials.append({"trial_id": f"fold={fold}_{config_id}", "fold": fold,
+                           **config})
+
+    return trials
+
+
+def init_worker(threads_per_trial):
+    """
+    Limit the threads of a worker process before TensorFlow starts, so parallel
+    trials do not oversubscribe the cores.
+
+    :param threads_per_trial: Number of threads per process.
+    """
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_trial)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads_per_trial)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_trial)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def run_trial(trial, path_embeddings, path_split, epochs=100, patience=10):
+    """
+    Train and evaluate the classifier head for one trial. Runs in a worker process.
+
+    :param trial: Trial dictionary from make_trials() with fold, dropout,
+        learning_rate and batch_size.
+    :param path_embeddings: Embedding file (.npy) of all train and validation images,
+        see embedding_funcs.compute_embeddings().
+    :param path_split: Split file written by src/data/s02_make_splits.py.
+    :param epochs: Maximum number of epochs.
+    :param patience: Epochs without validation loss improvement before stopping.
+    :return: Trial dictionary with the results added.
+    """
+    from tensorflow import keras
+
+    from src.model.data_funcs import load_split, split_indices
+    from src.model.embedding_funcs import build_head, make_embedding_dataset
+
+    start = time.perf_counter()
+
+    # Read-only memory map, shared with the other processes through the page cache
+    embeddings = np.load(path_embeddings, mmap_mode="r")
+    split = load_split(path_split)
+    train_ix, validation_ix = split_indices(split, fold=trial["fold"])
+
+    train_ds = make_embedding_dataset(embeddings, split["labels"],
+                                      batch_size=trial["batch_size"], shuffle=True,
+                                      image_ix=train_ix)
+    validation_ds = make_embedding_dataset(embeddings[:1], split["labels"],
+                                           batch_size=trial["batch_size"],
+                                           image_ix=validation_ix)
+
+    head = build_head(embeddings.shape[-1], len(split["class_names"]),
+                      dropout=trial["dropout"])
+    head.compile(loss=keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                 optimizer=keras.optimizers.Adam(learning_rate=trial["learning_rate"]),
+                 metrics=[keras.metrics.SparseCategoricalAccuracy(name="acc"),
+                          keras.metrics.SparseTopKCategoricalAccuracy(
+                              k=3, name="top_3_acc")])
+
+    history = head.fit(train_ds, epochs=epochs, validation_data=validation_ds,
+                       verbose=0,
+                       callbacks=[keras.callbacks.EarlyStopping(
+                           monitor="val_loss", patience=patience,
+                           restore_best_weights=True)])
+
+    # Metrics of the restored best epoch
+    val_loss, val_acc, val_top_3_acc = head.evaluate(validation_ds, verbose=0)
+
+    return {**trial,
+            "epochs": len(history.history["loss"]),
+            "val_loss": val_loss,
+            "val_acc": val_acc,
+            "val_top_3_acc": val_top_3_acc,
+            "seconds": time.perf_counter() - start}
+
+
+def sweep_data_keys(path_embeddings, path_split):
+    """
+    Identify the data a sweep trains on, so results of trials on other embeddings or
+    another split are not reused when resuming.
+
+    :param path_embeddings: Embedding file (.npy). Its name holds the embedding cache
+        key, see embedding_funcs.compute_embeddings().
+    :param path_split: Split file.
+    :return: Dictionary with "embedding_key" and "split_hash".
+    """
+    with open(path_split, "rb") as f:
+        split_hash = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+    return {"embedding_key": pathlib.Path(path_embeddings).stem,
+            "split_hash": split_hash}
+
+
+def load_completed_trials(path_results, data_keys=None):
+    """
+    Load the results of trials that finished in earlier runs of the sweep.
+
+    :param path_results: Path to results file (csv).
+    :param data_keys: Keys from sweep_data_keys(). Only rows with the same keys are
+        returned. None returns all rows.
+    :return: Dataframe with one row per finished trial.
+    """
+    if not path_results.is_file():
+        return pd.DataFrame()
+
+    df_results = pd.read_csv(path_results)
+    if data_keys is None:
+        return df_results
+
+    # Rows written before the keys were stored have none and do not match
+    matching = pd.Series(True, index=df_results.index)
+    for key, value in data_keys.items():
+        if key not in df_results:
+            return df_results.iloc[:0]
+        matching &= df_results[key] == value
+
+    return df_results[matching].reset_index(drop=True)
+
+
+def run_sweep(trials, path_embeddings, path_split, path_results, n_processes=None,
+              threads_per_trial=None, **trial_kwargs):
+    """
+    Run trials in a process pool. Each finished trial is appended to the results file
+    right away, so an interrupted sweep resumes with the missing trials only. Rows are
+    stored with the keys of the embeddings and the split, results of trials on other
+    data are dropped from the results file and the trials run again.
+
+    :param trials: Trials from make_trials().
+    :param path_embeddings: Embedding file (.npy), see run_trial().
+    :param path_split: Split file, see run_trial().
+    :param path_results: Path to results file (csv).
+    :param n_processes: Number of parallel trials. None uses the number of cores
+        divided by threads_per_trial.
+    :param threads_per_trial: Threads per trial. None splits the cores evenly between
+        the processes (at least one each).
+    :param trial_kwargs: Passed on to run_trial(), e.g. epochs.
+    :return: Dataframe with the results of all trials on the current data, including
+        earlier runs.
+    """
+    n_cores = os.cpu_count() or 1
+    if n_processes is None:
+        n_processes = max(1, n_cores // (threads_per_trial or 1))
+    if threads_per_trial is None:
+        threads_per_trial = max(1, n_cores // n_processes)
+
+    # Skip trials that are already in the results file and ran on the same data
+    data_keys = sweep_data_keys(path_embeddings, path_split)
+    n_rows = len(load_completed_trials(path_results))
+    df_completed = load_completed_trials(path_results, data_keys)
+    if n_rows > len(df_completed):
+        print(f"Dropping {n_rows - len(df_completed)} results of trials on other "
+              f"embeddings or another split from {path_results}")
+        if len(df_completed):
+            df_completed.to_csv(path_results, index=False)
+        else:
+            os.remove(path_results)
+    completed = set(df_completed["trial_id"]) if len(df_completed) else set()
+    pending = [trial for trial in trials if trial["trial_id"] not in completed]
+
+    print(f"Running {len(pending)} trials ({len(completed)} done) in {n_processes} "
+          f"processes with {threads_per_trial} threads each")
+
+    # Spawn fresh processes, so no TensorFlow state is inherited from the parent
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_processes, mp_context=context, initializer=init_worker,
+            initargs=(threads_per_trial,)) as executor:
+        futures = [executor.submit(run_trial, trial, path_embeddings, path_split,
+                                   **trial_kwargs)
+                   for trial in pending]
+
+        for j, future in enumerate(concurrent.futures.as_completed(futures)):
+            result = {**future.result(), **data_keys}
+
+            # Checkpoint: append the finished trial to the results file
+            pd.DataFrame([result]).to_csv(path_results, mode="a", index=False,
+                                          header=not path_results.is_file())
+            print(f"Finished trial {j + 1} / {len(pending)}: {result['trial_id']} "
+                  f"val_acc={result['val_acc']:.3f} ({result['seconds']:.0f} s)")
+
+    return load_completed_trials(path_results, data_keys)
+
+
+def summarize_sweep(df_results, param_names):
+    """
+    Aggregate trial results over the folds of each parameter combination.
+
+    :param df_results: Dataframe returned by run_sweep().
+    :param param_names: Names of the swept parameters.
+    :return: Dataframe with the mean and standard deviation of the validation metrics
+        per combination, best first.
+    """
+    df_summary = (df_results
+                  .groupby(list(param_names))[["val_loss", "val_acc", "val_top_3_acc",
+                                               "epochs"]]
+                  .agg(["mean", "std"]))
+    # Flatten the column levels: val_acc_mean, val_acc_std, ...
+    df_summary.columns = ["_".join(column) for column in df_summary.columns]
+    df_summary["n_folds"] = df_results.groupby(list(param_names)).size()
+
+    return df_summary.sort_values("val_acc_mean", ascending=False).reset_index()
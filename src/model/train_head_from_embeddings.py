@@ -0,0 +1,108 @@
+# Train the classifier head of the baseline model on cached backbone embeddings. The
+# frozen MobileNetV2 runs once over the training images (plus augmented views) and
+# once over the validation images. The head then trains for up to 100 epochs on the
+# embeddings without touching the backbone, which takes minutes on a CPU. The trained
+# head is attached to the backbone and saved as a regular model without augmentation.
+#
+# Run as a module from the project root: python -m src.model.train_head_from_embeddings
+
+## Imports
+import pathlib
+
+import numpy as np
+from tensorflow import keras
+
+from src.model.data_funcs import load_split, split_indices
+from src.model.embedding_funcs import attach_head, build_backbone, build_head, \
+    compute_embeddings, make_embedding_dataset
+
+## Paths (relative to project root)
+
+# Model name - used for saving
+model_name = "mushi_identifier_v1_head"
+
+# Processed data directory
+path_processed_dir = pathlib.Path("data/02_processed/")
+
+# Model directory
+path_model_dir = pathlib.Path("models/")
+
+# Training and validation data
+path_train_val_dir = path_processed_dir / "train_and_validation"
+
+# Split written by src/data/s02_make_splits.py
+path_split = path_processed_dir / "splits" / "train_and_validation_seed666.npz"
+
+# Embedding cache
+path_embedding_dir = path_processed_dir / "embeddings"
+
+# Training logs
+path_training_logs = path_model_dir / "training_logs" / (
+        model_name + "_training_logs.csv")
+
+# Saved model
+path_saved_model = path_model_dir / (model_name + ".keras")
+
+## Settings
+
+image_size = (224, 224)
+
+# Plain view plus augmented views of each training image. The validation images are
+# embedded without augmentation.
+n_train_views = 5
+
+# Validation fold for k-fold cross-validation. None uses the train/validation split.
+fold = None
+
+# Embeddings are small, so large batches are cheap
+batch_size = 256
+
+learning_rate = 0.001
+
+## Compute embeddings
+
+split = load_split(path_split, path_image_dir=path_train_val_dir)
+paths = np.array([str(path_train_val_dir / file) for file in split["files"]])
+labels = split["labels"]
+class_names = list(split["class_names"])
+train_ix, validation_ix = split_indices(split, fold=fold)
+
+backbone = build_backbone(image_size)
+
+# Cached on disk, recomputed only if the images, backbone or preprocessing change
+train_embeddings = compute_embeddings(backbone, paths[train_ix], path_embedding_dir,
+                                      image_size=image_size, n_views=n_train_views)
+validation_embeddings = compute_embeddings(backbone, paths[validation_ix],
+                                           path_embedding_dir, image_size=image_size)
+
+train_ds = make_embedding_dataset(train_embeddings, labels[train_ix],
+                                  batch_size=batch_size, shuffle=True)
+validation_ds = make_embedding_dataset(validation_embeddings, labels[validation_ix],
+                                       batch_size=batch_size)
+
+## Train head
+
+head = build_head(train_embeddings.shape[-1], len(class_names))
+
+head.compile(loss=keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+             optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
+             metrics=[keras.metrics.SparseCategoricalAccuracy(name="acc"),
+                      keras.metrics.SparseTopKCategoricalAccuracy(k=3,
+                                                                  name="top_3_acc")])
+
+callbacks = [
+    # Stop training once validation loss ceases to improve, keep the best weights
+    keras.callbacks.EarlyStopping(monitor="val_loss", verbose=1, patience=10,
+                                  restore_best_weights=True),
+    # Log training loss and metrics to a csv file
+    keras.callbacks.CSVLogger(filename=path_training_logs, append=True)
+]
+
+head.fit(train_ds, epochs=100, callbacks=callbacks, validation_data=validation_ds)
+
+## Save model
+
+# Backbone + head, takes images like the model from make_model_v1.py
+model = attach_head(backbone, head, image_size)
+model.save(path_saved_model)
+print(f"Saved {path_saved_model}")